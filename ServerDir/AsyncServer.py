@@ -0,0 +1,236 @@
+import asyncio
+import signal
+import time
+
+from Framer import RequestFramer
+import Handlers  # Attaches the default request handlers to RequestRegistry
+import Reaper
+import Response
+from Logger import Log
+import Metrics
+from Spool import SpooledContent
+import Tracing
+
+
+class AsyncServer:
+    """
+    Single-threaded asyncio backend for the server.
+
+    Every connection is served by a coroutine on one event loop instead of a
+    dedicated OS thread, so thousands of idle or polling clients cost a few KB
+    each rather than a thread stack each. Requests go through the same
+    RequestFramer and Handlers.handle_frame path as the threaded server. Idle
+    and slow connections are closed by a Reaper driven from a loop timer,
+    rather than by a timeout on every read.
+    """
+    logger = Log(logger_name=__name__)
+
+    READ_CHUNK_SIZE = 64 * 1024
+
+    idle_timeout = 30
+    request_timeout = Reaper.Reaper.DEFAULT_REQUEST_TIMEOUT
+    reaper = None
+    max_requests_per_connection = 1000
+    max_payload_size = RequestFramer.DEFAULT_MAX_PAYLOAD_SIZE
+    buffer_pool = None
+    spool_threshold = None
+    draining = False  # Set when the server stops accepting connections: connections close after their current request
+    _writers = set()  # Open connections, closed by force when a drain times out
+
+    @staticmethod
+    def start_server(host, port, idle_timeout, max_requests_per_connection, max_payload_size, ready=None,
+                     listen_socket=None, reuse_port=False, drain_timeout=None, buffer_pool=None,
+                     spool_threshold=None, request_timeout=None):
+        """
+        Runs the asyncio server until it is interrupted.
+
+        Args:
+            host (str): The address to bind.
+            port (int): The port to bind.
+            idle_timeout (float): Seconds to wait for the next request on a connection.
+            max_requests_per_connection (int): Requests served before a connection is closed.
+            max_payload_size (int): The largest request payload accepted.
+            ready (callable, optional): Called with the bound (host, port) once the server accepts connections.
+            listen_socket (socket.socket, optional): An already listening socket to accept from, instead of binding.
+            reuse_port (bool): Bind with SO_REUSEPORT, so several processes can listen on the same port.
+            drain_timeout (float, optional): If given, SIGTERM drains the server and returns (see Server.start_server).
+            buffer_pool (BufferPool, optional): Where request payload buffers are borrowed from.
+            spool_threshold (int, optional): Send message contents larger than this are spooled to disk.
+            request_timeout (float, optional): Seconds to receive a request or send a response (see Reaper).
+        """
+        AsyncServer.idle_timeout = idle_timeout
+        AsyncServer.max_requests_per_connection = max_requests_per_connection
+        AsyncServer.max_payload_size = max_payload_size
+        AsyncServer.buffer_pool = buffer_pool
+        AsyncServer.spool_threshold = spool_threshold
+        AsyncServer.request_timeout = request_timeout or AsyncServer.request_timeout
+        try:
+            asyncio.run(AsyncServer.serve(host, port, ready, listen_socket, reuse_port, drain_timeout))
+        except KeyboardInterrupt:
+            AsyncServer.logger.debug("Close server")
+        except Exception as e:
+            AsyncServer.logger.error(e)
+
+    @staticmethod
+    async def serve(host, port, ready=None, listen_socket=None, reuse_port=False, drain_timeout=None):
+        if listen_socket is not None:
+            server = await asyncio.start_server(AsyncServer.handle_client, sock=listen_socket)
+        else:
+            server = await asyncio.start_server(AsyncServer.handle_client, host, port, reuse_port=reuse_port or None)
+        host, port = server.sockets[0].getsockname()[:2]
+        AsyncServer.logger.info(f"Server listening on [{host}:{port}] (asyncio)")
+        AsyncServer.reaper = Reaper.Reaper(AsyncServer.idle_timeout, AsyncServer.request_timeout)
+        Metrics.add_source("reaper", AsyncServer.reaper.stats)
+        AsyncServer.schedule_reaping(asyncio.get_running_loop())
+        if ready:
+            ready(host, port)
+
+        if drain_timeout is None:
+            async with server:
+                await server.serve_forever()
+            return
+
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        await stop.wait()
+
+        AsyncServer.logger.info("Stop accepting connections")
+        server.close()
+        AsyncServer.draining = True
+        closed = AsyncServer.reaper.close_idle()
+        if closed:
+            AsyncServer.logger.info(f"Closed {closed} idle connections")
+        deadline = loop.time() + drain_timeout
+        while Metrics.active_connections() and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        remaining = Metrics.active_connections()
+        if remaining:
+            AsyncServer.logger.warning(f"Drain timed out after {drain_timeout}s with {remaining} connections still open")
+            # Their handlers see the connection end and return, instead of being cancelled by asyncio.run
+            for writer in list(AsyncServer._writers):
+                writer.transport.abort()
+            await asyncio.sleep(0.1)
+        else:
+            AsyncServer.logger.info("All connections drained")
+
+    @staticmethod
+    def schedule_reaping(loop):
+        # One timer for all the connections, instead of a timeout on every read
+        AsyncServer.reaper.expire(loop.time())
+        loop.call_later(Reaper.TimerWheel.DEFAULT_TICK, AsyncServer.schedule_reaping, loop)
+
+    @staticmethod
+    def close_reaped(writer, reason):
+        # An idle (or drained) connection is closed cleanly, a slow one is dropped with whatever is left in its buffers
+        if reason == Reaper.REASON_IDLE or reason == Reaper.REASON_DRAINED:
+            writer.transport.close()
+        else:
+            writer.transport.abort()
+
+    @staticmethod
+    async def handle_client(reader, writer):
+        address = writer.get_extra_info("peername")
+        AsyncServer.logger.info("Connection from [%s]", address)
+        requests_handled = 0
+        framer = RequestFramer(AsyncServer.max_payload_size, AsyncServer.buffer_pool, AsyncServer.spool_threshold)
+        watch = AsyncServer.reaper.watch(framer, lambda reason: AsyncServer.close_reaped(writer, reason))
+        Metrics.connection_opened()
+        AsyncServer._writers.add(writer)
+        accepted_ns = time.perf_counter_ns()
+
+        try:
+            while requests_handled < AsyncServer.max_requests_per_connection:
+                recv_start_ns = time.perf_counter_ns() if Tracing.enabled else None
+                data = await reader.read(AsyncServer.READ_CHUNK_SIZE)
+                if not data:
+                    if watch.reaped is not None:
+                        break
+                    if not framer.idle:
+                        raise ValueError("Connection closed in the middle of a request")
+                    AsyncServer.logger.debug("Client closed the connection after %d requests", requests_handled)
+                    break
+
+                for frame in framer.feed(data):
+                    trace = None
+                    if Tracing.enabled:
+                        # Frames after the first of a chunk did not wait for the network
+                        trace = Tracing.new_trace(None if requests_handled else accepted_ns, recv_start_ns)
+                        recv_start_ns = None
+                        Tracing.mark(trace, Tracing.FRAME)
+
+                    requests_handled += 1
+                    try:
+                        if Tracing.profiling:
+                            response = Tracing.profile_call(Handlers.handle_frame, frame, trace)
+                        else:
+                            response = Handlers.handle_frame(frame, trace)
+                        if type(response) is Handlers.LongPoll:
+                            watch.sending(writer.transport.get_write_buffer_size())
+                            await writer.drain()  # The responses before it are not held back by the wait
+                            watch.busy()
+                            response = await Handlers.finish_long_poll_async(frame, response, trace)
+                    finally:
+                        framer.release(frame)
+                    if type(response) is Response.FileResponse:
+                        watch.sending(writer.transport.get_write_buffer_size() + Response.size(response))
+                        await AsyncServer.send_with_files(writer, response)
+                    elif response:
+                        writer.writelines(response)  # "sent" is when the response is buffered, drain() comes after
+                    if trace is not None:
+                        Tracing.finish(trace, frame.header.code, frame.header.client_id)
+                    if requests_handled >= AsyncServer.max_requests_per_connection:
+                        break
+                pending = writer.transport.get_write_buffer_size()
+                if pending:
+                    watch.sending(pending)
+                    await writer.drain()
+                if framer.idle:
+                    watch.waiting()
+                else:
+                    watch.receiving()
+                if AsyncServer.draining:
+                    AsyncServer.logger.debug("Closing connection, the server is draining")
+                    break
+            else:
+                AsyncServer.logger.info(f"Closing connection after the limit of {requests_handled} requests")
+
+        except (ValueError, OSError) as e:
+            if watch.reaped is None:
+                AsyncServer.logger.error(e)
+                Metrics.record_error(e)
+        except Exception as e:
+            AsyncServer.logger.error(e)
+            Metrics.record_error(e)
+
+        if watch.reaped is not None:
+            AsyncServer.logger.info(f"Closed connection reaped as [{watch.reaped}] after {requests_handled} requests")
+        watch.closed()
+        framer.close()
+        Metrics.connection_closed()
+        AsyncServer._writers.discard(writer)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+    @staticmethod
+    async def send_with_files(writer, buffers):
+        """Writes a response with spooled contents, sending each of them from its file with loop.sendfile."""
+        loop = asyncio.get_running_loop()
+        pending = []
+        try:
+            for buffer in buffers:
+                if type(buffer) is SpooledContent:
+                    if pending:
+                        writer.writelines(pending)
+                        pending = []
+                    await writer.drain()
+                    await buffer.send_async(loop, writer.transport)
+                else:
+                    pending.append(buffer)
+            if pending:
+                writer.writelines(pending)
+        finally:
+            Response.discard_files(buffers)
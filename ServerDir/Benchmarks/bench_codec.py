@@ -0,0 +1,104 @@
+"""
+Micro-benchmark for request parsing, codes 600-604.
+
+For every request code it reports the parse time in ns/op and the memory
+allocated per request, for both Protocol.parse_request (precompiled structs
+unpacked in place by one parser per code into a single flat NamedTuple per
+request, message contents as memoryviews) and the previous dict based parser that sliced the
+data and used struct.unpack with format strings. Both parse the same whole
+request buffer.
+
+ns/op is the best of five runs. "alloc blocks/op" is the number of memory blocks still held by one parsed
+request (the result objects themselves), "peak bytes/op" is the tracemalloc
+peak while parsing, divided by the number of requests.
+
+Usage (from the ServerDir folder):
+    python Benchmarks/bench_codec.py --iterations 200000
+"""
+import argparse
+import os
+import struct
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Codec
+from Protocol import Protocol
+
+
+def legacy_parse_request(data):
+    """The parser as it was before the codec layer, extended to the same codes for comparison."""
+    header = struct.unpack("<16s B H I", data[:23])
+    payload_data = data[23:23 + header[3]]
+    code = header[2]
+    if code == 600:
+        name_raw, public_key_raw = struct.unpack("<255s 160s", payload_data)
+        payload = {"name": name_raw.rstrip(b"\x00").decode("ascii"), "public_key": public_key_raw.rstrip(b"\x00")}
+    elif code == 602:
+        payload = {"client_id": struct.unpack("<16s", payload_data)[0]}
+    elif code == 603:
+        client_id, message_type, content_size = struct.unpack("<16s B I", payload_data[:21])
+        payload = {"client_id": client_id, "message_type": message_type, "content_size": content_size,
+                   "content": payload_data[21:]}
+    else:
+        payload = None
+    return {
+        "header": {"client_id": header[0], "version": header[1], "code": code, "payload_size": header[3]},
+        "payload": payload,
+    }
+
+
+def sample_requests(message_size):
+    client_id = bytes(range(16))
+    return {
+        600: Protocol.build_request(client_id, 2, 600, Codec.REGISTRATION.pack(b"alice\0", bytes(range(160)))),
+        601: Protocol.build_request(client_id, 2, 601),
+        602: Protocol.build_request(client_id, 2, 602, client_id[::-1]),
+        603: Protocol.build_request(client_id, 2, 603,
+                                    Codec.MESSAGE_HEADER.pack(client_id[::-1], 3, message_size) + b"m" * message_size),
+        604: Protocol.build_request(client_id, 2, 604),
+    }
+
+
+def time_ns_per_op(parse, data, iterations, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for _ in range(iterations):
+            parse(data)
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / iterations
+
+
+def allocations_per_op(parse, data, iterations):
+    results = [None] * iterations  # preallocated so the list itself is not counted
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    for i in range(iterations):
+        results[i] = parse(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks = sys.getallocatedblocks() - blocks_before
+    del results
+    return blocks / iterations, peak / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200000)
+    parser.add_argument("--message-size", type=int, default=4096, help="Content size of the 603 request")
+    args = parser.parse_args()
+
+    print(f"{'code':<6}{'parser':<8}{'ns/op':>10}{'alloc blocks/op':>18}{'peak bytes/op':>16}")
+    for code, data in sample_requests(args.message_size).items():
+        for name, parse in (("legacy", legacy_parse_request), ("codec", Protocol.parse_request)):
+            ns = time_ns_per_op(parse, data, args.iterations)
+            blocks, peak = allocations_per_op(parse, data, min(args.iterations, 20000))
+            print(f"{code:<6}{name:<8}{ns:>10.0f}{blocks:>18.1f}{peak:>16.0f}")
+
+
+if __name__ == "__main__":
+    main()
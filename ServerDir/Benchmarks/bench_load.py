@@ -0,0 +1,302 @@
+"""
+Reproducible load benchmark with a configurable request mix.
+
+Starts the server in this process on a free port, then drives it with
+persistent client connections that send a weighted random mix of
+register (600), user list (601), public key (602), send (603) and pull (604)
+requests. Each connection first registers its own client. The load comes
+either from asyncio in this process or from a pool of worker processes
+(each running its own asyncio loop), for a fixed duration after a warmup.
+
+The result is one JSON document: requests/sec, latency percentiles and
+errors overall and per request type, and the peak RSS of this process (the
+server, plus the load generator with --driver asyncio). The random mix is
+seeded, so two runs send the same sequence of requests. --compare reads an
+earlier result and exits with status 1 if throughput or p99 latency
+regressed by more than --tolerance.
+
+Usage (from the ServerDir folder):
+    python Benchmarks/bench_load.py --mode pool --connections 32 --duration 10 --output run.json
+    python Benchmarks/bench_load.py --driver process --processes 4 --mix register=1,list=1,key=2,send=8,pull=8
+    python Benchmarks/bench_load.py --compare run.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Codec
+from Protocol import Protocol
+
+OPERATIONS = {
+    "register": Protocol.REGISTRATION_CODE,
+    "list": Protocol.USER_LIST_CODE,
+    "key": Protocol.PUBLIC_KEY_CODE,
+    "send": Protocol.SEND_MESSAGE_CODE,
+    "pull": Protocol.PULL_MESSAGES_CODE,
+}
+DEFAULT_MIX = "register=1,list=2,key=3,send=10,pull=10"
+CLIENT_VERSION = 1
+PUBLIC_KEY = b"k" * Codec.PUBLIC_KEY_SIZE
+
+
+def parse_mix(text):
+    """Parses "register=1,send=10,..." into {operation: weight}."""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation [{name}], expected one of {list(OPERATIONS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize(latencies, errors, elapsed):
+    """Latency percentiles in ms, request rate and error rate of one set of samples."""
+    latencies = sorted(latencies)
+    total = len(latencies) + errors
+    summary = {"requests": len(latencies), "errors": errors,
+               "error_rate": round(errors / total, 6) if total else 0.0,
+               "requests_per_sec": round(len(latencies) / elapsed, 1) if elapsed else None}
+    for name, fraction in (("p50_ms", 0.5), ("p90_ms", 0.9), ("p99_ms", 0.99), ("p999_ms", 0.999)):
+        value = percentile(latencies, fraction)
+        summary[name] = round(value * 1000, 3) if value is not None else None
+    summary["max_ms"] = round(latencies[-1] * 1000, 3) if latencies else None
+    return summary
+
+
+def peak_rss_kb():
+    """Peak RSS of this process in KB, or None where it cannot be read."""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KB on Linux
+    except (ImportError, OSError):
+        return None
+
+
+# Load generator
+
+class _Client:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.client_id = b""
+
+    async def call(self, code, payload=b""):
+        """Sends one request and waits for its whole response. Returns the response code and payload."""
+        self.writer.write(Protocol.build_request(self.client_id, CLIENT_VERSION, code, payload))
+        header = await self.reader.readexactly(Codec.RESPONSE_HEADER.size)
+        _, response_code, size = Codec.RESPONSE_HEADER.unpack(header)
+        response = await self.reader.readexactly(size) if size else b""
+        return response_code, response
+
+
+async def _drive(port, connections, mix, duration, warmup, seed, name_prefix):
+    """Runs the load on one event loop and returns {operation: (latencies, errors)} for the measured period."""
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    results = {name: ([], [0]) for name in names}
+    client_ids = []
+    counter = [0]
+
+    def next_name():
+        counter[0] += 1
+        return f"{name_prefix}-{counter[0]}".encode()
+
+    async def connect():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        client = _Client(reader, writer)
+        code, response = await client.call(Protocol.REGISTRATION_CODE,
+                                           Codec.REGISTRATION.pack(next_name(), PUBLIC_KEY))
+        if code != Protocol.REGISTRATION_SUCCESS_CODE:
+            raise RuntimeError(f"Could not register a load client (response code {code})")
+        client.client_id = response
+        client_ids.append(client.client_id)
+        return client
+
+    clients = [await connect() for _ in range(connections)]
+    loop = asyncio.get_running_loop()
+    measure_from = loop.time() + warmup
+    end = measure_from + duration
+
+    async def run(client, rng):
+        while loop.time() < end:
+            operation = rng.choices(names, weights)[0]
+            peer = rng.choice(client_ids)
+            if operation == "register":
+                payload = Codec.REGISTRATION.pack(next_name(), PUBLIC_KEY)
+            elif operation == "key":
+                payload = peer
+            elif operation == "send":
+                payload = Codec.MESSAGE_HEADER.pack(peer, 3, 64) + b"m" * 64
+            else:
+                payload = b""
+
+            start = time.perf_counter()
+            try:
+                code, _ = await client.call(OPERATIONS[operation], payload)
+            except (OSError, asyncio.IncompleteReadError):
+                results[operation][1][0] += 1
+                return
+            latency = time.perf_counter() - start
+            if loop.time() >= measure_from:
+                if code == Protocol.ERROR_CODE:
+                    results[operation][1][0] += 1
+                else:
+                    results[operation][0].append(latency)
+
+    await asyncio.gather(*(run(client, random.Random(seed * 1000 + index)) for index, client in enumerate(clients)))
+    for client in clients:
+        client.writer.close()
+    return {name: (latencies, errors[0]) for name, (latencies, errors) in results.items()}
+
+
+def _drive_process(port, connections, mix, duration, warmup, seed, index):
+    # Entry point of a load worker process
+    return asyncio.run(_drive(port, connections, mix, duration, warmup, seed * 1000 + index, f"load{seed}p{index}"))
+
+
+def run_load(port, driver, processes, connections, mix, duration, warmup, seed):
+    """
+    Runs the load and merges the results of every worker.
+
+    Returns:
+        dict: {operation: (latencies, errors)}.
+    """
+    if driver == "asyncio":
+        return asyncio.run(_drive(port, connections, mix, duration, warmup, seed, f"load{seed}"))
+
+    # Spawned (not forked) workers, so they do not inherit the server's threads and sockets
+    per_process = [connections // processes + (1 if i < connections % processes else 0) for i in range(processes)]
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes) as pool:
+        parts = pool.starmap(_drive_process, [(port, count, mix, duration, warmup, seed, index)
+                                               for index, count in enumerate(per_process) if count])
+    merged = {name: ([], 0) for name in mix}
+    for part in parts:
+        for name, (latencies, errors) in part.items():
+            merged[name][0].extend(latencies)
+            merged[name] = (merged[name][0], merged[name][1] + errors)
+    return merged
+
+
+def start_server(mode, workers, db_filename, message_log=None):
+    """Starts the server on a free port in a daemon thread of this process and returns the port."""
+    from Logger import Log, LogLevel
+
+    # Before importing the server, which logs as it loads: stdout carries only the JSON result, and per-request
+    # console lines would dominate the measurement
+    Log.set_console_stream(sys.stderr)
+    Log.set_levels(console_level=LogLevel.ERROR)
+    from Server import Server
+
+    bound = {}
+    ready = threading.Event()
+
+    def on_ready(host, port):
+        bound["port"] = port
+        ready.set()
+
+    thread = threading.Thread(target=Server.start_server, daemon=True, kwargs=dict(
+        mode=mode, port=0, max_workers=workers, max_requests=sys.maxsize, idle_timeout=600,
+        db_filename=db_filename, message_log=message_log, ready=on_ready))
+    thread.start()
+    if not ready.wait(10):
+        raise RuntimeError(f"Server in mode [{mode}] did not start")
+    return bound["port"]
+
+
+def compare(result, baseline, tolerance):
+    """Prints the change from a baseline result and returns False on a regression beyond the tolerance."""
+    if baseline.get("config") != result["config"]:
+        print("Note: the baseline was run with a different configuration", file=sys.stderr)
+    ok = True
+    for key, higher_is_better in (("requests_per_sec", True), ("p99_ms", False)):
+        old, new = baseline["total"].get(key), result["total"].get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        regressed = change < -tolerance if higher_is_better else change > tolerance
+        ok = ok and not regressed
+        print(f"{key}: {old} -> {new} ({change:+.1%}){'  REGRESSION' if regressed else ''}", file=sys.stderr)
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("threaded", "pool", "async"), default="pool", help="Server backend")
+    parser.add_argument("--workers", type=int, default=None, help="Worker threads in pool mode")
+    parser.add_argument("--db", default=None, help="Run the server with this SQLite database")
+    parser.add_argument("--message-log", default=None, help="Keep the messages in a message log in this folder")
+    parser.add_argument("--driver", choices=("asyncio", "process"), default="asyncio",
+                        help="Generate load from asyncio in this process or from worker processes")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="Worker processes (process driver)")
+    parser.add_argument("--connections", type=int, default=32, help="Client connections in total")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Request weights (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=10.0, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=1.0, help="Seconds of load before measuring")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="Also write the JSON result to this file")
+    parser.add_argument("--compare", default=None, help="A previous JSON result to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="Allowed relative drop of req/s or rise of p99 for --compare (default: %(default)s)")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    port = start_server(args.mode, args.workers, args.db, args.message_log)
+    start = time.perf_counter()
+    results = run_load(port, args.driver, max(1, args.processes), args.connections, mix, args.duration, args.warmup,
+                       args.seed)
+    elapsed = min(time.perf_counter() - start - args.warmup, args.duration) if args.duration else 0
+
+    all_latencies = [latency for latencies, _ in results.values() for latency in latencies]
+    result = {
+        "config": {"mode": args.mode, "workers": args.workers, "db": bool(args.db),
+                   "message_log": bool(args.message_log), "driver": args.driver,
+                   "processes": args.processes if args.driver == "process" else None,
+                   "connections": args.connections, "mix": mix, "duration": args.duration,
+                   "warmup": args.warmup, "seed": args.seed},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": os.cpu_count()},
+        "total": summarize(all_latencies, sum(errors for _, errors in results.values()), elapsed),
+        "operations": {name: summarize(latencies, errors, elapsed) for name, (latencies, errors) in results.items()},
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if not compare(result, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
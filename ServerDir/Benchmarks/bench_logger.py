@@ -0,0 +1,71 @@
+"""
+Per-call latency of the logger on the calling (request) thread.
+
+Measures logger.info calls in synchronous mode and in asynchronous mode
+(Log.enable_async), with the console output sent to os.devnull. For the
+asynchronous mode the time to drain the queue afterwards is reported too.
+The "filtered" row is a logger.debug call with a lazy argument while the
+console threshold is INFO, i.e. the cost of a disabled record.
+
+Usage (from the ServerDir folder):
+    python Benchmarks/bench_logger.py --calls 20000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Logger import Log, LogLevel
+
+
+def measure(log_call, calls):
+    latencies = []
+    for i in range(calls):
+        start = time.perf_counter_ns()
+        log_call("Request with code [%s] was successfully decrypted.", 600 + i % 5)
+        latencies.append(time.perf_counter_ns() - start)
+    latencies.sort()
+    return latencies
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=20000)
+    parser.add_argument("--queue-size", type=int, default=100000)
+    args = parser.parse_args()
+
+    results = []
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            logger = Log(logger_name="bench")
+            results.append(("sync", measure(logger.info, args.calls), None))
+
+            Log.set_levels(console_level=LogLevel.INFO)
+            results.append(("filtered", measure(logger.debug, args.calls), None))
+            Log.set_levels(console_level=LogLevel.DEBUG)
+
+            Log.enable_async(queue_size=args.queue_size, overflow="block")
+            latencies = measure(logger.info, args.calls)
+            start = time.perf_counter()
+            Log.flush()
+            results.append(("async", latencies, time.perf_counter() - start))
+            Log.disable_async()
+        finally:
+            sys.stdout = stdout
+
+    print(f"{'mode':<10}{'p50 us':>10}{'p99 us':>10}{'max us':>10}{'drain ms':>10}")
+    for mode, latencies, drain in results:
+        print(f"{mode:<10}{percentile(latencies, 0.5) / 1000:>10.1f}{percentile(latencies, 0.99) / 1000:>10.1f}"
+              f"{latencies[-1] / 1000:>10.1f}{'' if drain is None else f'{drain * 1000:.1f}':>10}")
+
+
+if __name__ == "__main__":
+    main()
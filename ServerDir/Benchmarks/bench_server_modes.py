@@ -0,0 +1,169 @@
+"""
+Load benchmark comparing the server backends (threaded, pool and asyncio).
+
+Each backend is started in its own process on a free port. An asyncio load
+generator then keeps a fixed number of client connections in flight, each one
+sending a user list request (601) and waiting for the server to finish with the
+connection. Latency percentiles, throughput, errors and the server's RSS are
+reported for every concurrency level.
+
+Usage (from the ServerDir folder):
+    python Benchmarks/bench_server_modes.py --concurrency 10 100 1000 --requests 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from Protocol import Protocol
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def read_rss_kb(pid):
+    """Returns (current RSS, peak RSS) of a process in KB, or (None, None) when /proc is unavailable."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            fields = dict(line.split(":", 1) for line in status if ":" in line)
+        return int(fields["VmRSS"].split()[0]), int(fields["VmHWM"].split()[0])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def start_server_process(mode, port):
+    process = subprocess.Popen(
+        [sys.executable, "Main.py", "--mode", mode, "--port", str(port)],
+        cwd=SERVER_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+
+    process.kill()
+    raise RuntimeError(f"Server in mode [{mode}] did not start on port {port}")
+
+
+async def one_request(port, request, latencies):
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(request)
+        writer.write_eof()  # no more requests on this connection
+        await writer.drain()
+        await reader.read()  # the server closes the connection once the request is handled
+    finally:
+        writer.close()
+    latencies.append(time.perf_counter() - start)
+
+
+async def run_load(port, concurrency, total_requests):
+    request = Protocol.build_request(b"", 1, 601)
+    latencies = []
+    errors = 0
+    remaining = total_requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            try:
+                await one_request(port, request, latencies)
+            except OSError:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def benchmark_mode(mode, concurrency_levels, total_requests):
+    port = find_free_port()
+    process = start_server_process(mode, port)
+    results = []
+
+    try:
+        for concurrency in concurrency_levels:
+            peak_rss = [0]
+            stop = threading.Event()
+
+            def sample_rss():
+                while not stop.is_set():
+                    rss, _ = read_rss_kb(process.pid)
+                    if rss:
+                        peak_rss[0] = max(peak_rss[0], rss)
+                    time.sleep(0.02)
+
+            sampler = threading.Thread(target=sample_rss, daemon=True)
+            sampler.start()
+            latencies, errors, elapsed = asyncio.run(run_load(port, concurrency, total_requests))
+            stop.set()
+            sampler.join()
+
+            latencies.sort()
+            p50 = percentile(latencies, 0.50)
+            p99 = percentile(latencies, 0.99)
+            results.append({
+                "mode": mode,
+                "concurrency": concurrency,
+                "requests": len(latencies),
+                "errors": errors,
+                "requests_per_sec": round(len(latencies) / elapsed, 1) if elapsed else None,
+                "p50_ms": round(p50 * 1000, 3) if p50 is not None else None,
+                "p99_ms": round(p99 * 1000, 3) if p99 is not None else None,
+                "peak_rss_kb": peak_rss[0] or None,
+            })
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", default=["threaded", "pool", "async"])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[10, 100, 500])
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per concurrency level")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    for mode in args.modes:
+        results.extend(benchmark_mode(mode, args.concurrency, args.requests))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'mode':<10}{'conc':>6}{'reqs':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'RSS KB':>10}")
+    for r in results:
+        print(f"{r['mode']:<10}{r['concurrency']:>6}{r['requests']:>8}{r['errors']:>8}"
+              f"{r['requests_per_sec']!s:>10}{r['p50_ms']!s:>10}{r['p99_ms']!s:>10}{r['peak_rss_kb']!s:>10}")
+
+
+if __name__ == "__main__":
+    main()
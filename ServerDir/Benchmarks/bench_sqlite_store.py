@@ -0,0 +1,78 @@
+"""
+Send throughput of the message store with SQLite durability off and on.
+
+Several threads store messages (as the 603 handler does) into a MessageStore
+that is either in memory only, journaled to SqliteStore with group commits,
+or journaled with a commit per send (batch size 1). The time includes the
+final flush, so every message counted as sent is committed.
+
+Usage (from the ServerDir folder):
+    python Benchmarks/bench_sqlite_store.py --messages 20000 --threads 8
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from MessageStore import MessageStore
+from SqliteStore import SqliteStore
+
+
+def run(store, messages, threads, content, recipients=64):
+    per_thread = messages // threads
+    sender_id = b"s" * 16
+    recipient_ids = [i.to_bytes(16, "little") for i in range(recipients)]
+
+    def send():
+        for i in range(per_thread):
+            store.enqueue(recipient_ids[i % recipients], sender_id, 3, content)
+
+    workers = [threading.Thread(target=send) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if store.journal is not None:
+        store.journal.flush()
+    return per_thread * threads / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--size", type=int, default=256, help="Message content size in bytes")
+    parser.add_argument("--synchronous", default="NORMAL", help="SQLite synchronous setting (NORMAL or FULL)")
+    args = parser.parse_args()
+
+    content = b"m" * args.size
+    configurations = (
+        ("durability off", None),
+        ("group commit", dict(batch_size=SqliteStore.DEFAULT_BATCH_SIZE, flush_interval=SqliteStore.DEFAULT_FLUSH_INTERVAL)),
+        ("commit per send", dict(batch_size=1, flush_interval=0)),
+    )
+
+    print(f"{'configuration':<18}{'sends/sec':>12}{'commits':>10}")
+    for name, options in configurations:
+        store = MessageStore(max_queue_bytes=1 << 40)
+        journal = None
+        with tempfile.TemporaryDirectory() as folder:
+            if options is not None:
+                journal = SqliteStore(os.path.join(folder, "bench.db"), synchronous=args.synchronous, **options)
+                store.journal = journal
+            # Commit per send is much slower, so it gets a tenth of the messages
+            count = args.messages // 10 if options and options["batch_size"] == 1 else args.messages
+            rate = run(store, count, args.threads, content)
+            commits = journal.stats()["commits"] if journal else 0
+            if journal:
+                journal.close()
+        print(f"{name:<18}{rate:>12.0f}{commits:>10}")
+
+
+if __name__ == "__main__":
+    main()
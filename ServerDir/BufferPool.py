@@ -0,0 +1,111 @@
+import bisect
+import threading
+
+from Logger import Log
+
+logger = Log(logger_name=__name__)
+
+
+class PooledBuffer(bytearray):
+    """A receive buffer owned by a BufferPool. Views over it are only valid until the buffer is released."""
+    __slots__ = ()
+
+
+class BufferPool:
+    """
+    Reusable receive buffers in a few size classes, shared by all the connections.
+
+    A framer borrows the smallest buffer that fits a request payload, the
+    request is parsed in place and the buffer goes back to the pool once the
+    request is handled, so steady traffic stops allocating a new payload
+    buffer per request. Buffers are never freed, but the memory they take
+    (borrowed and free together) is capped: beyond the cap, and for payloads
+    larger than the largest class, plain one-off bytearrays are handed out
+    instead, and release() ignores them.
+
+    Anything that outlives the request (a stored message content) must be
+    copied out of a pooled buffer first, see is_pooled().
+    """
+    DEFAULT_SIZE_CLASSES = (512, 8 * 1024, 64 * 1024)  # Registration and other small payloads, messages
+    DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, size_classes=DEFAULT_SIZE_CLASSES, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Args:
+            size_classes (tuple): The buffer sizes, in bytes.
+            max_bytes (int): The most memory the pooled buffers may take.
+        """
+        self._sizes = sorted(size_classes)
+        self._class_of = {size: index for index, size in enumerate(self._sizes)}
+        self._free = [[] for _ in self._sizes]
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._pooled_bytes = 0
+        self._borrowed = [0] * len(self._sizes)
+        self._peak_borrowed = [0] * len(self._sizes)
+        self._peak_pooled_bytes = 0
+        self._reused = 0
+        self._allocated = 0
+        self._too_large = 0
+        self._over_cap = 0
+
+    @staticmethod
+    def is_pooled(data):
+        """True if data is a pooled buffer or a memoryview over one."""
+        return type(data.obj if type(data) is memoryview else data) is PooledBuffer
+
+    def acquire(self, size):
+        """
+        Borrows a buffer of at least size bytes.
+
+        Returns:
+            bytearray: A PooledBuffer, give it back with release(), or a plain bytearray of exactly size bytes.
+        """
+        index = bisect.bisect_left(self._sizes, size)
+        if index == len(self._sizes):
+            with self._lock:
+                self._too_large += 1
+            return bytearray(size)
+
+        with self._lock:
+            free = self._free[index]
+            if free:
+                buffer = free.pop()
+                self._reused += 1
+            elif self._pooled_bytes + self._sizes[index] <= self._max_bytes:
+                buffer = None
+                self._pooled_bytes += self._sizes[index]
+                self._peak_pooled_bytes = max(self._peak_pooled_bytes, self._pooled_bytes)
+                self._allocated += 1
+            else:
+                self._over_cap += 1
+                return bytearray(size)
+            self._borrowed[index] += 1
+            if self._borrowed[index] > self._peak_borrowed[index]:
+                self._peak_borrowed[index] = self._borrowed[index]
+        # Allocated outside the lock; the pool already counts it
+        return buffer if buffer is not None else PooledBuffer(self._sizes[index])
+
+    def release(self, buffer):
+        """Gives a buffer back. Does nothing for buffers the pool did not hand out as pooled."""
+        if type(buffer) is not PooledBuffer:
+            return
+        index = self._class_of[len(buffer)]
+        with self._lock:
+            self._borrowed[index] -= 1
+            self._free[index].append(buffer)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pooled_bytes": self._pooled_bytes,
+                "peak_pooled_bytes": self._peak_pooled_bytes,
+                "max_bytes": self._max_bytes,
+                "classes": {str(size): {"borrowed": self._borrowed[index], "free": len(self._free[index]),
+                                        "peak_borrowed": self._peak_borrowed[index]}
+                            for index, size in enumerate(self._sizes)},
+                "reused": self._reused,
+                "allocated": self._allocated,
+                "too_large": self._too_large,
+                "over_cap": self._over_cap,
+            }
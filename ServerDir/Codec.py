@@ -0,0 +1,157 @@
+import struct
+from typing import NamedTuple, Optional
+
+from Spool import SpooledPayload
+
+# Precompiled wire formats. All fields are little-endian and packed (no alignment padding).
+HEADER = struct.Struct("<16s B H I")  # Client ID, version, code, payload size
+REGISTRATION = struct.Struct("<255s 160s")  # Name (null terminated), public key
+CLIENT_ID = struct.Struct("<16s")  # Target client ID of a public key request
+MESSAGE_HEADER = struct.Struct("<16s B I")  # Recipient client ID, message type, content size
+USER_LIST_QUERY = struct.Struct("<I I")  # Optional payload of a user list request: since version, limit (0: none)
+PULL_TIMEOUT = struct.Struct("<I")  # Optional payload of a pull request: how long to wait for messages, in ms
+RESPONSE_HEADER = struct.Struct("<B H I")  # Version, code, payload size
+USER_ENTRY = struct.Struct("<16s 255s")  # Client ID, name (null terminated) - one per user in a user list
+USER_LIST_PAGE = struct.Struct("<I I")  # Before the entries when answering a user list query: next version, version
+PUBLIC_KEY_RESPONSE = struct.Struct("<16s 160s")  # Client ID, public key
+MESSAGE_SENT = struct.Struct("<16s I")  # Recipient client ID, message ID
+MESSAGE_ENTRY_HEADER = struct.Struct("<16s I B I")  # Sender client ID, message ID, message type, content size
+
+NAME_SIZE = 255
+PUBLIC_KEY_SIZE = 160
+
+# NamedTuple.__new__ is a Python level function that costs as much as the decoding itself: the parsers below build
+# the tuples with tuple.__new__ directly
+_new = tuple.__new__
+
+
+class RequestHeader(NamedTuple):
+    client_id: bytes
+    version: int
+    code: int
+    payload_size: int
+
+
+# Parsed requests. Every request is one flat tuple: the four header fields followed by the payload fields of its
+# code, so parsing a request builds a single object.
+
+class Request(NamedTuple):
+    """A request of a code registered with a payload schema (see RequestRegistry.schema_parser)."""
+    client_id: bytes
+    version: int
+    code: int
+    payload_size: int
+    payload: object  # The decoded payload, or None for requests without a payload
+
+
+class RegistrationRequest(NamedTuple):
+    client_id: bytes
+    version: int
+    code: int
+    payload_size: int
+    name: str
+    public_key: bytes
+
+
+class UserListRequest(NamedTuple):
+    client_id: bytes
+    version: int
+    code: int
+    payload_size: int
+    since_version: Optional[int]  # None (and limit None) for the full list
+    limit: Optional[int]  # 0 for no limit
+
+
+class PublicKeyRequest(NamedTuple):
+    client_id: bytes
+    version: int
+    code: int
+    payload_size: int
+    target_id: bytes
+
+
+class SendMessageRequest(NamedTuple):
+    client_id: bytes
+    version: int
+    code: int
+    payload_size: int
+    recipient_id: bytes
+    message_type: int
+    content_size: int
+    content: memoryview  # A view into the received payload buffer, not a copy (or a Spool.SpooledContent)
+
+
+class PullMessagesRequest(NamedTuple):
+    client_id: bytes
+    version: int
+    code: int
+    payload_size: int
+    timeout_ms: Optional[int]  # None for a plain pull
+
+
+_NO_QUERY = (None, None)
+_NO_TIMEOUT = (None,)
+
+
+# One parser per request code: parse(header, buffer, offset) decodes the header[3] (payload size) payload bytes at
+# offset in buffer (a frame payload at offset 0, or a whole request at HEADER.size) straight into the request tuple.
+# header is the unpacked HEADER, a RequestHeader or a plain tuple. Payload sizes are compared with the header, which
+# the caller checked against the buffer.
+
+def parse_registration(header, buffer, offset=0):
+    """Registration request (code 600)."""
+    if header[3] != REGISTRATION.size:
+        raise ValueError(f"Data size {header[3]} does not match the expected for registration request: "
+                         f"{REGISTRATION.size}.")
+    name_raw, public_key = REGISTRATION.unpack_from(buffer, offset)
+    end = name_raw.find(b"\0")
+    name = str(memoryview(name_raw)[:end] if end >= 0 else name_raw, "ascii")
+    return _new(RegistrationRequest, header + (name, public_key))
+
+
+def parse_user_list(header, buffer, offset=0):
+    """User list request (code 601): no payload for the full list, a USER_LIST_QUERY for a page or delta."""
+    size = header[3]
+    if not size:
+        return _new(UserListRequest, header + _NO_QUERY)
+    if size != USER_LIST_QUERY.size:
+        raise ValueError(f"User list payload of {size} bytes, expected 0 or {USER_LIST_QUERY.size}.")
+    return _new(UserListRequest, header + USER_LIST_QUERY.unpack_from(buffer, offset))
+
+
+def parse_public_key_request(header, buffer, offset=0):
+    """Public key request (code 602)."""
+    if header[3] != CLIENT_ID.size:
+        raise ValueError(f"Data size {header[3]} does not match the expected for public key request: "
+                         f"{CLIENT_ID.size}.")
+    return _new(PublicKeyRequest, header + CLIENT_ID.unpack_from(buffer, offset))
+
+
+def parse_send_message(header, buffer, offset=0):
+    """Send message request (code 603). The content is a view over buffer, not a copy, or a spooled content."""
+    if type(buffer) is SpooledPayload:
+        fields = MESSAGE_HEADER.unpack(buffer.head)
+        if fields[2] != len(buffer.content):
+            raise ValueError(f"Message content size {fields[2]} does not match "
+                             f"the {len(buffer.content)} bytes received.")
+        return _new(SendMessageRequest, header + fields + (buffer.content,))
+    size = header[3]
+    if size < MESSAGE_HEADER.size:
+        raise ValueError(f"Data size {size} is insufficient for send message request: {MESSAGE_HEADER.size}.")
+    fields = MESSAGE_HEADER.unpack_from(buffer, offset)
+    if fields[2] != size - MESSAGE_HEADER.size:
+        raise ValueError(f"Message content size {fields[2]} does not match "
+                         f"the {size - MESSAGE_HEADER.size} bytes received.")
+    if type(buffer) is not memoryview:
+        buffer = memoryview(buffer)
+    return _new(SendMessageRequest, header + fields + (buffer[offset + MESSAGE_HEADER.size:offset + size],))
+
+
+def parse_pull_messages(header, buffer, offset=0):
+    """Pull messages request (code 604): no payload for a plain pull, a PULL_TIMEOUT for a long poll."""
+    size = header[3]
+    if not size:
+        return _new(PullMessagesRequest, header + _NO_TIMEOUT)
+    if size != PULL_TIMEOUT.size:
+        raise ValueError(f"Pull messages payload of {size} bytes, expected 0 or {PULL_TIMEOUT.size}.")
+    return _new(PullMessagesRequest, header + PULL_TIMEOUT.unpack_from(buffer, offset))
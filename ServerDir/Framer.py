@@ -0,0 +1,215 @@
+from typing import NamedTuple
+
+import Codec
+from Codec import RequestHeader
+from Protocol import Protocol
+import Spool
+
+_new_tuple = tuple.__new__
+_unpack_header = Codec.HEADER.unpack_from
+
+
+class Frame(NamedTuple):
+    """One complete request: its parsed header and a view over exactly payload_size bytes (or a SpooledPayload)."""
+    header: RequestHeader
+    payload: memoryview
+
+
+class RequestFramer:
+    """
+    Incremental request framer.
+
+    Bytes are collected into a fixed header buffer until the header is complete,
+    then into a payload buffer of payload_size bytes, borrowed from a BufferPool
+    if the framer has one (give it back with release() once the request is
+    handled) or allocated otherwise. The
+    same state machine serves blocking sockets (read_frame, which uses recv_into
+    so no read ever crosses a frame boundary) and event loops (feed, which accepts
+    chunks of any size and yields every frame they complete).
+
+    With a spool threshold, the content of a send message request larger than
+    the threshold goes through a fixed chunk buffer to a spool file instead
+    (see Spool), and the frame's payload is a Spool.SpooledPayload. Such
+    requests may exceed max_payload_size, up to max_spool_size.
+    """
+    DEFAULT_MAX_PAYLOAD_SIZE = 16 * 1024 * 1024
+
+    DEFAULT_MAX_SPOOL_SIZE = 0xFFFFFFFF  # Any size the header can describe
+
+    _EMPTY_PAYLOAD = memoryview(b"")
+
+    def __init__(self, max_payload_size=DEFAULT_MAX_PAYLOAD_SIZE, pool=None, spool_threshold=None,
+                 max_spool_size=DEFAULT_MAX_SPOOL_SIZE):
+        """
+        Args:
+            max_payload_size (int): Larger payload sizes are rejected before anything is allocated.
+            pool (BufferPool, optional): Where payload buffers are borrowed from.
+            spool_threshold (int, optional): Send message payloads larger than this are spooled to disk.
+            max_spool_size (int): Larger spooled payloads are rejected.
+        """
+        self._max_payload_size = max_payload_size
+        self._pool = pool
+        self._spool_threshold = spool_threshold
+        self._max_spool_size = max_spool_size
+        self._spool = None
+        self._chunk_view = None  # Allocated on the first spooled request
+        self._header_buffer = bytearray(Protocol.HEADER_SIZE)
+        self._header_view = memoryview(self._header_buffer)
+        self._reset()
+
+    @property
+    def idle(self):
+        """True when no part of a request has been received since the last complete frame."""
+        return self._header is None and self._filled == 0
+
+    @property
+    def expected_size(self):
+        """The size of the request being received, header included, or None until its header is complete."""
+        header = self._header
+        return None if header is None else Protocol.HEADER_SIZE + header.payload_size
+
+    def feed(self, data):
+        """
+        Consumes a chunk of received bytes.
+
+        Args:
+            data (bytes-like): Any number of bytes, possibly spanning several requests.
+
+        Yields:
+            Frame: Every request completed by this chunk, in order.
+        """
+        view = memoryview(data)
+        offset = 0
+        while offset < len(view):
+            target = self._target()
+            size = min(len(target), len(view) - offset)
+            target[:size] = view[offset:offset + size]
+            offset += size
+
+            frame = self._advance(size)
+            if frame is not None:
+                yield frame
+
+    def read_frame(self, client_socket):
+        """
+        Reads exactly one request from a blocking socket.
+
+        Args:
+            client_socket (socket.socket): The connection to read from.
+
+        Returns:
+            Frame: The request, or None if the client closed the connection between requests.
+        """
+        while True:
+            received = client_socket.recv_into(self._target())
+            if not received:
+                if self.idle:
+                    return None
+                raise ValueError(f"Connection closed in the middle of a request ({self._describe_progress()})")
+
+            frame = self._advance(received)
+            if frame is not None:
+                return frame
+
+    def _reset(self):
+        self._header = None
+        self._payload_view = None
+        self._spool = None
+        self._filled = 0
+
+    def _target(self):
+        if self._header is None:
+            return self._header_view[self._filled:]
+        if self._spool is not None and self._filled >= Protocol.MESSAGE_HEADER_SIZE:
+            return self._chunk_view[:self._header.payload_size - self._filled]
+        return self._payload_view[self._filled:]
+
+    def _spools(self, header):
+        return (self._spool_threshold is not None and header.code == Protocol.SEND_MESSAGE_CODE
+                and max(self._spool_threshold, Protocol.MESSAGE_HEADER_SIZE - 1) < header.payload_size
+                <= self._max_spool_size)
+
+    def _advance(self, size):
+        if self._spool is not None:
+            return self._advance_spool(size)
+        self._filled += size
+
+        if self._header is None:
+            if self._filled < Protocol.HEADER_SIZE:
+                return None
+
+            header = _new_tuple(RequestHeader, _unpack_header(self._header_buffer))
+            payload_size = header.payload_size
+            if self._spools(header):
+                self._start_spool(header)
+                return None
+            if payload_size > self._max_payload_size:
+                raise ValueError(
+                    f"Payload size {payload_size} exceeds the maximum allowed size {self._max_payload_size}.")
+
+            self._header = header
+            self._filled = 0
+            if payload_size:
+                buffer = self._pool.acquire(payload_size) if self._pool is not None else bytearray(payload_size)
+                self._payload_view = memoryview(buffer)[:payload_size]
+                return None
+            self._payload_view = RequestFramer._EMPTY_PAYLOAD
+
+        elif self._filled < len(self._payload_view):
+            return None
+
+        frame = _new_tuple(Frame, (self._header, self._payload_view))
+        self._reset()
+        return frame
+
+    def _start_spool(self, header):
+        if self._chunk_view is None:
+            self._chunk_view = memoryview(bytearray(Spool.CHUNK_SIZE))
+        self._header = header
+        self._payload_view = memoryview(bytearray(Protocol.MESSAGE_HEADER_SIZE))
+        self._spool = Spool.SpoolWriter(header.payload_size - Protocol.MESSAGE_HEADER_SIZE)
+        self._filled = 0
+
+    def _advance_spool(self, size):
+        # The message header is kept in memory, the content is written out chunk by chunk
+        if self._filled >= Protocol.MESSAGE_HEADER_SIZE:
+            self._spool.write(self._chunk_view[:size])
+        self._filled += size
+        if self._filled < self._header.payload_size:
+            return None
+
+        payload = Spool.SpooledPayload(self._payload_view.tobytes(), self._spool.finish())
+        frame = _new_tuple(Frame, (self._header, payload))
+        self._reset()
+        return frame
+
+    def release(self, frame):
+        """
+        Gives the payload buffer of a handled frame back to the pool. The frame's payload must not be used after.
+
+        Args:
+            frame (Frame): A frame returned by this framer.
+        """
+        payload = frame.payload
+        if self._pool is not None and type(payload) is memoryview and payload.nbytes:
+            buffer = payload.obj
+            payload.release()
+            self._pool.release(buffer)
+
+    def close(self):
+        """
+        Gives back the buffer of a partly received payload, or deletes its spool file, when the connection ends in
+        the middle of a request.
+        """
+        if self._spool is not None:
+            self._spool.discard()
+        elif self._pool is not None and self._header is not None and self._payload_view.nbytes:
+            buffer = self._payload_view.obj
+            self._payload_view.release()
+            self._pool.release(buffer)
+        self._reset()
+
+    def _describe_progress(self):
+        if self._header is None:
+            return f"{self._filled} of {Protocol.HEADER_SIZE} header bytes"
+        return f"{self._filled} of {self._header.payload_size} payload bytes"
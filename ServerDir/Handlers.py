@@ -0,0 +1,359 @@
+import asyncio
+import sqlite3
+import threading
+import time
+
+from BufferPool import BufferPool
+from Logger import Log
+from LogStore import LogStore
+import Metrics
+from Protocol import Protocol
+from RequestRegistry import RequestRegistry
+import RequestLog
+import Response
+from MessageStore import MessageStore
+from SharedStore import SharedDatabase, SharedMessageStore, SharedUserRegistry
+import Tracing
+from UserDirectory import UserDirectory
+from UserRegistry import UserRegistry
+
+logger = Log(logger_name=__name__)
+
+# Server state used by the handlers
+users = UserRegistry()
+messages = MessageStore()
+Metrics.add_source("users", lambda: {"registered": len(users)})
+Metrics.add_source("messages", messages.stats)
+
+LONG_POLL_MAX_SECONDS = 60  # Longer pull timeouts are cut to this
+
+_long_poll_lock = threading.Lock()
+_long_polls = {"waiting": 0, "delivered": 0, "timed_out": 0}
+Metrics.add_source("long_poll", lambda: dict(_long_polls))
+
+
+def attach_journal(store, with_messages=True):
+    """
+    Loads the registered clients and waiting messages from a durable store, then reports every change to it.
+
+    Args:
+        store (SqliteStore): The store.
+        with_messages (bool): False to leave the messages out, when they are kept in a durable store already.
+    """
+    store.load_into(users, messages if with_messages else None)
+    users.journal = store
+    if with_messages:
+        messages.journal = store
+
+
+def configure_queues(max_queue_bytes=None, overflow=None):
+    """
+    Sets the memory cap of every recipient's queue and what happens to messages beyond it. Must be called before
+    messages are stored or loaded.
+
+    Args:
+        max_queue_bytes (int, optional): Content bytes a recipient's queue may hold in memory.
+        overflow (str, optional): MessageStore.OVERFLOW_REJECT (the default) or MessageStore.OVERFLOW_SPILL.
+    """
+    global messages
+    messages = MessageStore(max_queue_bytes or MessageStore.DEFAULT_MAX_QUEUE_BYTES,
+                            overflow or MessageStore.OVERFLOW_REJECT)
+    Metrics.add_source("messages", messages.stats)
+
+
+def expire_messages(ttl):
+    """
+    Drops the waiting messages that are not pulled within ttl seconds, from a background sweeper. Must be called
+    before messages are stored or loaded.
+
+    Args:
+        ttl (float): The message time to live, in seconds.
+    """
+    messages.ttl = ttl
+    messages.start_sweeper()
+
+
+def use_log_store(directory, max_queue_bytes=None):
+    """
+    Keeps the waiting messages in an append-only log of segment files (see LogStore) instead of in memory.
+
+    Args:
+        directory (str): The segment folder.
+        max_queue_bytes (int, optional): Content bytes a recipient's queue may hold, beyond which sends are rejected.
+
+    Returns:
+        threading.Event: Set it to stop the background compaction of the log.
+    """
+    global messages
+    messages = LogStore(directory, max_queue_bytes=max_queue_bytes or MessageStore.DEFAULT_MAX_QUEUE_BYTES)
+    Metrics.add_source("messages", messages.stats)
+    return messages.start_compactor()
+
+
+def use_shared_store(filename, max_queue_bytes=None):
+    """
+    Keeps the clients and waiting messages in a database shared by several server processes (see Prefork)
+    instead of in memory.
+
+    Args:
+        filename (str): The database file.
+        max_queue_bytes (int, optional): Content bytes a recipient's queue may hold, beyond which sends are rejected.
+    """
+    global users, messages
+    database = SharedDatabase(filename)
+    users = SharedUserRegistry(database)
+    messages = SharedMessageStore(database, max_queue_bytes or MessageStore.DEFAULT_MAX_QUEUE_BYTES)
+    Metrics.add_source("messages", messages.stats)
+
+
+def _require_registered(client_id):
+    record = users.touch(client_id)
+    if record is None:
+        raise ValueError(f"Client [{client_id.hex()}] is not registered")
+    return record
+
+
+def handle_registration(request):
+    logger.info("Registration request for [%s]", request.name)
+    record = users.register(request.name, request.public_key)
+    logger.info("Registered [%s] as [%s]", record.name, record.client_id.hex())
+    return Response.registration_success(record.client_id)
+
+
+def handle_user_list(request):
+    requester = _require_registered(request.client_id)
+    directory = users.user_directory()
+    if request.since_version is None:
+        entries, size, _ = directory.entries(exclude=requester.client_id)
+        logger.info("User list request from [%s]: %d users", requester.name, size // UserDirectory.ENTRY_SIZE)
+        return Response.encoded_user_list(entries, size)
+
+    entries, size, next_version = directory.entries(request.since_version, request.limit or None, requester.client_id)
+    logger.info("User list request from [%s] since version %d: %d users", requester.name, request.since_version,
+                size // UserDirectory.ENTRY_SIZE)
+    return Response.user_list_page(entries, size, next_version, directory.version)
+
+
+def handle_public_key(request):
+    requester = _require_registered(request.client_id)
+    logger.info("Public key request from [%s] for [%s]", requester.name, request.target_id.hex())
+    target = users.get(request.target_id)
+    if target is None:
+        raise ValueError(f"Client [{request.target_id.hex()}] is not registered")
+    return Response.public_key(target.client_id, target.public_key)
+
+
+def handle_send_message(request):
+    sender = _require_registered(request.client_id)
+    recipient_id = request.recipient_id
+    if users.get(recipient_id) is None:
+        raise ValueError(f"Recipient [{recipient_id.hex()}] is not registered")
+
+    content = request.content
+    if BufferPool.is_pooled(content):
+        content = bytes(content)  # The receive buffer is reused once this request is handled
+    message = messages.enqueue(recipient_id, sender.client_id, request.message_type, content)
+    logger.info("Message [%d] of type [%d] (%d bytes) from [%s] to [%s]", message.message_id, message.message_type,
+                request.content_size, sender.name, recipient_id.hex())
+    return Response.message_sent(recipient_id, message.message_id)
+
+
+def handle_pull_messages(request):
+    requester = _require_registered(request.client_id)
+    waiting = messages.pull(requester.client_id)
+    if not waiting and request.timeout_ms:
+        timeout = min(request.timeout_ms / 1000, LONG_POLL_MAX_SECONDS)
+        logger.info("Pull waiting messages request from [%s]: waiting up to %.1fs", requester.name, timeout)
+        return LongPoll(requester, timeout)
+    logger.info("Pull waiting messages request from [%s]: %d messages", requester.name, len(waiting))
+    return Response.waiting_messages(waiting)
+
+
+class LongPoll:
+    """
+    A pull that found no messages and waits for them (a 604 request with a
+    timeout). Handlers return it instead of a response, and the server waits
+    on it without polling: wait() blocks the calling thread, wait_async()
+    suspends the connection's coroutine. Both are woken by the send path
+    (MessageStore.add_waiter) and return the 2104 response, with no messages
+    if none arrived in time.
+
+    In pool mode a waiting pull holds its worker thread.
+    """
+    __slots__ = ("requester", "timeout")
+
+    def __init__(self, requester, timeout):
+        """
+        Args:
+            requester (UserRecord): The pulling client.
+            timeout (float): The longest wait, in seconds.
+        """
+        self.requester = requester
+        self.timeout = timeout
+
+    def wait(self):
+        """Waits on the calling thread and returns the response."""
+        client_id = self.requester.client_id
+        woken = threading.Event()
+        wake = woken.set
+        recheck = messages.RECHECK_INTERVAL
+        deadline = time.monotonic() + self.timeout
+        remaining = self.timeout
+        _count_long_poll("waiting", 1)
+        try:
+            while remaining > 0 and messages.add_waiter(client_id, wake):
+                try:
+                    woken.wait(remaining if recheck is None else min(remaining, recheck))
+                finally:
+                    messages.remove_waiter(client_id, wake)
+                if woken.is_set():
+                    break
+                remaining = deadline - time.monotonic()
+        finally:
+            _count_long_poll("waiting", -1)
+        return self._respond()
+
+    async def wait_async(self):
+        """Waits on the running event loop and returns the response."""
+        client_id = self.requester.client_id
+        loop = asyncio.get_running_loop()
+        woken = loop.create_future()
+
+        def wake():
+            # Called on the sending thread, which is the loop's own thread unless a store is shared with threads
+            loop.call_soon_threadsafe(_set_woken, woken)
+
+        recheck = messages.RECHECK_INTERVAL
+        deadline = loop.time() + self.timeout
+        remaining = self.timeout
+        _count_long_poll("waiting", 1)
+        try:
+            while remaining > 0 and messages.add_waiter(client_id, wake):
+                try:
+                    await asyncio.wait((woken,), timeout=remaining if recheck is None else min(remaining, recheck))
+                finally:
+                    messages.remove_waiter(client_id, wake)
+                if woken.done():
+                    break
+                remaining = deadline - loop.time()
+        finally:
+            _count_long_poll("waiting", -1)
+        return self._respond()
+
+    def _respond(self):
+        waiting = messages.pull(self.requester.client_id)
+        _count_long_poll("delivered" if waiting else "timed_out", 1)
+        logger.info("Pull waiting messages request from [%s]: %d messages", self.requester.name, len(waiting))
+        return Response.waiting_messages(waiting)
+
+
+def _set_woken(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _count_long_poll(key, delta):
+    with _long_poll_lock:
+        _long_polls[key] += delta
+
+
+# A request that fails with one of these is answered with the error response: malformed or refused requests, a busy
+# or failing shared database, and the disk errors of the spill, spool and log stores
+_REQUEST_ERRORS = (ValueError, sqlite3.Error, OSError)
+
+
+def handle_frame(frame, trace=None):
+    """
+    Parses and handles one framed request, for both server backends: the trace marks, the error response for a
+    malformed or failed request, and the request's metrics and request log record.
+
+    Args:
+        frame (Framer.Frame): The received request.
+        trace (list, optional): The request's trace, see Tracing.
+
+    Returns:
+        The response buffers, or a LongPoll: the server waits on it with finish_long_poll or finish_long_poll_async,
+        which record the request once it has its response.
+    """
+    start = time.perf_counter_ns()
+    request = None
+    response = None
+    failed = False
+    try:
+        request = Protocol.parse_frame(frame.header, frame.payload)
+        if trace is not None:
+            Tracing.mark(trace, Tracing.PARSED)
+
+        logger.info("Request with code [%d] was successfully decrypted.", request.code)
+        logger.debug("Request: %s", request)
+        if trace is not None:
+            Tracing.mark(trace, Tracing.LOGGED)
+
+        response = RequestRegistry.dispatch(request)
+        if trace is not None and type(response) is not LongPoll:
+            Tracing.mark(trace, Tracing.HANDLED)
+        return response
+
+    except _REQUEST_ERRORS as e:
+        logger.error(e)
+        Metrics.record_error(e)
+        failed = True
+        response = Response.error()
+        return response
+
+    finally:
+        if type(response) is not LongPoll:
+            _record_request(frame, request is not None, response, failed, time.perf_counter_ns() - start)
+
+
+def finish_long_poll(frame, poll, trace=None):
+    """Waits on the calling thread for the messages of a LongPoll returned by handle_frame, returns its response."""
+    start = time.perf_counter_ns()
+    try:
+        response = poll.wait()
+    except _REQUEST_ERRORS as e:
+        return _long_poll_failed(frame, e, trace, start)
+    return _long_poll_answered(frame, response, trace, start)
+
+
+async def finish_long_poll_async(frame, poll, trace=None):
+    """Like finish_long_poll, waiting on the running event loop."""
+    start = time.perf_counter_ns()
+    try:
+        response = await poll.wait_async()
+    except _REQUEST_ERRORS as e:
+        return _long_poll_failed(frame, e, trace, start)
+    return _long_poll_answered(frame, response, trace, start)
+
+
+def _long_poll_answered(frame, response, trace, start, failed=False):
+    if trace is not None:
+        Tracing.mark(trace, Tracing.HANDLED)
+    _record_request(frame, True, response, failed, time.perf_counter_ns() - start)
+    return response
+
+
+def _long_poll_failed(frame, error, trace, start):
+    logger.error(error)
+    Metrics.record_error(error)
+    return _long_poll_answered(frame, Response.error(), trace, start, failed=True)
+
+
+def _record_request(frame, parsed, response, failed, latency_ns):
+    Metrics.record_request(frame.header.code, latency_ns, Protocol.HEADER_SIZE + len(frame.payload),
+                           Response.size(response) if response else 0, failed)
+    if RequestLog.writer is not None:
+        RequestLog.writer.record(frame.header.code, frame.header.client_id, len(frame.payload), latency_ns,
+                                 response, None if parsed else RequestLog.OUTCOME_INVALID)
+
+
+def register_default_handlers():
+    """Attaches the handlers above to their request codes. Any of them can be replaced with RequestRegistry.set_handler."""
+    RequestRegistry.set_handler(Protocol.REGISTRATION_CODE, handle_registration)
+    RequestRegistry.set_handler(Protocol.USER_LIST_CODE, handle_user_list)
+    RequestRegistry.set_handler(Protocol.PUBLIC_KEY_CODE, handle_public_key)
+    RequestRegistry.set_handler(Protocol.SEND_MESSAGE_CODE, handle_send_message)
+    RequestRegistry.set_handler(Protocol.PULL_MESSAGES_CODE, handle_pull_messages)
+
+
+register_default_handlers()
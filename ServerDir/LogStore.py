@@ -0,0 +1,510 @@
+"""
+Log-structured message storage.
+
+LogStore keeps the waiting messages in append-only segment files instead of
+memory. A send appends one record to the active segment, through a shared
+memory map of the whole (preallocated) segment, so a burst of sends is a
+sequence of memory copies into consecutive pages and no system call. An
+in-memory index keeps, per recipient, where its records are; a pull reads
+them back as memoryviews of the segment maps, without a copy, and appends a
+consumed record so the pull survives a restart.
+
+A record is a RECORD header followed by the message content:
+
+    crc32 (I), kind (B), sequence (Q), recipient ID (16s), sender ID (16s), message type (B), content size (I)
+
+The CRC is crc32(rest of the header, crc32(content)): the content's part
+can be computed while it is copied in. Sequence numbers grow by one per
+message (message IDs are their low 32 bits); a consumed record holds the
+recipient and the highest sequence number it pulled.
+
+A spooled content (see Spool) may be gigabytes, so it is not copied under
+the lock: its space is reserved with a pending record, whose CRC only covers
+its header, the content is copied in without the lock, and the record is
+then numbered and sealed as a message. Recovery skips a pending record left
+behind by a crash.
+
+Segments fill up and are sealed, and a background thread (start_compactor)
+reclaims them from the oldest: a segment without live messages is deleted,
+and the oldest segment is compacted, its live records copied to the active
+segment, once they take at most COMPACT_LIVE_RATIO of it or the log takes
+more than twice the space of its live messages. Only the oldest segment is
+ever removed, so the consumed records of the remaining segments always cover
+every pulled message they still hold.
+
+On startup the index is rebuilt by scanning every segment in order. The
+scan of a segment ends at its first empty record, or at a record whose
+header cannot be read (a write cut short by a crash). A record with a sane
+header but a wrong CRC is skipped by its size, so the records acknowledged
+after it survive. A segment file too short to hold a record was never
+written to (a crash while it was created) and is removed.
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+
+from Logger import Log
+from MessageStore import Message, MessageStore
+from Spool import SpooledContent
+
+logger = Log(logger_name=__name__)
+
+RECORD = struct.Struct("<I B Q 16s 16s B I")  # CRC, kind, sequence, recipient ID, sender ID, message type, size
+KIND_MESSAGE = 1
+KIND_CONSUMED = 2
+KIND_PENDING = 3  # Space of a message whose content is still being copied in
+
+_NO_CLIENT = bytes(16)
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class _Segment:
+    __slots__ = ("number", "path", "map", "view", "size", "end", "live", "live_bytes", "writers")
+
+    def __init__(self, number, path, size):
+        self.number = number
+        self.path = path
+        self.size = size
+        self.end = 0
+        self.live = {}  # Offset -> _Record of the messages not pulled yet
+        self.live_bytes = 0
+        self.writers = 0  # Contents being copied in without the lock; the segment is not removed meanwhile
+        if not os.path.exists(path):
+            with open(path, "wb") as file:
+                file.truncate(size)
+        with open(path, "r+b") as file:
+            self.map = mmap.mmap(file.fileno(), size)
+        self.view = memoryview(self.map)  # Slices of it are not copies. The map is never closed, see LogStore.pull
+
+
+class _Record:
+    __slots__ = ("segment", "offset", "sequence", "size")
+
+    def __init__(self, segment, offset, sequence, size):
+        self.segment = segment
+        self.offset = offset
+        self.sequence = sequence
+        self.size = size  # Header included
+
+
+class _LogQueue:
+    __slots__ = ("records", "bytes")
+
+    def __init__(self):
+        self.records = deque()
+        self.bytes = 0
+
+
+class LogStore:
+    """
+    MessageStore interface over an append-only log of memory-mapped segment
+    files in a folder (see the module documentation). The log is durable
+    across restarts of the process on its own, so journal is never used.
+
+    Appends, pulls and compaction slices hold one lock: a log has a single
+    write position anyway. Only spooled contents are copied in without it.
+    Queues are capped like in MessageStore; messages beyond the cap are
+    rejected, except spooled ones (see Spool), which count towards it once
+    stored. There is no TTL.
+    """
+    DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+    COMPACT_LIVE_RATIO = 0.5
+    COMPACT_SLICE = 256  # The most records copied per lock hold
+    COMPACT_INTERVAL = 1.0  # Seconds between compaction passes, which also flush the active segment
+
+    RECHECK_INTERVAL = None  # Every enqueue wakes the waiters
+
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 max_queue_bytes=MessageStore.DEFAULT_MAX_QUEUE_BYTES):
+        """
+        Opens the log in a folder, created if missing, and rebuilds its index.
+
+        Args:
+            directory (str): The segment folder.
+            segment_bytes (int): The size of a segment file. Larger messages get a segment of their own.
+            max_queue_bytes (int): Content bytes a recipient's queue may hold.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._segment_bytes = segment_bytes
+        self._max_queue_bytes = max_queue_bytes
+        self._lock = threading.Lock()
+        self._segments = []  # Oldest first, the last one is the active segment
+        self._queues = {}  # Recipient ID -> _LogQueue
+        self._waiters = {}
+        self._sequence = 1
+        self._rejected = 0
+        self._appended = 0
+        self._compacted_segments = 0
+        self._copied_records = 0
+        self._deleted_segments = 0
+        self._recovered_messages = 0
+        self._damaged_segments = 0
+        self._damaged_records = 0
+        self.journal = None  # Part of the MessageStore interface; the log already is durable
+        self._recover()
+
+    # Recovery
+
+    def _recover(self):
+        start = time.perf_counter()
+        numbers = sorted(int(name[:-4]) for name in os.listdir(self._directory)
+                         if name.endswith(".seg") and name[:-4].isdigit())
+        consumed = {}  # Recipient ID -> highest consumed sequence
+        records = {}  # Recipient ID -> {sequence: _Record}
+        for number in numbers:
+            path = self._segment_path(number)
+            size = os.path.getsize(path)
+            if size < RECORD.size:
+                logger.warning(f"Removing the segment '{path}' of {size} bytes, it was never written to")
+                os.remove(path)
+                continue
+            segment = _Segment(number, path, size)
+            self._scan(segment, records, consumed)
+            self._segments.append(segment)
+
+        for recipient_id, recipient_records in records.items():
+            last_consumed = consumed.get(recipient_id, 0)
+            queue = None
+            for sequence in sorted(recipient_records):  # Compacted records moved ahead of newer ones
+                record = recipient_records[sequence]
+                segment = record.segment
+                if record.sequence <= last_consumed:
+                    continue
+                if queue is None:
+                    queue = self._queues[recipient_id] = _LogQueue()
+                queue.records.append(record)
+                queue.bytes += record.size - RECORD.size
+                segment.live[record.offset] = record
+                segment.live_bytes += record.size
+                self._recovered_messages += 1
+
+        if not self._segments:
+            self._new_segment(self._segment_bytes)
+        logger.info(f"Recovered {self._recovered_messages} waiting messages from {len(self._segments)} segments "
+                    f"in '{self._directory}' in {time.perf_counter() - start:.2f}s")
+
+    def _scan(self, segment, records, consumed):
+        view = segment.view
+        offset = 0
+        damaged = False
+        while offset + RECORD.size <= segment.size:
+            crc, kind, sequence, recipient_id, sender_id, message_type, size = RECORD.unpack_from(view, offset)
+            if kind == 0 and crc == 0:
+                break  # The free end of the segment
+            end = offset + RECORD.size + size
+            content_crc = zlib.crc32(view[offset + RECORD.size:end]) if kind != KIND_PENDING else 0
+            if kind not in (KIND_MESSAGE, KIND_CONSUMED, KIND_PENDING) or end > segment.size:
+                logger.warning(f"Damaged record at offset [{offset}] of '{segment.path}', ignoring the rest of it")
+                self._damaged_segments += 1
+                self._damaged_records += 1
+                # Its size cannot be trusted: nothing after it may come back to life once new records are written
+                view[offset:] = bytes(segment.size - offset)
+                break
+            if zlib.crc32(view[offset + 4:offset + RECORD.size], content_crc) != crc:
+                # A sane header tells where the next record starts: the records appended after this one (while a
+                # spooled content was copied in, or before a crash tore this write) are still good
+                logger.warning(f"Damaged record at offset [{offset}] of '{segment.path}', skipping it")
+                if not damaged:
+                    self._damaged_segments += 1
+                damaged = True
+                self._damaged_records += 1
+                offset = end
+                continue
+            if kind == KIND_MESSAGE:
+                # A record copied by an unfinished compaction is found twice, the copy (found last) is kept
+                records.setdefault(recipient_id, {})[sequence] = _Record(segment, offset, sequence, end - offset)
+            elif kind == KIND_PENDING:
+                offset = end  # Never sealed: the sender was not told the message was stored
+                continue
+            elif sequence > consumed.get(recipient_id, 0):
+                consumed[recipient_id] = sequence
+            self._sequence = max(self._sequence, sequence + 1)
+            offset = end
+        segment.end = offset
+
+    def _segment_path(self, number):
+        return os.path.join(self._directory, f"{number:08d}.seg")
+
+    def _new_segment(self, size):
+        number = self._segments[-1].number + 1 if self._segments else 1
+        segment = _Segment(number, self._segment_path(number), size)
+        self._segments.append(segment)
+        return segment
+
+    # Appends, called with the lock held
+
+    def _reserve(self, record_size):
+        active = self._segments[-1]
+        if active.end + record_size > active.size:
+            active.map.flush()  # Sealed: its pages go to disk now rather than at the next compaction pass
+            active = self._new_segment(max(self._segment_bytes, record_size))
+        offset = active.end
+        active.end += record_size
+        return active, offset
+
+    def _append(self, kind, sequence, recipient_id, sender_id, message_type, content):
+        size = len(content)
+        segment, offset = self._reserve(RECORD.size + size)
+        segment.view[offset + RECORD.size:offset + RECORD.size + size] = content
+        self._seal(segment, offset, kind, sequence, recipient_id, sender_id, message_type, size, zlib.crc32(content))
+        self._appended += 1
+        return segment, offset
+
+    def _seal(self, segment, offset, kind, sequence, recipient_id, sender_id, message_type, size, content_crc):
+        # The header is written once, with its CRC: resealing a pending record never leaves it invalid in between
+        crc = zlib.crc32(RECORD.pack(0, kind, sequence, recipient_id, sender_id, message_type, size)[4:], content_crc)
+        RECORD.pack_into(segment.view, offset, crc, kind, sequence, recipient_id, sender_id, message_type, size)
+
+    def _publish(self, segment, offset, recipient_id, sender_id, message_type, size, content_crc):
+        # Numbers and seals a message record whose content is in place, and adds it to its recipient's queue
+        sequence = self._sequence
+        self._sequence += 1
+        self._seal(segment, offset, KIND_MESSAGE, sequence, recipient_id, sender_id, message_type, size, content_crc)
+        self._appended += 1
+        record = _Record(segment, offset, sequence, RECORD.size + size)
+        queue = self._queues.get(recipient_id)
+        if queue is None:
+            queue = self._queues[recipient_id] = _LogQueue()
+        queue.records.append(record)
+        queue.bytes += size
+        segment.live[offset] = record
+        segment.live_bytes += record.size
+        return sequence
+
+    @staticmethod
+    def _copy_spooled(content, view, start):
+        # Called without the lock. Returns the CRC of the content.
+        crc = 0
+        end = start + len(content)
+        with content.open() as file:
+            while start < end:
+                chunk = view[start:min(start + _COPY_CHUNK_SIZE, end)]
+                read = file.readinto(chunk)
+                if not read:
+                    raise ValueError(f"Spooled content '{content.path}' is shorter than {len(content)} bytes")
+                crc = zlib.crc32(chunk[:read], crc)
+                start += read
+        return crc
+
+    # MessageStore interface
+
+    def enqueue(self, recipient_id, sender_id, message_type, content):
+        """
+        Appends a message for its recipient to the log.
+
+        Returns:
+            Message: The stored message, with its message ID. Its content is the one given.
+
+        Raises:
+            ValueError: If the recipient's queue is full.
+        """
+        if type(content) is SpooledContent:
+            return self._enqueue_spooled(recipient_id, sender_id, message_type, content)
+
+        size = len(content)
+        with self._lock:
+            queue = self._queues.get(recipient_id)
+            queued = queue.bytes if queue is not None else 0
+            if queued + size > self._max_queue_bytes:
+                self._rejected += 1
+                raise ValueError(f"The message queue of [{recipient_id.hex()}] is full "
+                                 f"({queued} of {self._max_queue_bytes} bytes)")
+            segment, offset = self._reserve(RECORD.size + size)
+            segment.view[offset + RECORD.size:offset + RECORD.size + size] = content
+            sequence = self._publish(segment, offset, recipient_id, sender_id, message_type, size,
+                                     zlib.crc32(content))
+            waiters = self._waiters.pop(recipient_id, None) if self._waiters else None
+        for wake in waiters or ():
+            wake()
+        return Message(sequence & 0xFFFFFFFF, sender_id, recipient_id, message_type, content)
+
+    def _enqueue_spooled(self, recipient_id, sender_id, message_type, content):
+        # A spooled content is larger than the cap may be, and not held in memory: it is always accepted. It is
+        # copied in without the lock, in the space of a pending record.
+        size = len(content)
+        with self._lock:
+            segment, offset = self._reserve(RECORD.size + size)
+            self._seal(segment, offset, KIND_PENDING, 0, recipient_id, sender_id, message_type, size, 0)
+            segment.writers += 1
+        try:
+            content_crc = LogStore._copy_spooled(content, segment.view, offset + RECORD.size)
+        except BaseException:
+            with self._lock:
+                segment.writers -= 1
+            raise
+        with self._lock:
+            segment.writers -= 1
+            sequence = self._publish(segment, offset, recipient_id, sender_id, message_type, size, content_crc)
+            waiters = self._waiters.pop(recipient_id, None) if self._waiters else None
+        for wake in waiters or ():
+            wake()
+        return Message(sequence & 0xFFFFFFFF, sender_id, recipient_id, message_type, content)
+
+    def add_waiter(self, recipient_id, wake):
+        """See MessageStore.add_waiter."""
+        with self._lock:
+            if recipient_id in self._queues:
+                return False
+            self._waiters.setdefault(recipient_id, []).append(wake)
+        return True
+
+    def remove_waiter(self, recipient_id, wake):
+        with self._lock:
+            waiters = self._waiters.get(recipient_id)
+            if waiters and wake in waiters:
+                waiters.remove(wake)
+                if not waiters:
+                    del self._waiters[recipient_id]
+
+    def restore(self, message):
+        """Appends a message loaded from another store, with a new message ID."""
+        self.enqueue(message.recipient_id, message.sender_id, message.message_type, message.content)
+
+    def pull(self, recipient_id):
+        """
+        Removes and returns all the waiting messages of a recipient, in the order they were sent.
+
+        Returns:
+            list: The messages, empty if there are none. Their contents are views of the segment maps, valid for
+            as long as they are referenced (a removed segment stays mapped until then).
+        """
+        with self._lock:
+            queue = self._queues.pop(recipient_id, None)
+            if queue is None:
+                return []
+            records = queue.records
+            self._append(KIND_CONSUMED, records[-1].sequence, recipient_id, _NO_CLIENT, 0, b"")
+            for record in records:
+                segment = record.segment
+                del segment.live[record.offset]
+                segment.live_bytes -= record.size
+
+        # The records are not live anymore, compaction leaves them where they are
+        messages = []
+        for record in records:
+            view = record.segment.view
+            _, _, sequence, _, sender_id, message_type, size = RECORD.unpack_from(view, record.offset)
+            start = record.offset + RECORD.size
+            messages.append(Message(sequence & 0xFFFFFFFF, sender_id, recipient_id, message_type,
+                                    view[start:start + size]))
+        return messages
+
+    def stats(self):
+        with self._lock:
+            log_bytes = sum(segment.end for segment in self._segments)
+            live_bytes = sum(segment.live_bytes for segment in self._segments)
+            return {
+                "queues": len(self._queues),
+                "messages": sum(len(queue.records) for queue in self._queues.values()),
+                "bytes": sum(queue.bytes for queue in self._queues.values()),
+                "spilled_messages": 0,
+                "spilled_bytes": 0,
+                "rejected": self._rejected,
+                "segments": len(self._segments),
+                "log_bytes": log_bytes,
+                "live_bytes": live_bytes,
+                "appended_records": self._appended,
+                "compacted_segments": self._compacted_segments,
+                "copied_records": self._copied_records,
+                "deleted_segments": self._deleted_segments,
+                "recovered_messages": self._recovered_messages,
+                "damaged_segments": self._damaged_segments,
+                "damaged_records": self._damaged_records,
+            }
+
+    def queue_stats(self, top=10):
+        with self._lock:
+            queues = [{"recipient": recipient_id.hex(), "messages": len(queue.records), "bytes": queue.bytes,
+                       "spilled_messages": 0}
+                      for recipient_id, queue in self._queues.items()]
+        queues.sort(key=lambda q: q["bytes"], reverse=True)
+        return queues[:top]
+
+    # Compaction
+
+    def compact(self, slice_size=COMPACT_SLICE):
+        """
+        Reclaims the oldest segment if it can be: deletes it once it has no live message, or moves slice_size of
+        its live records to the active segment if it is due for compaction.
+
+        Returns:
+            bool: Whether there is more to do right away.
+        """
+        with self._lock:
+            if len(self._segments) < 2:
+                return False
+            head = self._segments[0]
+            if head.writers:
+                return False
+            if head.live:
+                log_bytes = sum(segment.end for segment in self._segments)
+                live_bytes = sum(segment.live_bytes for segment in self._segments)
+                if head.live_bytes > LogStore.COMPACT_LIVE_RATIO * head.end and log_bytes <= 2 * live_bytes:
+                    return False
+                for offset in sorted(head.live)[:slice_size]:
+                    self._move(head, offset)
+                if head.live:
+                    return True
+                self._compacted_segments += 1
+            del self._segments[0]
+            self._deleted_segments += 1
+
+        # Views handed out by pull keep the map alive; the file can go now
+        try:
+            os.remove(head.path)
+        except OSError as e:
+            logger.error(f"Failed to remove the segment '{head.path}': {e}")
+        logger.debug(f"Removed the segment '{head.path}'")
+        return len(self._segments) > 1
+
+    def _move(self, head, offset):
+        # Called with the lock held. The record is copied as it is, CRC and sequence number included.
+        record = head.live.pop(offset)
+        head.live_bytes -= record.size
+        segment, new_offset = self._reserve(record.size)
+        segment.view[new_offset:new_offset + record.size] = head.view[offset:offset + record.size]
+        record.segment = segment
+        record.offset = new_offset
+        segment.live[new_offset] = record
+        segment.live_bytes += record.size
+        self._copied_records += 1
+
+    def flush(self):
+        """Writes the pages of the active segment to disk."""
+        with self._lock:
+            segment = self._segments[-1]
+        segment.map.flush()
+
+    def start_compactor(self, interval=COMPACT_INTERVAL):
+        """
+        Compacts the log on a background thread: every interval seconds, or right away while there is more to do.
+        Every pass also flushes the active segment.
+
+        Returns:
+            threading.Event: Set it to stop the compactor.
+        """
+        stop = threading.Event()
+
+        def run():
+            while True:
+                try:
+                    more = self.compact()
+                    if not more:
+                        self.flush()
+                except Exception as e:
+                    logger.error(f"Failed to compact the message log: {e}")
+                    more = False
+                if stop.wait(0 if more else interval):
+                    return
+
+        threading.Thread(target=run, name="log-compactor", daemon=True).start()
+        return stop
+
+    def close(self):
+        """Flushes the log. The segment maps stay open for the views still in use."""
+        self.flush()
@@ -1,8 +1,10 @@
+import atexit
 import os
+import queue
 import sys
+import time
 from datetime import datetime
 from enum import Enum
-import inspect
 import threading
 
 
@@ -36,108 +38,506 @@ class LogLevel(Enum):
             return "UNKNOWN"
 
 
+# Level values as plain ints, for the threshold check at the start of every log call
+_DEBUG = LogLevel.DEBUG.value
+_INFO = LogLevel.INFO.value
+_WARNING = LogLevel.WARNING.value
+_ERROR = LogLevel.ERROR.value
+
+# One log file shared by every logger writing to its path (see Log.get_sink).
+class _FileSink:
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, path, max_bytes=0, backup_count=5, rotate_interval=0, flush_interval=1.0):
+        """
+        Opens the file in append mode with a large write buffer.
+
+        Args:
+            path (str): The log file path.
+            max_bytes (int): Rotate once the file would grow past this size, 0 to never rotate by size.
+            backup_count (int): Rotated files kept as path.1 (newest) to path.N.
+            rotate_interval (float): Rotate after this many seconds, 0 to never rotate by time.
+            flush_interval (float): The longest written lines stay in the buffer, in seconds. 0 flushes every write.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_interval = rotate_interval
+        self.flush_interval = flush_interval
+        self.rotations = 0
+        self._lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, "ab", buffering=_FileSink.BUFFER_SIZE)  # Binary, so _size counts bytes
+        self._size = self._file.tell()
+        self._opened = time.time()
+        self._dirty = False
+
+    def write_lines(self, lines):
+        """
+        Writes complete lines with one call under the sink lock, so lines of different loggers never interleave.
+
+        Args:
+            lines (list): The lines, without line endings.
+        """
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        with self._lock:
+            if self._file is None:
+                return
+            if self._should_rotate(len(data)):
+                self._rotate()
+            self._file.write(data)
+            self._size += len(data)
+            if self.flush_interval <= 0:
+                self._file.flush()
+            else:
+                self._dirty = True
+
+    def _should_rotate(self, incoming):
+        # Called with the lock held
+        if self.max_bytes and self._size and self._size + incoming > self.max_bytes:
+            return True
+        return bool(self.rotate_interval) and time.time() - self._opened >= self.rotate_interval
+
+    def _rotate(self):
+        # Called with the lock held: path.N-1 -> path.N, ..., path -> path.1
+        self._file.close()
+        try:
+            if self.backup_count > 0:
+                for index in range(self.backup_count - 1, 0, -1):
+                    source = f"{self.path}.{index}"
+                    if os.path.exists(source):
+                        os.replace(source, f"{self.path}.{index + 1}")
+                os.replace(self.path, f"{self.path}.1")
+            else:
+                os.remove(self.path)
+        except OSError as e:
+            print(f"Failed to rotate log file: {self.path}: {str(e)}", file=sys.stderr)
+        self._open()
+        self.rotations += 1
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None and self._dirty:
+                self._file.flush()
+                self._dirty = False
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# Flushes the buffered file sinks in the background, each one every flush_interval seconds.
+class _SinkFlusher:
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="log-flusher", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        last_flush = {}
+        while True:
+            with Log._sinks_lock:
+                sinks = list(Log._sinks.values())
+            intervals = [sink.flush_interval for sink in sinks if sink.flush_interval > 0]
+            if self._stop.wait(min(intervals, default=1.0)):
+                return
+            now = time.monotonic()
+            for sink in sinks:
+                if sink.flush_interval > 0 and now - last_flush.get(sink, 0) >= sink.flush_interval:
+                    sink.flush()
+                    last_flush[sink] = now
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+# Background writer used when asynchronous logging is enabled (see Log.enable_async).
+class _AsyncWriter:
+    OVERFLOW_DROP = "drop"
+    OVERFLOW_BLOCK = "block"
+    MAX_BATCH = 512
+
+    _STOP = object()
+
+    def __init__(self, queue_size, overflow):
+        """
+        Starts the writer thread.
+
+        Args:
+            queue_size (int): The most records waiting to be written.
+            overflow (str): OVERFLOW_DROP to drop records when the queue is full, OVERFLOW_BLOCK to wait for room.
+        """
+        if overflow not in (_AsyncWriter.OVERFLOW_DROP, _AsyncWriter.OVERFLOW_BLOCK):
+            raise ValueError(f"Unknown overflow policy [{overflow}]")
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._block = overflow == _AsyncWriter.OVERFLOW_BLOCK
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, record):
+        """
+        Queues a record: (log, level, timestamp, filename, line, message, args).
+        """
+        if self._block:
+            self._queue.put(record)
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Blocks until every record queued so far is written."""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def stop(self):
+        """Writes the queued records and stops the writer thread."""
+        self._queue.put(_AsyncWriter._STOP)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < _AsyncWriter.MAX_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if self._write(batch):
+                return
+
+    def _write(self, batch):
+        console_lines = []
+        file_lines = {}
+        events = []
+        stop = False
+
+        for record in batch:
+            if record is _AsyncWriter._STOP:
+                stop = True
+                continue
+            if isinstance(record, threading.Event):
+                events.append(record)
+                continue
+
+            log, level, created, filename, line, message, args = record
+            log_entry = Log._format_log_entry(Log._get_timestamp(created), LogLevel.to_string(level), filename, line,
+                                              Log._render(message, args), log._logger_name)
+            if log._to_console and level.value >= Log._console_level:
+                console_lines.append(Log._colorize(log_entry, level))
+            sink = log._file_sink()
+            if sink is not None and level.value >= Log._file_level:
+                file_lines.setdefault(sink, []).append(log_entry)
+
+        try:
+            if console_lines:
+                Log._write_console(console_lines, flush=True)
+            for sink, lines in file_lines.items():
+                sink.write_lines(lines)
+        except Exception as e:
+            print(f"Failed to write {len(batch)} log records: {str(e)}", file=sys.stderr)
+        finally:
+            for event in events:
+                event.set()
+
+        return stop
+
+
 # Log class to manage logging messages to both console and file.
 class Log:
-    _log_file = None
-    _to_file = False
+    _to_file = None
     _to_console = True
     _logger_name = "default"
-
-    def __init__(self, logger_name="default", filename="", log_to_file=False, log_to_console=True):
+    _async_writer = None
+
+    # Process-wide sinks: one _FileSink per log file path, and one lock for the console
+    _sinks = {}
+    _sinks_lock = threading.Lock()
+    _default_sink = None  # The log file of every logger that did not choose one (see Log.configure_file)
+    _flusher = None
+    _console_lock = threading.Lock()
+    _console_stream = None  # None writes to whatever sys.stdout is at the time
+
+    # Lowest level value written to each sink; a record below both is dropped before any work is done
+    _console_level = _DEBUG
+    _file_level = _INFO
+
+    _basenames = {}  # Code object -> basename of its file, for the caller location
+    _timestamp_cache = (None, "")  # (second, formatted timestamp)
+    _centered_levels = {}  # Level name -> the name centered in the level column
+
+    _COLORS = {
+        LogLevel.DEBUG: "\033[37m",  # White for DEBUG
+        LogLevel.INFO: "\033[34m",  # Blue for INFO
+        LogLevel.WARNING: "\033[33m",  # Yellow for WARNING
+        LogLevel.ERROR: "\033[31m",  # Red for ERROR
+    }
+
+    def __init__(self, logger_name="default", filename="", log_to_file=None, log_to_console=True):
         """
         Initializes the Log object with optional file and console logging.
 
         Args:
             logger_name (str): The name of the logger.
             filename (str): The log file path.
-            log_to_file (bool): Whether to log to a file.
+            log_to_file (bool, optional): Whether to log to a file. True logs to filename, False never logs to a
+                file, and None (the default) logs to the process log file if one is set with Log.configure_file.
             log_to_console (bool): Whether to log to console.
         """
         self._to_file = log_to_file
         self._to_console = log_to_console
         self._logger_name = logger_name
+        self._sink = None
         self._initialize_log_file(filename)
-        self._lock = threading.Lock()
 
     def _initialize_log_file(self, filename):
         """
-        Initializes the log file for logging if log_to_file is enabled.
+        Attaches the shared sink of the log file if log_to_file is enabled.
 
         Args:
             filename (str): The log file path.
         """
         if self._to_file and filename:
-            try:
-                self._log_file = open(filename, "a")  # Open file in append mode
-            except Exception as e:
-                print(f"Failed to open log file: {filename}: {str(e)}", file=sys.stderr)
-                Log._to_file = False
+            self._sink = Log.get_sink(filename)
+            if self._sink is None:
+                self._to_file = False
+
+    @staticmethod
+    def get_sink(filename, max_bytes=0, backup_count=5, rotate_interval=0, flush_interval=1.0):
+        """
+        Returns the sink of a log file, opening it on first use. Every logger of the path shares it; the
+        rotation and flush settings only apply when the sink is created.
+
+        Args:
+            filename (str): The log file path.
+            max_bytes (int): Rotate once the file would grow past this size, 0 to never rotate by size.
+            backup_count (int): Rotated files kept as filename.1 to filename.N.
+            rotate_interval (float): Rotate after this many seconds, 0 to never rotate by time.
+            flush_interval (float): The longest written lines stay buffered, in seconds. 0 flushes every write.
+
+        Returns:
+            _FileSink: The sink, or None if the file cannot be opened.
+        """
+        path = os.path.abspath(filename)
+        with Log._sinks_lock:
+            sink = Log._sinks.get(path)
+            if sink is None:
+                try:
+                    sink = _FileSink(path, max_bytes, backup_count, rotate_interval, flush_interval)
+                except Exception as e:
+                    print(f"Failed to open log file: {filename}: {str(e)}", file=sys.stderr)
+                    return None
+                if not Log._sinks:
+                    atexit.register(Log.close_sinks)
+                Log._sinks[path] = sink
+                if flush_interval > 0 and Log._flusher is None:
+                    Log._flusher = _SinkFlusher()
+            return sink
+
+    @staticmethod
+    def configure_file(filename, max_bytes=0, backup_count=5, rotate_interval=0, flush_interval=1.0):
+        """
+        Sets the process log file, written by every logger created without log_to_file.
+
+        Args:
+            filename (str): The log file path.
+            max_bytes (int): Rotate once the file would grow past this size, 0 to never rotate by size.
+            backup_count (int): Rotated files kept as filename.1 to filename.N.
+            rotate_interval (float): Rotate after this many seconds, 0 to never rotate by time.
+            flush_interval (float): The longest written lines stay buffered, in seconds. 0 flushes every write.
+
+        Returns:
+            bool: True if the file was opened.
+        """
+        Log._default_sink = Log.get_sink(filename, max_bytes, backup_count, rotate_interval, flush_interval)
+        return Log._default_sink is not None
+
+    @staticmethod
+    def close_sinks():
+        """
+        Writes the queued records, then flushes and closes every log file.
+        """
+        Log.flush()
+        if Log._flusher is not None:
+            Log._flusher.stop()
+            Log._flusher = None
+        with Log._sinks_lock:
+            for sink in Log._sinks.values():
+                sink.close()
+            Log._sinks.clear()
+            Log._default_sink = None
+
+    def _file_sink(self):
+        if self._sink is not None:
+            return self._sink
+        return Log._default_sink if self._to_file is None else None
+
+    @staticmethod
+    def enable_async(queue_size=10000, overflow=_AsyncWriter.OVERFLOW_DROP):
+        """
+        Switches every logger to asynchronous mode: a log call only queues a
+        compact record and returns, and one background thread formats and writes
+        the records in batches. The queue is flushed at exit.
+
+        Args:
+            queue_size (int): The most records waiting to be written.
+            overflow (str): "drop" to drop records when the queue is full, "block" to wait for room.
+        """
+        if Log._async_writer is None:
+            Log._async_writer = _AsyncWriter(queue_size, overflow)
+            atexit.register(Log.disable_async)
+
+    @staticmethod
+    def disable_async():
+        """
+        Writes the queued records and switches back to synchronous logging.
+        """
+        writer = Log._async_writer
+        if writer is not None:
+            Log._async_writer = None
+            writer.stop()
+            if writer.dropped:
+                print(f"{writer.dropped} log records were dropped because the log queue was full", file=sys.stderr)
+
+    @staticmethod
+    def flush():
+        """
+        Blocks until every queued log record is written, then flushes the log file buffers.
+        """
+        writer = Log._async_writer
+        if writer is not None:
+            writer.flush()
+        with Log._sinks_lock:
+            sinks = list(Log._sinks.values())
+        for sink in sinks:
+            sink.flush()
+
+    @staticmethod
+    def set_levels(console_level=None, file_level=None):
+        """
+        Sets the lowest level written to the console and to the log files, for every logger.
+
+        Args:
+            console_level (LogLevel, optional): The console threshold, unchanged if None.
+            file_level (LogLevel, optional): The log file threshold, unchanged if None.
+        """
+        if console_level is not None:
+            Log._console_level = console_level.value
+        if file_level is not None:
+            Log._file_level = file_level.value
+
+    @staticmethod
+    def set_console_stream(stream):
+        """
+        Sends the console output of every logger to another stream, e.g. sys.stderr when stdout carries data.
+
+        Args:
+            stream (file, optional): A text stream, None for sys.stdout.
+        """
+        Log._console_stream = stream
+
+    def is_enabled_for(self, level):
+        """
+        Checks whether a record of this level would be written anywhere, to skip building expensive messages.
+
+        Args:
+            level (LogLevel): The log level.
+
+        Returns:
+            bool: True if the console or the log file would get the record.
+        """
+        return self._enabled(level.value)
+
+    def _enabled(self, value):
+        return ((self._to_console and value >= Log._console_level)
+                or (value >= Log._file_level and self._file_sink() is not None))
 
     def cleanup(self):
         """
-        Cleans up the log file by closing it.
+        Detaches the logger from its log file. The file itself is shared, so it is only flushed here and closed
+        at exit (see Log.close_sinks).
         """
-        if self._log_file:
-            self._log_file.close()
-            self._log_file = None
+        if self._sink is not None:
+            self._sink.flush()
+            self._sink = None
+            self._to_file = False
 
-    def _log_message(self, level, message, file_details=None):
+    def _log_message(self, level, message, file_details=None, args=()):
         """
         Logs a message at a specified level with optional file details.
 
         Args:
             level (LogLevel): The log level.
-            message (str): The message to log.
+            message (str): The message to log, a %-style format if args are given.
             file_details (tuple, optional): A tuple with filename and line number.
+            args (tuple): The arguments of the message, only rendered when the record is written.
         """
-        with self._lock:
-            timestamp = Log._get_timestamp()
-            level_str = LogLevel.to_string(level)
+        # Get caller details (filename and line) if not provided
+        if not file_details:
+            file_details = self._get_caller_details()
 
-            # Get caller details (filename and line) if not provided
-            if not file_details:
-                filename, line = self._get_caller_details()
-            else:
-                filename, line = file_details
+        writer = Log._async_writer
+        if writer is not None:
+            writer.submit((self, level, time.time(), file_details[0], file_details[1], message, args))
+            return
 
-            log_entry = self._format_log_entry(timestamp, level_str, filename, line, message, self._logger_name)
+        filename, line = file_details
+        log_entry = self._format_log_entry(Log._get_timestamp(), LogLevel.to_string(level), filename, line,
+                                           Log._render(message, args), self._logger_name)
 
-            if self._to_console:
-                self._log_to_console(log_entry, level)
+        if self._to_console and level.value >= Log._console_level:
+            self._log_to_console(log_entry, level)
 
-            if self._to_file and Log._log_file:
-                self._log_to_file(log_entry, level)
+        sink = self._file_sink()
+        if sink is not None:
+            self._log_to_file(sink, log_entry, level)
 
-    def _log_to_file(self, message, level):
+    @staticmethod
+    def _log_to_file(sink, message, level):
         """
-        Logs a message to the file if the level is not DEBUG.
+        Logs a message to the file if the level reaches the file threshold (INFO by default).
 
         Args:
+            sink (_FileSink): The log file.
             message (str): The log message.
             level (LogLevel): The log level.
         """
-        if not (level == LogLevel.DEBUG):  # Don't log DEBUG level messages to the file
-            self._log_file.write(f"{message}\n")
+        if level.value >= Log._file_level:
+            sink.write_lines([message])
 
-    def debug(self, message):
+    # The level is checked first, so a disabled record costs one comparison: no frame lookup and no formatting.
+    # Pass the message arguments separately (logger.debug("Header: %s", header)) so they are only rendered
+    # when the record is written.
+
+    def debug(self, message, *args):
         """Logs a debug-level message."""
-        file_details = self._get_caller_details()
-        self._log_message(level=LogLevel.DEBUG, message=message, file_details=file_details)
+        if self._enabled(_DEBUG):
+            self._log_message(LogLevel.DEBUG, message, self._get_caller_details(), args)
 
-    def info(self, message):
+    def info(self, message, *args):
         """Logs an info-level message."""
-        file_details = self._get_caller_details()
-        self._log_message(level=LogLevel.INFO, message=message, file_details=file_details)
+        if self._enabled(_INFO):
+            self._log_message(LogLevel.INFO, message, self._get_caller_details(), args)
 
-    def warning(self, message):
+    def warning(self, message, *args):
         """Logs a warning-level message."""
-        file_details = self._get_caller_details()
-        self._log_message(level=LogLevel.WARNING, message=message, file_details=file_details)
+        if self._enabled(_WARNING):
+            self._log_message(LogLevel.WARNING, message, self._get_caller_details(), args)
 
-    def error(self, message):
+    def error(self, message, *args):
         """Logs an error-level message."""
-        file_details = self._get_caller_details()
-        self._log_message(level=LogLevel.ERROR, message=message, file_details=file_details)
+        if self._enabled(_ERROR):
+            self._log_message(LogLevel.ERROR, message, self._get_caller_details(), args)
 
     @staticmethod
     def _log_to_console(message, level):
@@ -148,16 +548,38 @@ class Log:
             message (str): The log message.
             level (LogLevel): The log level.
         """
-        reset_color = "\033[0m"
-        COLORS = {
-            LogLevel.DEBUG: "\033[37m",  # White for DEBUG
-            LogLevel.INFO: "\033[34m",  # Blue for INFO
-            LogLevel.WARNING: "\033[33m",  # Yellow for WARNING
-            LogLevel.ERROR: "\033[31m",  # Red for ERROR
-        }
+        Log._write_console([Log._colorize(message, level)])
+
+    @staticmethod
+    def _write_console(lines, flush=False):
+        """
+        Writes lines to the console with one call under the console lock, so lines never interleave.
+
+        Args:
+            lines (list): The lines, without line endings.
+            flush (bool): Whether to flush the stream afterwards.
+        """
+        stream = Log._console_stream or sys.stdout
+        with Log._console_lock:
+            stream.write("\n".join(lines) + "\n")
+            if flush:
+                stream.flush()
+
+    @staticmethod
+    def _colorize(message, level):
+        """
+        Wraps a message in the console color of its level.
+
+        Args:
+            message (str): The log message.
+            level (LogLevel): The log level.
 
-        color = COLORS.get(level, reset_color)  # Default to no color (reset)
-        print(f"{color}{message}{reset_color}")
+        Returns:
+            str: The colored message.
+        """
+        reset_color = "\033[0m"
+        color = Log._COLORS.get(level, reset_color)  # Default to no color (reset)
+        return f"{color}{message}{reset_color}"
 
     @staticmethod
     def _format_log_entry(timestamp, level_str, filename, line, message, logger_name):
@@ -180,10 +602,14 @@ class Log:
 
         # Format each component of the log entry
         timestamp = timestamp[:timestamp_width]
-        if len(level_str) % 2 == 0:
-            level_str = level_str.center(level_width - 1) + " "
-        else:
-            level_str = level_str.center(level_width)
+        centered = Log._centered_levels.get(level_str)
+        if centered is None:
+            if len(level_str) % 2 == 0:
+                centered = level_str.center(level_width - 1) + " "
+            else:
+                centered = level_str.center(level_width)
+            Log._centered_levels[level_str] = centered
+        level_str = centered
 
         fixed_part_length = len(f"[{timestamp}] [{level_str}] [{filename}:{line}]")
         max_fixed_part_length = 54
@@ -197,14 +623,41 @@ class Log:
         return log_entry
 
     @staticmethod
-    def _get_timestamp():
+    def _render(message, args):
         """
-        Gets the current timestamp in the format YYYY-MM-DD HH:MM:SS.
+        Renders a %-style message with its arguments.
+
+        Args:
+            message (str): The message or format.
+            args (tuple): The arguments, may be empty.
+
+        Returns:
+            str: The rendered message. A format that does not fit its arguments is logged as is with the arguments.
+        """
+        if not args:
+            return message
+        try:
+            return str(message) % args
+        except (TypeError, ValueError) as e:
+            return f"{message} {args!r} (bad log arguments: {e})"
+
+    @staticmethod
+    def _get_timestamp(created=None):
+        """
+        Gets a timestamp in the format YYYY-MM-DD HH:MM:SS. The string is only rebuilt once per second.
+
+        Args:
+            created (float, optional): The time to format, as returned by time.time(). Now by default.
 
         Returns:
-            str: The current timestamp.
+            str: The timestamp.
         """
-        return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        second = int(time.time() if created is None else created)
+        cached_second, timestamp = Log._timestamp_cache
+        if second != cached_second:
+            timestamp = datetime.fromtimestamp(second).strftime("%Y-%m-%d %H:%M:%S")
+            Log._timestamp_cache = (second, timestamp)
+        return timestamp
 
     @staticmethod
     def _get_caller_details():
@@ -214,10 +667,12 @@ class Log:
         Returns:
             tuple: A tuple containing the filename and line number.
         """
-        frame = inspect.currentframe().f_back.f_back  # Get caller's frame
-        filename = os.path.basename(frame.f_code.co_filename)  # Get the file name
-        line = frame.f_lineno  # Get the line number
-        return filename, line
+        frame = sys._getframe(2)  # Get caller's frame
+        code = frame.f_code
+        filename = Log._basenames.get(code)
+        if filename is None:
+            filename = Log._basenames[code] = os.path.basename(code.co_filename)  # Get the file name
+        return filename, frame.f_lineno
 
 
 # Example usage of the Log class
@@ -1,10 +1,186 @@
+import argparse
+import os
+import signal
+import tempfile
 
 from  FileHandler import *
+import Handlers
+from Logger import Log, LogLevel
+import Metrics
+from MessageStore import MessageStore
+from Prefork import Supervisor
+from Reaper import Reaper
+import RequestLog
+import Tracing
 from Server import Server
 
 
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="MessageU server")
+    parser.add_argument("--mode", choices=Server.MODES, default=Server.MODE_THREADED,
+                        help="Connection handling backend (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=None,
+                        help=f"Override the port read from '{Server.PORT_FILENAME}'")
+    parser.add_argument("--workers", type=int, default=None,
+                        help=f"Worker threads in pool mode, each serving one request at a time; idle connections "
+                             f"do not hold one (default: {Server.MAX_WORKERS})")
+    parser.add_argument("--queue-depth", type=int, default=None,
+                        help=f"Connections that may wait for a worker in pool mode (default: {Server.QUEUE_DEPTH})")
+    parser.add_argument("--idle-timeout", type=float, default=None,
+                        help=f"Seconds an idle connection is kept open (default: {Server.IDLE_TIMEOUT})")
+    parser.add_argument("--request-timeout", type=float, default=None,
+                        help="Seconds a client may take to send a request or read a response, plus its size at "
+                             f"{Reaper.MIN_TRANSFER_RATE // 1024} KB/s (default: {Server.REQUEST_TIMEOUT})")
+    parser.add_argument("--message-ttl", type=float, default=None,
+                        help="Seconds a message waits to be pulled before it is dropped (default: forever, "
+                             "not supported with --processes)")
+    parser.add_argument("--queue-cap", type=float, default=MessageStore.DEFAULT_MAX_QUEUE_BYTES / (1024 * 1024),
+                        help="Megabytes of message content a recipient's queue may hold (default: %(default)s)")
+    parser.add_argument("--queue-overflow", choices=MessageStore.OVERFLOW_POLICIES,
+                        default=MessageStore.OVERFLOW_REJECT,
+                        help="What happens to messages beyond --queue-cap: reject them, or spill them to disk until "
+                             "the recipient pulls (default: %(default)s, spill is not supported with --processes "
+                             "or --message-log)")
+    parser.add_argument("--max-requests", type=int, default=None,
+                        help=f"Requests served per connection (default: {Server.MAX_REQUESTS_PER_CONNECTION})")
+    parser.add_argument("--db", default=None,
+                        help="SQLite database file to keep clients and waiting messages across restarts")
+    parser.add_argument("--message-log", default=None,
+                        help="Keep the waiting messages in an append-only log in this folder instead of in memory; "
+                             "--db then only keeps the clients (not supported with --processes)")
+    parser.add_argument("--buffer-pool-mb", type=float, default=Server.BUFFER_POOL_BYTES / (1024 * 1024),
+                        help="Memory for reusable request buffers, 0 to allocate one per request "
+                             "(default: %(default)s)")
+    parser.add_argument("--spool-threshold-mb", type=float, default=Server.SPOOL_THRESHOLD / (1024 * 1024),
+                        help="Spool message contents larger than this to disk, 0 to keep all in memory "
+                             "(default: %(default)s, off with --db)")
+    parser.add_argument("--spool-dir", default=None,
+                        help="Folder for spooled message contents (default: a temporary folder)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Worker processes sharing the port, with their state in the --db database, "
+                             "not with --mode async (default: %(default)s)")
+    parser.add_argument("--drain-timeout", type=float, default=10.0,
+                        help="Seconds open connections get to finish on SIGTERM (default: %(default)s)")
+    parser.add_argument("--log-level", choices=("DEBUG", "INFO", "WARNING", "ERROR"), default="DEBUG",
+                        help="Lowest level printed to the console (default: %(default)s)")
+    parser.add_argument("--log-file", default=None,
+                        help="Also write INFO and above to this file, shared by every module's logger")
+    parser.add_argument("--log-max-bytes", type=int, default=0,
+                        help="Rotate the log file once it reaches this size (default: never)")
+    parser.add_argument("--log-rotate-interval", type=float, default=0,
+                        help="Rotate the log file every this many seconds (default: never)")
+    parser.add_argument("--log-backups", type=int, default=5,
+                        help="Rotated log files kept (default: %(default)s)")
+    parser.add_argument("--log-flush-interval", type=float, default=1.0,
+                        help="Seconds log lines may stay buffered before reaching the file, 0 to flush every line "
+                             "(default: %(default)s)")
+    parser.add_argument("--request-log", default=None,
+                        help="Record every request to this binary log, read it with RequestLog.py")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve a JSON metrics snapshot at http://127.0.0.1:PORT/metrics "
+                             "(PORT + i for worker process i)")
+    parser.add_argument("--metrics-file", default=None,
+                        help="Append a JSON metrics snapshot to this file every --metrics-interval seconds")
+    parser.add_argument("--metrics-interval", type=float, default=10.0,
+                        help="Seconds between snapshots written to --metrics-file (default: %(default)s)")
+    parser.add_argument("--trace", action="store_true",
+                        help="Time every stage of every request, SIGUSR2 dumps the recent traces to --trace-dump")
+    parser.add_argument("--trace-buffer", type=int, default=Tracing.DEFAULT_BUFFER_SIZE,
+                        help="Recent request traces kept (default: %(default)s)")
+    parser.add_argument("--slow-ms", type=float, default=None,
+                        help="Log the stage timings of requests slower than this (implies --trace)")
+    parser.add_argument("--trace-dump", default="traces.jsonl",
+                        help="File written on SIGUSR2 (default: %(default)s)")
+    parser.add_argument("--profile-seconds", type=float, default=Tracing.DEFAULT_PROFILE_SECONDS,
+                        help="How long SIGUSR1 profiles requests (default: %(default)s)")
+    parser.add_argument("--async-log", action="store_true",
+                        help="Write log records from a background thread instead of the request threads")
+    args = parser.parse_args()
+    if args.processes > 1 and args.mode == Server.MODE_ASYNC:
+        # Every request of a worker process reads and writes the shared database, which would block the event loop
+        parser.error("--mode async is not supported with --processes, use the threaded or pool mode")
+    return args
+
+
+def worker_filename(filename, index):
+    """Returns the per-process variant of an output file: server.log -> server.2.log for worker 2."""
+    if filename is None or index is None:
+        return filename
+    root, extension = os.path.splitext(filename)
+    return f"{root}.{index}{extension}"
+
+
+def configure_process(args, index=None):
+    """
+    Sets up logging, the request log, metrics and tracing of this process.
+
+    Args:
+        args (argparse.Namespace): The parsed arguments.
+        index (int, optional): The worker index in multi-process mode. Every worker writes its own files.
+    """
+    Log.set_levels(console_level=LogLevel[args.log_level])
+    if args.log_file:
+        Log.configure_file(worker_filename(args.log_file, index), max_bytes=args.log_max_bytes,
+                           backup_count=args.log_backups, rotate_interval=args.log_rotate_interval,
+                           flush_interval=args.log_flush_interval)
+    if args.request_log:
+        RequestLog.enable(worker_filename(args.request_log, index))
+    if args.metrics_port is not None:
+        Metrics.serve_admin(args.metrics_port + (index or 0))
+    if args.metrics_file:
+        Metrics.start_snapshots(worker_filename(args.metrics_file, index), args.metrics_interval)
+    if args.trace or args.slow_ms is not None:
+        Tracing.enable(args.trace_buffer, args.slow_ms)
+    Tracing.install_signal_handlers(args.profile_seconds, worker_filename(args.trace_dump, index))
+    if args.async_log:
+        Log.enable_async()
+
+
+def run_worker(index, listen_socket, ready, args):
+    """Entry point of a worker process in multi-process mode (see Prefork.Supervisor)."""
+    # The supervisor handles Ctrl-C and hangups for the whole process group, and stops the workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    configure_process(args, index)
+    Handlers.use_shared_store(args.db, int(args.queue_cap * 1024 * 1024))
+    Server.start_server(mode=args.mode, port=args.port, max_workers=args.workers, queue_depth=args.queue_depth,
+                        idle_timeout=args.idle_timeout, max_requests=args.max_requests,
+                        request_timeout=args.request_timeout,
+                        ready=lambda host, port: ready.send(True), listen_socket=listen_socket,
+                        reuse_port=listen_socket is None, drain_timeout=args.drain_timeout,
+                        buffer_pool_bytes=int(args.buffer_pool_mb * 1024 * 1024), spool_threshold=0)
+
+
 def main():
-    Server.start_server()
+    args = parse_arguments()
+    if args.processes > 1:
+        Log.set_levels(console_level=LogLevel[args.log_level])
+        if not args.db:
+            args.db = os.path.join(tempfile.mkdtemp(prefix="messageu-"), "server.db")
+            Log(logger_name=__name__).warning(f"No --db given, the workers share the temporary database "
+                                              f"'{args.db}'")
+        if args.message_ttl:
+            Log(logger_name=__name__).warning("--message-ttl is not supported with --processes, messages are kept "
+                                              "until pulled")
+        if args.message_log:
+            Log(logger_name=__name__).warning("--message-log is not supported with --processes, the messages are "
+                                              "kept in the --db database")
+        if args.queue_overflow == MessageStore.OVERFLOW_SPILL:
+            Log(logger_name=__name__).warning("--queue-overflow spill is not supported with --processes, messages "
+                                              "beyond --queue-cap are rejected")
+        port = Server.PORT if args.port is None else args.port
+        Supervisor(run_worker, (args,), args.processes, Server.LOCAL_HOST, port, args.drain_timeout).run()
+        return
+
+    configure_process(args)
+    Server.start_server(mode=args.mode, port=args.port, max_workers=args.workers, queue_depth=args.queue_depth,
+                        idle_timeout=args.idle_timeout, max_requests=args.max_requests, db_filename=args.db,
+                        request_timeout=args.request_timeout, message_ttl=args.message_ttl,
+                        message_log=args.message_log, queue_cap=int(args.queue_cap * 1024 * 1024),
+                        queue_overflow=args.queue_overflow,
+                        drain_timeout=args.drain_timeout, buffer_pool_bytes=int(args.buffer_pool_mb * 1024 * 1024),
+                        spool_threshold=int(args.spool_threshold_mb * 1024 * 1024), spool_dir=args.spool_dir)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,513 @@
+import heapq
+import itertools
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
+
+from Logger import Log
+from Spool import SharedFile, SpooledContent
+
+logger = Log(logger_name=__name__)
+
+# A spill record is a kind byte and the 2104 entry fields, then the content of a SPILL_INLINE record. The content of a
+# SPILL_SPOOLED record stays in its spool file, and its queue keeps the SpooledContent until it is pulled.
+SPILL_RECORD = struct.Struct("<B 16s I B I")  # Kind, sender client ID, message ID, message type, content size
+SPILL_INLINE = 0
+SPILL_SPOOLED = 1
+
+
+class Message:
+    """One waiting message. content is any bytes-like object (a view over the request payload when possible)."""
+    __slots__ = ("message_id", "sender_id", "recipient_id", "message_type", "content", "expires")
+
+    def __init__(self, message_id, sender_id, recipient_id, message_type, content, expires=None):
+        self.message_id = message_id
+        self.sender_id = sender_id
+        self.recipient_id = recipient_id
+        self.message_type = message_type
+        self.content = content
+        self.expires = expires  # time.monotonic() deadline, None to wait until pulled
+
+    def __repr__(self):
+        return (f"Message(message_id={self.message_id}, sender_id={self.sender_id.hex()}, "
+                f"recipient_id={self.recipient_id.hex()}, message_type={self.message_type}, size={len(self.content)})")
+
+
+class _RecipientQueue:
+    __slots__ = ("messages", "bytes", "spill_path", "spilled_messages", "spilled_bytes", "spill_expires",
+                 "spilled_spools")
+
+    def __init__(self):
+        self.messages = deque()
+        self.bytes = 0
+        self.spill_path = None
+        self.spilled_messages = 0
+        self.spilled_bytes = 0
+        self.spill_expires = None  # When the newest spilled message expires
+        self.spilled_spools = None  # The spooled contents of the spilled messages, in order
+
+
+class _Shard:
+    __slots__ = ("lock", "queues", "waiters", "expiry")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.waiters = {}  # Recipient ID -> callbacks waiting for its next message
+        self.expiry = []  # Min-heap of (expires, sequence, recipient ID, queue), one entry per queue with a TTL
+
+
+class MessageStore:
+    """
+    Waiting messages, one FIFO queue per recipient.
+
+    Sending appends to the recipient's deque and pulling swaps the whole deque
+    out, both O(1) under the lock of the recipient's shard. Every queue has a
+    memory cap: once it is reached new messages are either rejected, or spilled
+    to a file for that recipient (and later messages follow them there, so the
+    order is kept) until the recipient pulls. A pull reads back only the
+    headers of the spilled messages: their contents are sent from the spill
+    file, so a pull never loads a spill into memory.
+
+    Long polls wait for a recipient's next message with add_waiter.
+
+    With a TTL, messages nobody pulls are dropped once they are ttl seconds
+    old. Every message of a queue gets the same TTL and a queue is FIFO, so
+    its expired messages are always at its front: each shard keeps a min-heap
+    with one entry per queue, due when the oldest message of the queue
+    expires, and sweep() pops the due entries, drops the expired front of
+    their queues and puts them back at the expiry of their new front. Spilled
+    messages are dropped together, with their file, once the newest of them
+    expires. A background thread (start_sweeper) sweeps in slices of at most
+    SWEEP_SLICE messages per shard lock.
+    """
+    OVERFLOW_REJECT = "reject"
+    OVERFLOW_SPILL = "spill"
+    OVERFLOW_POLICIES = (OVERFLOW_REJECT, OVERFLOW_SPILL)
+
+    DEFAULT_MAX_QUEUE_BYTES = 16 * 1024 * 1024
+    DEFAULT_SHARDS = 16
+
+    # Seconds between checks for messages a waiter might not be told about; None as every enqueue wakes the waiters
+    RECHECK_INTERVAL = None
+
+    SWEEP_SLICE = 256  # The most messages dropped per shard lock hold
+    SWEEP_INTERVAL = 1.0  # Seconds between sweeps when nothing is left to expire
+
+    def __init__(self, max_queue_bytes=DEFAULT_MAX_QUEUE_BYTES, overflow=OVERFLOW_REJECT, spill_dir=None,
+                 shards=DEFAULT_SHARDS, ttl=None):
+        """
+        Args:
+            max_queue_bytes (int): Content bytes a recipient's queue may hold in memory.
+            overflow (str): OVERFLOW_REJECT or OVERFLOW_SPILL, what to do with messages beyond the cap.
+            spill_dir (str, optional): Where spill files are written. A temporary folder by default.
+            shards (int): The number of lock stripes.
+            ttl (float, optional): Seconds a message waits to be pulled before it is dropped. Forever by default.
+        """
+        if overflow not in MessageStore.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy [{overflow}], expected one of {MessageStore.OVERFLOW_POLICIES}")
+
+        self._max_queue_bytes = max_queue_bytes
+        self._overflow = overflow
+        self._spill_dir = spill_dir
+        self._shards = [_Shard() for _ in range(shards)]
+        self._message_ids = itertools.count(1)
+        self._last_restored_id = 0
+        self._stats_lock = threading.Lock()
+        self._rejected = 0
+        self._sequence = itertools.count()  # Breaks ties between heap entries
+        self._expired_messages = 0
+        self._expired_bytes = 0
+        self._sweep_slices = 0
+        self._longest_slice_ns = 0
+        self.ttl = ttl  # Set before messages are stored: it only applies to messages stored after
+        self.journal = None  # Optional durable store told about every stored and pulled message (see SqliteStore)
+
+    def _shard(self, recipient_id):
+        return self._shards[hash(recipient_id) % len(self._shards)]
+
+    def _next_message_id(self):
+        return next(self._message_ids) & 0xFFFFFFFF
+
+    def enqueue(self, recipient_id, sender_id, message_type, content):
+        """
+        Stores a message for its recipient.
+
+        Args:
+            recipient_id (bytes): The recipient's client ID.
+            sender_id (bytes): The sender's client ID.
+            message_type (int): The message type.
+            content (bytes-like): The message content.
+
+        Returns:
+            Message: The stored message, with its message ID.
+
+        Raises:
+            ValueError: If the recipient's queue is full and the overflow policy is OVERFLOW_REJECT.
+        """
+        message = Message(self._next_message_id(), sender_id, recipient_id, message_type, content,
+                          time.monotonic() + self.ttl if self.ttl is not None else None)
+
+        shard = self._shard(recipient_id)
+        with shard.lock:
+            self._append(shard, message)
+            # Journaled under the shard lock so the journal sees a message stored before it is pulled
+            if self.journal is not None:
+                self.journal.record_message(message)
+            waiters = shard.waiters.pop(recipient_id, None) if shard.waiters else None
+        if waiters:
+            for wake in waiters:
+                wake()
+        return message
+
+    def add_waiter(self, recipient_id, wake):
+        """
+        Asks to be told about the next message stored for a recipient, unless messages are already waiting.
+
+        Args:
+            recipient_id (bytes): The recipient's client ID.
+            wake (callable): Called without arguments on the sending thread, once, right after the next message
+                is stored. Must not block.
+
+        Returns:
+            bool: False, without adding the waiter, if the recipient already has messages waiting.
+        """
+        shard = self._shard(recipient_id)
+        with shard.lock:
+            if recipient_id in shard.queues:
+                return False
+            shard.waiters.setdefault(recipient_id, []).append(wake)
+        return True
+
+    def remove_waiter(self, recipient_id, wake):
+        """Removes a waiter added with add_waiter, if it was not woken yet."""
+        shard = self._shard(recipient_id)
+        with shard.lock:
+            waiters = shard.waiters.get(recipient_id)
+            if waiters and wake in waiters:
+                waiters.remove(wake)
+                if not waiters:
+                    del shard.waiters[recipient_id]
+
+    def restore(self, message):
+        """
+        Puts back a message loaded from storage, keeping its message ID. New message IDs continue after it.
+        With a TTL, its age restarts now: storage does not keep when it was sent.
+
+        Args:
+            message (Message): The message.
+        """
+        if self.ttl is not None and message.expires is None:
+            message.expires = time.monotonic() + self.ttl
+        shard = self._shard(message.recipient_id)
+        with shard.lock:
+            self._append(shard, message, enforce_cap=False)
+        with self._stats_lock:
+            if message.message_id >= self._last_restored_id:
+                self._last_restored_id = message.message_id
+                self._message_ids = itertools.count(message.message_id + 1)
+
+    def _append(self, shard, message, enforce_cap=True):
+        # Called with the shard lock held. Spooled contents are on disk already and do not count against the cap.
+        # The queue is only created for an accepted message: an empty queue would tell add_waiter messages wait.
+        recipient_id = message.recipient_id
+        queue = shard.queues.get(recipient_id)
+        if queue is not None and queue.spill_path is not None:
+            self._spill(queue, message)  # Behind the spilled messages, restored ones included, to keep the order
+            return
+
+        size = len(message.content) if type(message.content) is not SpooledContent else 0
+        if enforce_cap and (queue.bytes if queue is not None else 0) + size > self._max_queue_bytes:
+            if self._overflow == MessageStore.OVERFLOW_REJECT:
+                with self._stats_lock:
+                    self._rejected += 1
+                raise ValueError(f"The message queue of [{recipient_id.hex()}] is full "
+                                 f"({queue.bytes if queue is not None else 0} of {self._max_queue_bytes} bytes)")
+            self._spill(queue or self._new_queue(shard, message), message)
+            return
+
+        queue = queue or self._new_queue(shard, message)
+        queue.messages.append(message)
+        queue.bytes += size
+
+    def _new_queue(self, shard, message):
+        # Called with the shard lock held
+        queue = shard.queues[message.recipient_id] = _RecipientQueue()
+        if message.expires is not None:
+            heapq.heappush(shard.expiry, (message.expires, next(self._sequence), message.recipient_id, queue))
+        return queue
+
+    def pull(self, recipient_id):
+        """
+        Removes and returns all the waiting messages of a recipient, in the order they were sent. Expired
+        messages the sweeper did not get to yet are dropped, not returned.
+
+        Args:
+            recipient_id (bytes): The recipient's client ID.
+
+        Returns:
+            list: The messages, empty if there are none.
+        """
+        shard = self._shard(recipient_id)
+        with shard.lock:
+            queue = shard.queues.pop(recipient_id, None)
+        if queue is None:
+            return []
+
+        messages = list(queue.messages)
+        queue.messages.clear()  # A heap entry may still refer to the queue until it comes due
+        if queue.spill_path is not None:
+            messages.extend(self._read_spill(queue, recipient_id))
+        if self.journal is not None:
+            self.journal.delete_messages(messages)
+        if self.ttl is not None:
+            messages = self._drop_expired(messages, queue)
+        return messages
+
+    def _drop_expired(self, messages, queue):
+        # Spilled messages are read back without their expiry, they expire together
+        now = time.monotonic()
+        spill_expired = queue.spill_expires is not None and queue.spill_expires <= now
+        kept = [message for message in messages
+                if not (message.expires <= now if message.expires is not None else spill_expired)]
+        if len(kept) < len(messages):
+            expired_bytes = sum(len(message.content) for message in messages) - sum(
+                len(message.content) for message in kept)
+            with self._stats_lock:
+                self._expired_messages += len(messages) - len(kept)
+                self._expired_bytes += expired_bytes
+        return kept
+
+    def stats(self):
+        """
+        Returns the store totals.
+
+        Returns:
+            dict: Queue count, waiting messages and bytes (in memory and spilled) and rejected messages.
+        """
+        totals = {"queues": 0, "messages": 0, "bytes": 0, "spilled_messages": 0, "spilled_bytes": 0}
+        for shard in self._shards:
+            with shard.lock:
+                for queue in shard.queues.values():
+                    totals["queues"] += 1
+                    totals["messages"] += len(queue.messages) + queue.spilled_messages
+                    totals["bytes"] += queue.bytes + queue.spilled_bytes
+                    totals["spilled_messages"] += queue.spilled_messages
+                    totals["spilled_bytes"] += queue.spilled_bytes
+        with self._stats_lock:
+            totals["rejected"] = self._rejected
+            totals["expired_messages"] = self._expired_messages
+            totals["expired_bytes"] = self._expired_bytes
+            totals["sweep_slices"] = self._sweep_slices
+            totals["longest_sweep_slice_us"] = self._longest_slice_ns // 1000
+        return totals
+
+    def sweep(self, now=None, slice_size=SWEEP_SLICE):
+        """
+        Drops the expired messages, holding each shard lock for at most slice_size messages.
+
+        Args:
+            now (float, optional): The current time.monotonic() value.
+            slice_size (int): The most messages dropped per shard.
+
+        Returns:
+            tuple: (messages, bytes, more): the messages and content bytes dropped, and whether expired messages
+            were left for the next sweep.
+        """
+        now = time.monotonic() if now is None else now
+        expired = []
+        spills = []
+        expired_bytes = 0
+        more = False
+        for shard in self._shards:
+            if not shard.expiry or shard.expiry[0][0] > now:
+                continue  # Unlocked peek: an entry pushed meanwhile is not due yet
+            start = time.perf_counter_ns()
+            with shard.lock:
+                dropped_bytes, left = self._sweep_shard(shard, now, slice_size, expired, spills)
+            elapsed = time.perf_counter_ns() - start
+            expired_bytes += dropped_bytes
+            more = more or left
+            with self._stats_lock:
+                self._sweep_slices += 1
+                self._longest_slice_ns = max(self._longest_slice_ns, elapsed)
+
+        # The slow parts run without a lock: the dropped spill files belong to nobody anymore
+        count = len(expired)
+        for path, spilled_messages, spilled_bytes, spools in spills:
+            for content in spools or ():
+                content.discard()
+            if self.journal is not None:
+                expired.extend(self._read_spill_headers(path))
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.error(f"Failed to remove the expired spill file '{path}': {e}")
+            count += spilled_messages
+            expired_bytes += spilled_bytes
+        if self.journal is not None and expired:
+            self.journal.delete_messages(expired)
+
+        if count:
+            with self._stats_lock:
+                self._expired_messages += count
+                self._expired_bytes += expired_bytes
+            logger.debug(f"Dropped {count} expired messages ({expired_bytes} bytes)")
+        return count, expired_bytes, more
+
+    def _sweep_shard(self, shard, now, slice_size, expired, spills):
+        # Called with the shard lock held. Returns (bytes, more) for this shard, the messages go to expired.
+        heap = shard.expiry
+        dropped = 0
+        dropped_bytes = 0
+        while heap and heap[0][0] <= now:
+            if dropped >= slice_size:
+                return dropped_bytes, True
+            _, _, recipient_id, queue = heapq.heappop(heap)
+            if shard.queues.get(recipient_id) is not queue:
+                continue  # Pulled since
+
+            messages = queue.messages
+            while messages and messages[0].expires <= now and dropped < slice_size:
+                message = messages.popleft()
+                size = len(message.content) if type(message.content) is not SpooledContent else 0
+                queue.bytes -= size
+                dropped += 1
+                dropped_bytes += len(message.content)
+                expired.append(message)
+
+            if not messages and queue.spill_path is not None and queue.spill_expires <= now:
+                spills.append((queue.spill_path, queue.spilled_messages, queue.spilled_bytes, queue.spilled_spools))
+                queue.spill_path = queue.spilled_spools = None
+                queue.spilled_messages = queue.spilled_bytes = 0
+
+            if messages:
+                heapq.heappush(heap, (messages[0].expires, next(self._sequence), recipient_id, queue))
+            elif queue.spill_path is not None:
+                heapq.heappush(heap, (queue.spill_expires, next(self._sequence), recipient_id, queue))
+            else:
+                del shard.queues[recipient_id]
+        return dropped_bytes, False
+
+    def start_sweeper(self, interval=SWEEP_INTERVAL):
+        """
+        Sweeps the expired messages on a background thread: every interval seconds, or right away while a sweep
+        leaves expired messages behind.
+
+        Args:
+            interval (float): Seconds between sweeps.
+
+        Returns:
+            threading.Event: Set it to stop the sweeper.
+        """
+        stop = threading.Event()
+
+        def run():
+            while True:
+                try:
+                    more = self.sweep()[2]
+                except Exception as e:
+                    logger.error(f"Failed to sweep the expired messages: {e}")
+                    more = False
+                if stop.wait(0 if more else interval):
+                    return
+
+        threading.Thread(target=run, name="message-sweeper", daemon=True).start()
+        logger.info(f"Messages expire after {self.ttl}s, swept every {interval}s")
+        return stop
+
+    def queue_stats(self, top=10):
+        """
+        Returns the largest queues, to see which recipients are backing up.
+
+        Args:
+            top (int): How many queues to return.
+
+        Returns:
+            list: One dict per queue (recipient, messages, bytes, spilled_messages), largest first.
+        """
+        queues = []
+        for shard in self._shards:
+            with shard.lock:
+                for recipient_id, queue in shard.queues.items():
+                    queues.append({
+                        "recipient": recipient_id.hex(),
+                        "messages": len(queue.messages) + queue.spilled_messages,
+                        "bytes": queue.bytes + queue.spilled_bytes,
+                        "spilled_messages": queue.spilled_messages,
+                    })
+        queues.sort(key=lambda q: q["bytes"], reverse=True)
+        return queues[:top]
+
+    def _spill(self, queue, message):
+        # Called with the shard lock held. A spooled content is not copied: the record refers to its spool file.
+        if queue.spill_path is None:
+            if self._spill_dir is None:
+                self._spill_dir = tempfile.mkdtemp(prefix="messageu-spill-")
+            else:
+                os.makedirs(self._spill_dir, exist_ok=True)
+            queue.spill_path = os.path.join(self._spill_dir, f"{message.recipient_id.hex()}-{message.message_id}.spill")
+            logger.warning(f"Message queue of [{message.recipient_id.hex()}] is full, spilling to '{queue.spill_path}'")
+
+        spooled = type(message.content) is SpooledContent
+        with open(queue.spill_path, "ab") as spill_file:
+            spill_file.write(SPILL_RECORD.pack(SPILL_SPOOLED if spooled else SPILL_INLINE, message.sender_id,
+                                               message.message_id, message.message_type, len(message.content)))
+            if not spooled:
+                spill_file.write(message.content)
+        if spooled:
+            if queue.spilled_spools is None:
+                queue.spilled_spools = deque()
+            queue.spilled_spools.append(message.content)
+
+        queue.spilled_messages += 1
+        queue.spilled_bytes += len(message.content)
+        if message.expires is not None:
+            queue.spill_expires = message.expires
+
+    @staticmethod
+    def _read_spill_headers(path):
+        # The spilled messages without their content, enough to delete them from the journal
+        messages = []
+        try:
+            with open(path, "rb") as spill_file:
+                while True:
+                    record = spill_file.read(SPILL_RECORD.size)
+                    if not record:
+                        break
+                    kind, sender_id, message_id, message_type, size = SPILL_RECORD.unpack(record)
+                    if kind == SPILL_INLINE:
+                        spill_file.seek(size, os.SEEK_CUR)
+                    messages.append(Message(message_id, sender_id, None, message_type, b""))
+        except OSError as e:
+            logger.error(f"Failed to read spilled messages from '{path}': {e}")
+        return messages
+
+    @staticmethod
+    def _read_spill(queue, recipient_id):
+        # Only the record headers are read. The contents stay on disk, as ranges of the spill file that are sent with
+        # sendfile; the file is deleted once the last of them is sent or dropped.
+        messages = []
+        spill = SharedFile(queue.spill_path)
+        try:
+            with open(queue.spill_path, "rb") as spill_file:
+                offset = 0
+                while True:
+                    record = spill_file.read(SPILL_RECORD.size)
+                    if not record:
+                        break
+                    offset += SPILL_RECORD.size
+                    kind, sender_id, message_id, message_type, size = SPILL_RECORD.unpack(record)
+                    if kind == SPILL_SPOOLED:
+                        content = queue.spilled_spools.popleft()
+                    else:
+                        content = spill.content(offset, size)
+                        offset += size
+                        spill_file.seek(offset)
+                    messages.append(Message(message_id, sender_id, recipient_id, message_type, content))
+        except OSError as e:
+            logger.error(f"Failed to read spilled messages from '{queue.spill_path}': {e}")
+        return messages
@@ -0,0 +1,340 @@
+"""
+Process-wide server metrics: request counters and latency histograms per
+request code, errors by cause, bytes in and out and connection counts.
+
+Updates are cheap enough to stay on all the time: each thread updates one
+of SHARDS shards picked by its thread ID, so threads rarely share a lock,
+and a snapshot merges the shards. Latencies go into log-linear (HDR style)
+histograms, so percentiles are exact to within 1/SUB_BUCKETS whatever the
+range, in constant memory.
+
+Snapshots are exposed through a local HTTP admin endpoint (serve_admin,
+GET /metrics) and/or appended as JSON lines to a file every few seconds
+(start_snapshots). Other components add their own stats with add_source.
+"""
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from Logger import Log
+
+logger = Log(logger_name=__name__)
+
+SHARDS = 16
+MAX_ERROR_CAUSES = 100  # Distinct error causes kept, later ones are counted as "other"
+
+
+class Histogram:
+    """
+    Log-linear histogram of non-negative integers (latencies in microseconds).
+
+    Values below 2 * SUB_BUCKETS get a bucket each; above that every power of
+    two range is split into SUB_BUCKETS equal buckets. Not thread-safe on its
+    own, callers hold their shard lock.
+    """
+    SUB_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BITS
+    MAX_VALUE = (1 << 36) - 1  # About 19 hours in microseconds; larger values are clamped
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (Histogram.bucket_index(Histogram.MAX_VALUE) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def bucket_index(value):
+        if value < 2 * Histogram.SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - Histogram.SUB_BITS - 1
+        return (shift + 1) * Histogram.SUB_BUCKETS + (value >> shift) - Histogram.SUB_BUCKETS
+
+    @staticmethod
+    def bucket_high(index):
+        """Returns the highest value that falls in a bucket."""
+        if index < 2 * Histogram.SUB_BUCKETS:
+            return index
+        shift = index // Histogram.SUB_BUCKETS - 1
+        mantissa = index % Histogram.SUB_BUCKETS + Histogram.SUB_BUCKETS
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, value):
+        if value > Histogram.MAX_VALUE:
+            value = Histogram.MAX_VALUE
+        self.counts[Histogram.bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction):
+        """Returns the value below which the given fraction of the recorded values fall (bucket upper bound)."""
+        if not self.count:
+            return 0
+        target = max(1, int(self.count * fraction + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(Histogram.bucket_high(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_us": round(self.total / self.count, 1) if self.count else 0,
+            "p50_us": self.percentile(0.5),
+            "p90_us": self.percentile(0.9),
+            "p99_us": self.percentile(0.99),
+            "p999_us": self.percentile(0.999),
+            "max_us": self.max,
+        }
+
+
+class _CodeStats:
+    __slots__ = ("requests", "errors", "latency")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+
+class _Shard:
+    __slots__ = ("lock", "codes", "errors", "bytes_in", "bytes_out")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.codes = {}  # Request code -> _CodeStats
+        self.errors = {}  # Cause -> count
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+
+_shards = [_Shard() for _ in range(SHARDS)]
+_connections_lock = threading.Lock()
+_connections = {"active": 0, "peak_active": 0, "opened": 0, "rejected": 0}
+_sources = {}
+_started = time.time()
+
+# Error messages put their variable parts in [brackets], e.g. "Client [ab12...] is not registered"; numbers vary too
+_VARIABLE_PARTS = re.compile(r"\[[^\]]*\]|\d+")
+
+
+def _mask(match):
+    return "[]" if match.group().startswith("[") else "#"
+
+
+def _shard():
+    return _shards[threading.get_ident() % SHARDS]
+
+
+def error_cause(error):
+    """
+    Returns the cause of an error with its variable parts removed, so that errors of the same kind are counted
+    together: ValueError("Client [ab12] is not registered") -> "ValueError: Client [] is not registered".
+    """
+    return f"{type(error).__name__}: {_VARIABLE_PARTS.sub(_mask, str(error))}"
+
+
+def record_request(code, latency_ns, bytes_in, bytes_out, error=False):
+    """
+    Counts one handled request.
+
+    Args:
+        code (int): The request code.
+        latency_ns (int): The time taken to handle it, in nanoseconds.
+        bytes_in (int): The request size, header included.
+        bytes_out (int): The response size, header included.
+        error (bool): Whether the request failed.
+    """
+    shard = _shard()
+    with shard.lock:
+        stats = shard.codes.get(code)
+        if stats is None:
+            stats = shard.codes[code] = _CodeStats()
+        stats.requests += 1
+        if error:
+            stats.errors += 1
+        stats.latency.record(latency_ns // 1000)
+        shard.bytes_in += bytes_in
+        shard.bytes_out += bytes_out
+
+
+def record_error(error):
+    """
+    Counts an error by its cause (see error_cause).
+
+    Args:
+        error (Exception): The error.
+    """
+    cause = error_cause(error)
+    shard = _shard()
+    with shard.lock:
+        errors = shard.errors
+        if cause not in errors and len(errors) >= MAX_ERROR_CAUSES:
+            cause = "other"
+        errors[cause] = errors.get(cause, 0) + 1
+
+
+def connection_opened():
+    with _connections_lock:
+        _connections["opened"] += 1
+        _connections["active"] += 1
+        if _connections["active"] > _connections["peak_active"]:
+            _connections["peak_active"] = _connections["active"]
+
+
+def connection_closed():
+    with _connections_lock:
+        _connections["active"] -= 1
+
+
+def active_connections():
+    with _connections_lock:
+        return _connections["active"]
+
+
+def connection_rejected():
+    with _connections_lock:
+        _connections["rejected"] += 1
+
+
+def add_source(name, stats):
+    """
+    Adds the stats of another component to the snapshots.
+
+    Args:
+        name (str): The key of the stats in the snapshot.
+        stats (callable): Returns a JSON serializable dict, called for every snapshot.
+    """
+    _sources[name] = stats
+
+
+def snapshot():
+    """
+    Merges the shards into one view of the metrics.
+
+    Returns:
+        dict: JSON serializable metrics, with the stats of every added source.
+    """
+    codes = {}
+    errors = {}
+    bytes_in = bytes_out = 0
+    for shard in _shards:
+        with shard.lock:
+            for code, stats in shard.codes.items():
+                merged = codes.get(code)
+                if merged is None:
+                    merged = codes[code] = _CodeStats()
+                merged.requests += stats.requests
+                merged.errors += stats.errors
+                merged.latency.merge(stats.latency)
+            for cause, count in shard.errors.items():
+                errors[cause] = errors.get(cause, 0) + count
+            bytes_in += shard.bytes_in
+            bytes_out += shard.bytes_out
+
+    total_latency = Histogram()
+    requests = {}
+    for code in sorted(codes):
+        stats = codes[code]
+        total_latency.merge(stats.latency)
+        latency = stats.latency.summary()
+        del latency["count"]  # Same as requests
+        requests[str(code)] = dict(requests=stats.requests, errors=stats.errors, **latency)
+
+    with _connections_lock:
+        connections = dict(_connections)
+
+    sources = {}
+    for name, stats in list(_sources.items()):
+        try:
+            sources[name] = stats()
+        except Exception as e:
+            sources[name] = {"error": str(e)}
+
+    now = time.time()
+    return {
+        "time": now,
+        "uptime_s": round(now - _started, 1),
+        "connections": connections,
+        "bytes": {"in": bytes_in, "out": bytes_out},
+        "requests": requests,
+        "latency": total_latency.summary(),
+        "errors": dict(sorted(errors.items(), key=lambda item: item[1], reverse=True)),
+        "sources": sources,
+    }
+
+
+class _AdminHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = json.dumps(snapshot(), indent=2).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Admin request from [%s]: " + format, self.client_address[0], *args)
+
+
+def serve_admin(port, host="127.0.0.1"):
+    """
+    Serves GET /metrics (a JSON snapshot) on a background thread.
+
+    Args:
+        port (int): The admin port, 0 for any free port.
+        host (str): The address to listen on, local only by default.
+
+    Returns:
+        ThreadingHTTPServer: The server, call shutdown() to stop it. server_address holds the actual port.
+    """
+    server = ThreadingHTTPServer((host, port), _AdminHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-admin", daemon=True).start()
+    logger.info(f"Metrics available at [http://{host}:{server.server_address[1]}/metrics]")
+    return server
+
+
+def start_snapshots(filename, interval=10.0):
+    """
+    Appends a snapshot to a file as one JSON line every interval seconds, on a background thread.
+
+    Args:
+        filename (str): The snapshot file.
+        interval (float): Seconds between snapshots.
+
+    Returns:
+        threading.Event: Set it to stop the snapshots.
+    """
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                with open(filename, "a") as file:
+                    file.write(json.dumps(snapshot()) + "\n")
+            except OSError as e:
+                logger.error(f"Failed to write metrics to '{filename}': {e}")
+
+    threading.Thread(target=run, name="metrics-snapshots", daemon=True).start()
+    logger.info(f"Writing metrics to '{filename}' every {interval}s")
+    return stop
@@ -0,0 +1,98 @@
+import selectors
+import socket
+import threading
+
+from Logger import Log
+
+logger = Log(logger_name=__name__)
+
+
+class ConnectionParker:
+    """
+    Holds the idle keep-alive connections of the worker pool without a thread each.
+
+    A pool worker that finds no request waiting on its connection parks it
+    here and goes back to the pool. One thread waits for any parked socket to
+    become readable (a request arriving, the client closing, or the reaper
+    shutting it down) and hands the connection back with resume(), so
+    workers are only ever busy with requests, and idle clients cannot hold
+    them all.
+    """
+
+    def __init__(self, resume, name="connection-parker"):
+        """
+        Starts the parker thread.
+
+        Args:
+            resume (callable): Called with the item of a parked socket once it is readable, on the parker thread.
+                Must not block.
+            name (str): The thread name.
+        """
+        self._resume = resume
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._pending = []  # (socket, item) parked since the thread last registered them
+        self._wake_reader, self._wake_writer = socket.socketpair()
+        self._wake_reader.setblocking(False)
+        self._wake_writer.setblocking(False)
+        self._selector.register(self._wake_reader, selectors.EVENT_READ)
+        self._parked = 0
+        self._peak_parked = 0
+        self._resumed = 0
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+
+    def park(self, client_socket, item):
+        """
+        Waits for a socket to become readable, then calls resume(item).
+
+        Args:
+            client_socket (socket.socket): The connection, with nothing of its next request read yet.
+            item: Passed to resume().
+        """
+        with self._lock:
+            self._pending.append((client_socket, item))
+            wake = len(self._pending) == 1
+            self._parked += 1
+            self._peak_parked = max(self._peak_parked, self._parked)
+        if wake:
+            try:
+                self._wake_writer.send(b"\0")
+            except BlockingIOError:
+                pass  # Already woken
+
+    def _run(self):
+        while True:
+            for key, _ in self._selector.select():
+                if key.fileobj is self._wake_reader:
+                    self._register_pending()
+                    continue
+                self._selector.unregister(key.fileobj)
+                with self._lock:
+                    self._parked -= 1
+                    self._resumed += 1
+                try:
+                    self._resume(key.data)
+                except Exception as e:
+                    logger.error(f"Failed to resume a parked connection: {e}")
+
+    def _register_pending(self):
+        try:
+            while self._wake_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for client_socket, item in pending:
+            try:
+                self._selector.register(client_socket, selectors.EVENT_READ, item)
+            except (ValueError, OSError) as e:
+                # Resumed at once: the worker's next read fails and closes the connection
+                logger.error(f"Failed to park a connection: {e}")
+                with self._lock:
+                    self._parked -= 1
+                self._resume(item)
+
+    def stats(self):
+        with self._lock:
+            return {"parked": self._parked, "peak_parked": self._peak_parked, "resumed": self._resumed}
@@ -0,0 +1,222 @@
+"""
+Multi-process server: a supervisor process and N worker processes, each
+running a complete server (any mode) on the same port.
+
+Where the platform has SO_REUSEPORT, every worker binds the port itself and
+the kernel spreads new connections across them. Elsewhere, or for port 0,
+the supervisor binds the port once and the workers inherit the listening
+socket and accept from it in turn.
+
+The workers share no memory: their clients and waiting messages live in a
+database every worker uses directly (see SharedStore), so a client may land
+on a different worker with every connection.
+
+The supervisor restarts a worker that dies, with a growing delay when it
+keeps dying right after it starts. SIGTERM or SIGINT stop the server: the
+workers stop accepting, finish their current requests (up to the drain
+timeout) and exit. SIGHUP restarts the workers one at a time, each replaced
+only once its successor accepts connections, so the port never goes dark.
+"""
+import multiprocessing
+import multiprocessing.connection
+import signal
+import socket
+import time
+
+from Logger import Log
+
+logger = Log(logger_name=__name__)
+
+
+class _Worker:
+    __slots__ = ("index", "process", "ready", "started", "failures", "restart_at")
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.ready = None
+        self.started = 0
+        self.failures = 0  # Consecutive exits within MIN_UPTIME
+        self.restart_at = 0
+
+
+class Supervisor:
+    """
+    Starts the worker processes and keeps them running until it is stopped.
+
+    A worker is a function called in a new process as
+    worker(index, listen_socket, ready, *args), where listen_socket is the
+    inherited listening socket or None if the worker must bind the port itself
+    with SO_REUSEPORT, and ready is the sending end of a pipe, on which it
+    sends True once it accepts connections. It must drain and return on
+    SIGTERM.
+    """
+    MIN_UPTIME = 5  # Seconds: a worker that exits sooner counts as crashing
+    MAX_BACKOFF = 30  # Seconds: the longest wait before restarting a crashing worker
+    READY_TIMEOUT = 30  # Seconds a replacement worker may take to start during a rolling restart
+    KILL_GRACE = 2  # Seconds on top of the drain timeout before a worker is killed
+
+    def __init__(self, worker, args, processes, host, port, drain_timeout):
+        """
+        Args:
+            worker (callable): The worker function, importable by name (it is called in a spawned process).
+            args (tuple): Extra arguments for the worker, picklable.
+            processes (int): The number of worker processes.
+            host (str): The address to listen on.
+            port (int): The port to listen on, 0 for any free port.
+            drain_timeout (float): Seconds a stopping worker may take to finish its requests.
+        """
+        if processes < 1:
+            raise ValueError(f"processes must be at least 1, got {processes}")
+        self._worker = worker
+        self._args = args
+        self._host = host
+        self._port = port
+        self._drain_timeout = drain_timeout
+        # Spawned, not forked: a forked worker would inherit the supervisor's logger threads and locks
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = [_Worker(index) for index in range(processes)]
+        self._listen_socket = None
+        self._stopping = False
+        self._reloading = False
+        self.restarts = 0
+
+    def run(self):
+        """Runs the workers until SIGTERM or SIGINT. Must be called from the main thread."""
+        if hasattr(socket, "SO_REUSEPORT") and self._port != 0:
+            logger.info(f"Workers share port [{self._port}] with SO_REUSEPORT")
+        else:
+            self._listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._listen_socket.bind((self._host, self._port))
+            self._listen_socket.listen()
+            self._port = self._listen_socket.getsockname()[1]
+            logger.info(f"Workers share the listening socket on [{self._host}:{self._port}]")
+
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self._request_reload)
+
+        for worker in self._workers:
+            self._start(worker)
+        logger.info(f"Started {len(self._workers)} workers, SIGHUP restarts them one at a time")
+
+        try:
+            while not self._stopping:
+                if self._reloading:
+                    self._reloading = False
+                    self._rolling_restart()
+                self._wait()
+                self._restart_exited()
+        finally:
+            self._stop_all()
+            if self._listen_socket is not None:
+                self._listen_socket.close()
+
+    def _request_stop(self, signum, frame):
+        self._stopping = True
+
+    def _request_reload(self, signum, frame):
+        self._reloading = True
+
+    def _spawn(self, index):
+        # A pipe rather than an Event: the resource tracker misreports semaphores of replaced spawned processes
+        ready, worker_end = self._context.Pipe(duplex=False)
+        process = self._context.Process(target=self._worker, name=f"server-worker-{index}",
+                                        args=(index, self._listen_socket, worker_end) + tuple(self._args))
+        process.start()
+        worker_end.close()
+        return process, ready
+
+    def _start(self, worker):
+        if worker.ready is not None:
+            worker.ready.close()
+        worker.process, worker.ready = self._spawn(worker.index)
+        worker.started = time.monotonic()
+        logger.info(f"Worker [{worker.index}] started with pid [{worker.process.pid}]")
+
+    def _wait(self):
+        # Sleeps until a worker exits, a restart is due or a signal flag may have been set
+        now = time.monotonic()
+        timeout = 0.5
+        sentinels = []
+        for worker in self._workers:
+            if worker.process is not None:
+                sentinels.append(worker.process.sentinel)
+            else:
+                timeout = min(timeout, max(0.0, worker.restart_at - now))
+        multiprocessing.connection.wait(sentinels, timeout)
+
+    def _restart_exited(self):
+        now = time.monotonic()
+        for worker in self._workers:
+            process = worker.process
+            if process is not None and not process.is_alive():
+                process.join()
+                uptime = now - worker.started
+                worker.failures = worker.failures + 1 if uptime < Supervisor.MIN_UPTIME else 0
+                delay = min(Supervisor.MAX_BACKOFF, 0.5 * 2 ** (worker.failures - 1)) if worker.failures else 0
+                worker.process = None
+                worker.restart_at = now + delay
+                logger.warning(f"Worker [{worker.index}] (pid [{process.pid}]) exited with code "
+                               f"[{process.exitcode}] after {uptime:.1f}s, restarting in {delay:.1f}s")
+            if worker.process is None and now >= worker.restart_at and not self._stopping:
+                self._start(worker)
+                self.restarts += 1
+
+    def _rolling_restart(self):
+        logger.info("Restarting the workers one at a time")
+        for worker in self._workers:
+            if self._stopping:
+                return
+            old = worker.process
+            process, ready = self._spawn(worker.index)
+            if not self._wait_ready(process, ready):
+                logger.error(f"Replacement of worker [{worker.index}] did not start within "
+                             f"{Supervisor.READY_TIMEOUT}s, keeping the old workers")
+                process.kill()
+                process.join()
+                ready.close()
+                return
+            worker.ready.close()
+            worker.process, worker.ready = process, ready
+            worker.started = time.monotonic()
+            worker.failures = 0
+            logger.info(f"Worker [{worker.index}] replaced by pid [{process.pid}]")
+            if old is not None:
+                self._stop_processes([old])
+        logger.info("All the workers were restarted")
+
+    @staticmethod
+    def _wait_ready(process, ready):
+        deadline = time.monotonic() + Supervisor.READY_TIMEOUT
+        while process.is_alive():
+            try:
+                if ready.poll(max(0.0, min(0.5, deadline - time.monotonic()))):
+                    return ready.recv()
+            except EOFError:  # The worker exited before it was ready
+                return False
+            if time.monotonic() >= deadline:
+                return False
+        return False
+
+    def _stop_all(self):
+        processes = [worker.process for worker in self._workers if worker.process is not None]
+        logger.info(f"Stopping {len(processes)} workers")
+        self._stop_processes(processes)
+        for worker in self._workers:
+            worker.process = None
+
+    def _stop_processes(self, processes):
+        # SIGTERM drains a worker; the ones still running after the drain timeout are killed
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self._drain_timeout + Supervisor.KILL_GRACE
+        for process in processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"Worker pid [{process.pid}] did not drain in time, killing it")
+                process.kill()
+                process.join()
@@ -1,104 +1,154 @@
 import socket
 import struct
 
+import Codec
 import Logger
+from RequestRegistry import RequestRegistry
 
 logger = Logger.Log(logger_name=__name__)
 
+_new_tuple = tuple.__new__  # Builds NamedTuples without calling their Python level __new__
+_unpack_header = Codec.HEADER.unpack_from
+_HEADER_SIZE = Codec.HEADER.size
+_parsers = RequestRegistry.parsers  # Code -> parse function, see RequestRegistry.register
+
 
 class Protocol:
     import struct
 
     # Constants for header and payload structure
-    HEADER_FORMAT = "16s B H I"  # 16 bytes for ID, 1 byte for version, 2 bytes for code, 4 bytes for size
-    HEADER_SIZE = struct.calcsize(HEADER_FORMAT)  # Calculate header size
+    # All fields are little-endian and packed (no alignment padding), as sent by the client
+    HEADER_FORMAT = Codec.HEADER.format  # 16 bytes for ID, 1 byte for version, 2 bytes for code, 4 bytes for size
+    HEADER_SIZE = Codec.HEADER.size
+
+    # Request codes
+    REGISTRATION_CODE = 600
+    USER_LIST_CODE = 601
+    PUBLIC_KEY_CODE = 602
+    SEND_MESSAGE_CODE = 603
+    PULL_MESSAGES_CODE = 604
 
     # Constants for request code 600 - Registration
-    REGISTRATION_FORMAT = "255s 160s"  # 255 bytes for name, 160 bytes for public key
-    REGISTRATION_SIZE = struct.calcsize(REGISTRATION_FORMAT)  # Calculate payload size for registration
+    REGISTRATION_FORMAT = Codec.REGISTRATION.format  # 255 bytes for name, 160 bytes for public key
+    REGISTRATION_SIZE = Codec.REGISTRATION.size
+
+    # Constants for request code 601 - User list: an optional query asks for the entries since a directory version
+    USER_LIST_QUERY_SIZE = Codec.USER_LIST_QUERY.size
+
+    # Constants for request code 602 - Public key request, code 603 - Send message
+    CLIENT_ID_SIZE = Codec.CLIENT_ID.size
+    MESSAGE_HEADER_SIZE = Codec.MESSAGE_HEADER.size
+
+    # Constants for request code 604 - Pull messages: an optional timeout turns the pull into a long poll
+    PULL_TIMEOUT_SIZE = Codec.PULL_TIMEOUT.size
+
+    # Constants for the response header
+    SERVER_VERSION = 2
+    RESPONSE_HEADER_FORMAT = Codec.RESPONSE_HEADER.format  # 1 byte for version, 2 bytes for code, 4 bytes for size
+    RESPONSE_HEADER_SIZE = Codec.RESPONSE_HEADER.size
+
+    # Response codes
+    REGISTRATION_SUCCESS_CODE = 2100
+    USER_LIST_RESPONSE_CODE = 2101
+    PUBLIC_KEY_RESPONSE_CODE = 2102
+    MESSAGE_SENT_CODE = 2103
+    WAITING_MESSAGES_CODE = 2104
+
+    # Response code 9000 - General error (also sent when the server is too busy to take the request)
+    # Responses are encoded in Response.py
+    ERROR_CODE = 9000
 
     @staticmethod
-    def parse_request(data):
+    def parse_header(data):
         """
-        Parses a binary request according to the described protocol.
+        Parses the fixed-size request header.
 
         Args:
-            data (bytes): The binary request data received.
+            data (bytes-like): At least HEADER_SIZE bytes of request data.
 
         Returns:
-            dict: Parsed request data including the header and payload.
+            Codec.RequestHeader: The header fields (client_id, version, code, payload_size).
         """
         if len(data) < Protocol.HEADER_SIZE:
-            raise ValueError(f"Data size {len(data)} does not match the expected header size: {Protocol.HEADER_SIZE}.")
+            raise ValueError(f"Data size {len(data)} is insufficient for the expected header size {Protocol.HEADER_SIZE}.")
 
-        # Parse the header
-        header = struct.unpack(Protocol.HEADER_FORMAT, data[:Protocol.HEADER_SIZE])
-        client_id = header[0]  # ID field (ignored by the server)
-        version = header[1]
-        code = header[2]
-        payload_size = header[3]
+        return _new_tuple(Codec.RequestHeader, _unpack_header(data))
 
-        # Ensure payload size matches the remaining data
-        if len(data) < Protocol.HEADER_SIZE + payload_size:
-            raise ValueError(
-                f"Data size {len(data)} does not match the expected payload size: {Protocol.HEADER_SIZE + payload_size}.")
+    @staticmethod
+    def build_request(client_id, version, code, payload=b""):
+        """
+        Builds a binary request, as sent by a client.
 
-        payload_data = data[Protocol.HEADER_SIZE:Protocol.HEADER_SIZE + payload_size]
+        Args:
+            client_id (bytes): The client ID (up to 16 bytes, padded with null bytes).
+            version (int): The client version.
+            code (int): The request code.
+            payload (bytes): The request payload.
 
-        payload = Protocol._parse_payload(payload_data, code)
+        Returns:
+            bytes: The header followed by the payload.
+        """
+        if len(client_id) > 16:
+            raise ValueError("Client ID must not exceed 16 bytes.")
 
-        return {
-            "header": {
-                "client_id": client_id,  # Ignored by server
-                "version": version,
-                "code": code,
-                "payload_size": payload_size,
-            },
-            "payload": payload,
-        }
+        return Codec.HEADER.pack(client_id, version, code, len(payload)) + payload
 
     @staticmethod
-    def _parse_payload(payload_data, code):
+    def parse_request(data):
+        """
+        Parses a binary request according to the described protocol.
 
-        # Parse payload based on the request code
-        if code == 600:  # Registration request
-            if len(payload_data) != Protocol.REGISTRATION_SIZE:
-                raise ValueError(
-                    f"Data size {len(payload_data)} does not match the expected for registration request: {Protocol.REGISTRATION_SIZE}.")
-        elif code == 601: # User list request
-            if len(payload_data) > 0:
-                raise ValueError(
-                    f"Data size {len(payload_data)} does not match the expected for user list request: {0}.")
-            return None
+        Args:
+            data (bytes-like): The binary request data received, header and payload.
 
-            return Protocol._parse_registration_payload(payload_data)
-        else:
+        Returns:
+            tuple: The parsed request, the Codec request tuple of its code (header fields, then payload fields).
+        """
+        size = len(data)
+        if size < _HEADER_SIZE:
+            raise ValueError(f"Data size {size} is insufficient for the expected header size {Protocol.HEADER_SIZE}.")
+        header = _unpack_header(data)
 
-            raise ValueError(f"Unsupported request code: {code}")
+        # Ensure payload size matches the remaining data
+        if size < _HEADER_SIZE + header[3]:
+            raise ValueError(
+                f"Data size {size} does not match the expected payload size: {Protocol.HEADER_SIZE + header[3]}.")
+
+        try:
+            parse = _parsers[header[2]]
+        except KeyError:
+            raise ValueError(f"Unsupported request code: {header[2]}") from None
+        return parse(header, data, _HEADER_SIZE)
 
     @staticmethod
-    def _parse_registration_payload(payload_data):
+    def parse_frame(header, payload_data):
         """
-        Parses the payload for a registration request (code 600).
+        Parses the payload of a request whose header was already parsed (see Framer.RequestFramer).
 
         Args:
-            payload_data (bytes): The payload data for the registration request.
+            header (Codec.RequestHeader): The parsed header.
+            payload_data (bytes-like): Exactly header.payload_size bytes of payload, or a Spool.SpooledPayload.
 
         Returns:
-            dict: Parsed payload data including the name and public key.
+            tuple: The parsed request, the Codec request tuple of its code (header fields, then payload fields).
         """
+        try:
+            parse = _parsers[header[2]]
+        except KeyError:
+            raise ValueError(f"Unsupported request code: {header[2]}") from None
+        return parse(header, payload_data)
 
-        name_raw, public_key_raw = struct.unpack(Protocol.REGISTRATION_FORMAT,payload_data)
-        # print(payload_data_raw)
-        # payload_data_raw.rstrip(b'\x00')
-        # name_raw, public_key_raw = struct.unpack(Protocol.REGISTRATION_FORMAT, payload_data)
-        name = name_raw.rstrip(b'\x00').decode('ascii')  # Remove null bytes and decode
-        public_key = public_key_raw.rstrip(b'\x00')  # Keep public key as bytes
-
-        return {
-            "name": name,
-            "public_key": public_key,
-        }
+    @staticmethod
+    def register_request_codes():
+        """
+        Registers the parser of every MessageU request code.
+        Handlers are attached separately (see Handlers.py).
+        """
+        RequestRegistry.register(Protocol.REGISTRATION_CODE, "registration request", Codec.parse_registration)
+        RequestRegistry.register(Protocol.USER_LIST_CODE, "user list request", Codec.parse_user_list)
+        RequestRegistry.register(Protocol.PUBLIC_KEY_CODE, "public key request", Codec.parse_public_key_request)
+        RequestRegistry.register(Protocol.SEND_MESSAGE_CODE, "send message request", Codec.parse_send_message)
+        RequestRegistry.register(Protocol.PULL_MESSAGES_CODE, "pull messages request", Codec.parse_pull_messages)
 
     # Example usage
     # data = receive_request_from_client()
@@ -176,6 +226,8 @@ class Protocol:
     #     logger.debug(f"code: {code}, data: {data}")
 
 
+Protocol.register_request_codes()
+
 # # Example usage
 # if __name__ == "__main__":
 #     # Create a sample request
@@ -0,0 +1,283 @@
+"""
+Idle and slow connection reaping.
+
+Connections carry no socket timeouts. Instead every connection has a
+ConnectionWatch, whose phase (waiting for a request, receiving one, being
+handled, sending a response) and deadline its handler updates with a single
+attribute store, and one Reaper per process checks the watches from a
+hashed timing wheel: scheduling a watch is an append to a wheel slot and
+every tick only looks at the slot the clock reached, so tens of thousands of
+connections cost O(1) each instead of one blocking timeout per thread.
+
+Deadlines move lazily. A handler never touches the wheel: when a slot comes
+due, the reaper compares each watch's current deadline with the clock and
+either reaps the connection or puts the watch back in the slot of its new
+deadline. A connection is reaped when it is
+
+- idle: no request started within the idle timeout after the previous one,
+- slow_request: a started request was not received within the request
+  timeout plus its size at MIN_TRANSFER_RATE (the slowloris case),
+- slow_reader: a response was not taken by the client within the request
+  timeout plus its size at MIN_TRANSFER_RATE,
+- drained: the server is draining and the connection was waiting for its
+  next request, with nothing of it received (see Reaper.close_idle).
+
+Requests being handled (a long-polling pull waits up to a minute) have no
+deadline.
+"""
+import threading
+import time
+
+from Logger import Log
+
+logger = Log(logger_name=__name__)
+
+REASON_IDLE = "idle"
+REASON_SLOW_REQUEST = "slow_request"
+REASON_SLOW_READER = "slow_reader"
+REASON_DRAINED = "drained"
+REASONS = (REASON_IDLE, REASON_SLOW_REQUEST, REASON_SLOW_READER, REASON_DRAINED)
+
+# Connection phases: (phase, deadline) for WAITING and SENDING, (phase, start) for RECEIVING, (phase, None) otherwise
+WAITING = 0
+RECEIVING = 1
+BUSY = 2
+SENDING = 3
+CLOSED = 4
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel: items scheduled at a time land in the slot of their tick, modulo the number of slots.
+
+    Not thread-safe on its own. An item scheduled more than a turn of the wheel ahead comes due early, once per
+    turn, so due() callers must check the item's actual deadline and schedule it again if it is not reached.
+    """
+    DEFAULT_TICK = 0.5  # Seconds
+    DEFAULT_SLOTS = 256  # A turn of 128 seconds with the default tick
+
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS, now=None):
+        """
+        Args:
+            tick (float): The resolution of the wheel, in seconds.
+            slots (int): The number of slots.
+            now (float, optional): The current time.monotonic() value.
+        """
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._current = int((time.monotonic() if now is None else now) / tick)
+        self.scheduled = 0
+
+    def schedule(self, when, item):
+        """Adds an item to the slot of the tick of when, or of the next tick if when has passed."""
+        tick = max(int(when / self.tick), self._current + 1)
+        self._slots[tick % len(self._slots)].append(item)
+        self.scheduled += 1
+
+    def due(self, now):
+        """
+        Advances the wheel to now.
+
+        Returns:
+            list: The items of every slot passed, removed from the wheel.
+        """
+        target = int(now / self.tick)
+        items = []
+        slots = self._slots
+        # After a long pause, one turn covers every slot
+        for tick in range(max(self._current + 1, target - len(slots) + 1), target + 1):
+            slot = slots[tick % len(slots)]
+            if slot:
+                items.extend(slot)
+                slot.clear()
+        self._current = max(self._current, target)
+        self.scheduled -= len(items)
+        return items
+
+
+class ConnectionWatch:
+    """
+    The reaping state of one connection. The connection's handler calls waiting(), receiving(), busy(), sending()
+    and closed() as it moves from phase to phase; they only store a new phase tuple, the reaper reads it.
+    """
+    __slots__ = ("phase", "reaped", "_framer", "_close", "_reaper", "_seen_phase", "_request_start")
+
+    def __init__(self, reaper, framer, close):
+        self._reaper = reaper
+        self._framer = framer
+        self._close = close
+        self.reaped = None  # The reason, once reaped
+        self._seen_phase = None  # The expired waiting phase in which the reaper found a request being received
+        self._request_start = 0.0
+        self.waiting()
+
+    def waiting(self):
+        """Waits for the next request, for up to the idle timeout."""
+        self.phase = (WAITING, time.monotonic() + self._reaper.idle_timeout)
+
+    def receiving(self):
+        """A request is partly received (event loops, which see every chunk). Keeps the start of the request."""
+        if self.phase[0] != RECEIVING:
+            self.phase = (RECEIVING, time.monotonic())
+
+    def busy(self):
+        """A request is being handled, however long that takes."""
+        self.phase = (BUSY, None)
+
+    def sending(self, size):
+        """A response of size bytes is being written."""
+        self.phase = (SENDING, time.monotonic() + self._reaper.transfer_time(size))
+
+    def closed(self):
+        """The connection ended; the reaper drops the watch when it next comes due."""
+        self.phase = (CLOSED, None)
+
+
+class Reaper:
+    """
+    Checks the connection watches of a process against their deadlines and closes the expired connections.
+
+    Something must call expire() every tick: run_thread() starts a thread that does, an event loop calls it from a
+    timer callback (see AsyncServer).
+    """
+    DEFAULT_REQUEST_TIMEOUT = 10  # Seconds for a request or response, on top of its size at MIN_TRANSFER_RATE
+    MIN_TRANSFER_RATE = 64 * 1024  # Bytes per second a client must at least send or read at
+
+    def __init__(self, idle_timeout, request_timeout=DEFAULT_REQUEST_TIMEOUT, tick=TimerWheel.DEFAULT_TICK):
+        """
+        Args:
+            idle_timeout (float): Seconds a connection may wait between requests.
+            request_timeout (float): Seconds a request or response may take, on top of its size at MIN_TRANSFER_RATE.
+            tick (float): The timing wheel resolution, in seconds.
+        """
+        self.idle_timeout = idle_timeout
+        self.request_timeout = request_timeout
+        self._wheel = TimerWheel(tick)
+        self._lock = threading.Lock()
+        self._watches = set()  # Every watch until it is dropped, for close_idle()
+        self._watched = 0
+        self._reaped = dict.fromkeys(REASONS, 0)
+        self._rescheduled = 0
+
+    def transfer_time(self, size):
+        """Returns the seconds a request or response of size bytes may take."""
+        return self.request_timeout + size / Reaper.MIN_TRANSFER_RATE
+
+    def watch(self, framer, close):
+        """
+        Starts watching a connection, waiting for its first request.
+
+        Args:
+            framer (RequestFramer): The connection's framer, to tell a request being received from an idle connection.
+            close (callable): Called with the reason to close the connection (from the reaper's thread or loop).
+
+        Returns:
+            ConnectionWatch: The connection's watch. Call closed() on it when the connection ends.
+        """
+        watch = ConnectionWatch(self, framer, close)
+        with self._lock:
+            self._wheel.schedule(watch.phase[1], watch)
+            self._watches.add(watch)
+            self._watched += 1
+        return watch
+
+    def expire(self, now=None):
+        """Reaps the connections past their deadline and schedules the other due watches again."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            due = self._wheel.due(now)
+        if not due:
+            return
+
+        later = []
+        dropped = []
+        for watch in due:
+            when = self._check(watch, now)
+            if when is None:
+                dropped.append(watch)
+            else:
+                later.append((when, watch))
+        with self._lock:
+            for when, watch in later:
+                self._wheel.schedule(when, watch)
+            self._watches.difference_update(dropped)
+            self._watched -= len(dropped)
+            self._rescheduled += len(later)
+
+    def _check(self, watch, now):
+        # Returns when to check the watch again, or None to drop it
+        phase = watch.phase
+        state, when = phase
+        if state == CLOSED:
+            return None
+        if state == BUSY:
+            return now + self.idle_timeout  # Only checked for a new phase now and then
+        if state == WAITING:
+            if when > now:
+                return when
+            if watch._framer.idle:
+                return self._reap(watch, REASON_IDLE)
+            # The request started at some point of this phase; its time counts from when it was first seen
+            if watch._seen_phase is not phase:
+                watch._seen_phase = phase
+                watch._request_start = now
+            start = watch._request_start
+        elif state == RECEIVING:
+            start = when
+        else:  # SENDING
+            return when if when > now else self._reap(watch, REASON_SLOW_READER)
+
+        # The allowed time grows once the request header tells its size
+        expected = watch._framer.expected_size
+        deadline = start + self.transfer_time(expected or 0)
+        if deadline > now:
+            return deadline
+        return self._reap(watch, REASON_SLOW_REQUEST)
+
+    def close_idle(self):
+        """
+        Closes every connection waiting for its next request with nothing of it received yet, when the server drains:
+        they would otherwise only see the drain once another request arrives. Connections in the middle of a request
+        are left to finish it.
+
+        Returns:
+            int: The number of connections closed.
+        """
+        with self._lock:
+            watches = list(self._watches)
+        closed = 0
+        for watch in watches:
+            if watch.reaped is None and watch.phase[0] == WAITING and watch._framer.idle:
+                self._reap(watch, REASON_DRAINED)
+                closed += 1
+        return closed
+
+    def _reap(self, watch, reason):
+        watch.reaped = reason
+        with self._lock:
+            self._reaped[reason] += 1
+        try:
+            watch._close(reason)
+        except Exception as e:
+            logger.error(f"Failed to close a connection reaped as [{reason}]: {e}")
+        return None
+
+    def run_thread(self):
+        """Calls expire() every tick on a daemon thread."""
+        def run():
+            while True:
+                time.sleep(self._wheel.tick)
+                self.expire()
+
+        threading.Thread(target=run, name="connection-reaper", daemon=True).start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "watched": self._watched,
+                "scheduled": self._wheel.scheduled,
+                "rescheduled": self._rescheduled,
+                "reaped": dict(self._reaped),
+                "idle_timeout_s": self.idle_timeout,
+                "request_timeout_s": self.request_timeout,
+            }
@@ -0,0 +1,301 @@
+"""
+Structured request log: one fixed-size binary record per handled request.
+
+The text log is built for people. This one is built for volume: a record is
+a single struct.pack of the request code, client ID, payload size, latency
+and outcome, and a log of millions of requests can be filtered and
+aggregated through mmap without reading it into memory.
+
+File layout: the 8 bytes MAGIC, then RECORD.size bytes records back to back.
+
+Reader usage (from the ServerDir folder):
+    python RequestLog.py requests.bin --stats
+    python RequestLog.py requests.bin --code 603 --outcome error --print
+    python RequestLog.py requests.bin --client 0123...ef --min-latency-us 1000 --print --limit 20
+"""
+import argparse
+import atexit
+import json
+import mmap
+import struct
+import sys
+import threading
+import time
+
+import Codec
+from Logger import Log
+from Metrics import Histogram
+from Protocol import Protocol
+
+logger = Log(logger_name=__name__)
+
+MAGIC = b"MUREQ\x00\x00\x01"
+
+# time, request code, client ID, payload size, latency (us), response code, response size, outcome
+RECORD = struct.Struct("<d H 16s I I H I B")
+
+OUTCOME_OK = 0
+OUTCOME_ERROR = 1  # The request was valid but refused (9000 response)
+OUTCOME_INVALID = 2  # The request could not be parsed
+OUTCOME_NO_RESPONSE = 3  # No handler sent a response
+OUTCOMES = {OUTCOME_OK: "ok", OUTCOME_ERROR: "error", OUTCOME_INVALID: "invalid", OUTCOME_NO_RESPONSE: "no_response"}
+
+
+class RequestLogWriter:
+    """
+    Appends records to a request log file. Thread-safe; records are buffered
+    and reach the file at least every flush_interval seconds while requests
+    keep coming, and on flush() / close().
+    """
+    BUFFER_SIZE = 256 * 1024
+
+    def __init__(self, filename, flush_interval=1.0):
+        """
+        Args:
+            filename (str): The log file, created with its header if missing, appended to otherwise.
+            flush_interval (float): The longest records stay buffered while requests keep coming, in seconds.
+
+        Raises:
+            ValueError: If the file exists but is not a request log.
+        """
+        self._file = open(filename, "ab", buffering=RequestLogWriter.BUFFER_SIZE)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        else:
+            with open(filename, "rb") as existing:
+                if existing.read(len(MAGIC)) != MAGIC:
+                    self._file.close()
+                    raise ValueError(f"'{filename}' is not a request log")
+
+        self.filename = filename
+        self._flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self.records = 0
+
+    def record(self, code, client_id, payload_size, latency_ns, response, outcome=None):
+        """
+        Appends the record of one request.
+
+        Args:
+            code (int): The request code.
+            client_id (bytes): The client ID from the request header.
+            payload_size (int): The request payload size.
+            latency_ns (int): Time from the complete frame to the response being ready, in nanoseconds.
+            response (list, optional): The response buffers, None if there was no response.
+            outcome (int, optional): One of the OUTCOME_ constants, derived from the response code by default.
+        """
+        if response:
+            _, response_code, response_size = Codec.RESPONSE_HEADER.unpack_from(response[0])
+        else:
+            response_code, response_size = 0, 0
+        if outcome is None:
+            if not response:
+                outcome = OUTCOME_NO_RESPONSE
+            else:
+                outcome = OUTCOME_ERROR if response_code == Protocol.ERROR_CODE else OUTCOME_OK
+
+        data = RECORD.pack(time.time(), code, client_id, payload_size, min(latency_ns // 1000, 0xFFFFFFFF),
+                           response_code, response_size, outcome)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(data)
+            self.records += 1
+            now = time.monotonic()
+            if now - self._last_flush >= self._flush_interval:
+                self._file.flush()
+                self._last_flush = now
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# The process request log, None unless enable() was called. The servers record every request into it.
+writer = None
+
+
+def enable(filename, flush_interval=1.0):
+    """
+    Starts recording every handled request to a file. The file is closed at exit.
+
+    Args:
+        filename (str): The log file.
+        flush_interval (float): The longest records stay buffered, in seconds.
+    """
+    global writer
+    if writer is None:
+        writer = RequestLogWriter(filename, flush_interval)
+        atexit.register(disable)
+        logger.info(f"Recording requests to '{filename}'")
+
+
+def disable():
+    """Stops recording and closes the file."""
+    global writer
+    current, writer = writer, None
+    if current is not None:
+        current.close()
+
+
+# Reader
+
+def open_records(filename):
+    """
+    Maps a request log into memory.
+
+    Args:
+        filename (str): The log file.
+
+    Returns:
+        tuple: The mmap object (close it when done) and a memoryview over the complete records.
+
+    Raises:
+        ValueError: If the file is not a request log.
+    """
+    with open(filename, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"'{filename}' is not a request log")
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    body_size = (len(mapped) - len(MAGIC)) // RECORD.size * RECORD.size  # Ignores a torn last record
+    return mapped, memoryview(mapped)[len(MAGIC):len(MAGIC) + body_size]
+
+
+def iter_records(records, code=None, client_id=None, outcome=None, min_latency_us=0, since=None, until=None):
+    """
+    Yields the records that match every given filter, oldest first.
+
+    Args:
+        records (memoryview): The records, as returned by open_records.
+        code (int, optional): Only this request code.
+        client_id (bytes, optional): Only this client.
+        outcome (int, optional): Only this outcome.
+        min_latency_us (int): Only requests at least this slow.
+        since (float, optional): Only records from this time on (seconds since the epoch).
+        until (float, optional): Only records before this time.
+
+    Yields:
+        tuple: (time, code, client_id, payload_size, latency_us, response_code, response_size, outcome)
+    """
+    for record in RECORD.iter_unpack(records):
+        if code is not None and record[1] != code:
+            continue
+        if client_id is not None and record[2] != client_id:
+            continue
+        if outcome is not None and record[7] != outcome:
+            continue
+        if record[4] < min_latency_us:
+            continue
+        if since is not None and record[0] < since:
+            continue
+        if until is not None and record[0] >= until:
+            continue
+        yield record
+
+
+def record_to_dict(record):
+    timestamp, code, client_id, payload_size, latency_us, response_code, response_size, outcome = record
+    return {"time": timestamp, "code": code, "client_id": client_id.hex(), "payload_size": payload_size,
+            "latency_us": latency_us, "response_code": response_code, "response_size": response_size,
+            "outcome": OUTCOMES.get(outcome, str(outcome))}
+
+
+def aggregate(records):
+    """
+    Summarizes records per request code, in constant memory: counters, and a Metrics.Histogram of the latencies
+    per code, so percentiles are exact to within 1/Histogram.SUB_BUCKETS.
+
+    Args:
+        records (iterable): Records as yielded by iter_records.
+
+    Returns:
+        dict: Request code -> count, outcome counts, bytes in and out and latency percentiles (us).
+    """
+    latencies = {}
+    summary = {}
+    for _, code, _, payload_size, latency_us, _, response_size, outcome in records:
+        entry = summary.get(code)
+        if entry is None:
+            entry = summary[code] = {"count": 0, "bytes_in": 0, "bytes_out": 0,
+                                     "outcomes": {name: 0 for name in OUTCOMES.values()}}
+            latencies[code] = Histogram()
+        entry["count"] += 1
+        entry["bytes_in"] += payload_size
+        entry["bytes_out"] += response_size
+        outcome_name = OUTCOMES.get(outcome, str(outcome))
+        entry["outcomes"][outcome_name] = entry["outcomes"].get(outcome_name, 0) + 1
+        latencies[code].record(latency_us)
+
+    for code, histogram in latencies.items():
+        summary[code].update({
+            "p50_us": histogram.percentile(0.5),
+            "p99_us": histogram.percentile(0.99),
+            "max_us": histogram.max,
+        })
+    return summary
+
+
+def _printed(records, limit):
+    # Prints the records as JSON lines while passing them on, up to limit of them
+    for count, record in enumerate(records):
+        if limit is not None and count >= limit:
+            break
+        print(json.dumps(record_to_dict(record)))
+        yield record
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Filter and summarize a MessageU request log")
+    parser.add_argument("filename")
+    parser.add_argument("--code", type=int, default=None, help="Only this request code")
+    parser.add_argument("--client", default=None, help="Only this client ID (hex)")
+    parser.add_argument("--outcome", choices=list(OUTCOMES.values()), default=None, help="Only this outcome")
+    parser.add_argument("--min-latency-us", type=int, default=0, help="Only requests at least this slow")
+    parser.add_argument("--since", type=float, default=None, help="Only records from this UNIX time on")
+    parser.add_argument("--until", type=float, default=None, help="Only records before this UNIX time")
+    parser.add_argument("--print", action="store_true", help="Print the matching records as JSON lines")
+    parser.add_argument("--limit", type=int, default=None, help="Print at most this many records")
+    parser.add_argument("--stats", action="store_true", help="Print per-code totals and latency percentiles")
+    args = parser.parse_args()
+
+    outcome = None
+    if args.outcome is not None:
+        outcome = next(value for value, name in OUTCOMES.items() if name == args.outcome)
+    client_id = bytes.fromhex(args.client) if args.client else None
+
+    try:
+        mapped, records = open_records(args.filename)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    matches = iter_records(records, args.code, client_id, outcome, args.min_latency_us, args.since, args.until)
+    try:
+        if args.print:
+            # With --stats too, the totals cover the printed records
+            printed = _printed(matches, args.limit)
+            if args.stats:
+                print(json.dumps(aggregate(printed), indent=2))
+            else:
+                for _ in printed:
+                    pass
+            printed.close()
+        else:
+            print(json.dumps(aggregate(matches), indent=2))
+    finally:
+        matches.close()  # Drops the generator's reference to the mapped records
+        records.release()
+        mapped.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
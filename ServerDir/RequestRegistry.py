@@ -0,0 +1,125 @@
+from typing import Callable, NamedTuple, Optional
+
+import Codec
+from Logger import Log
+
+logger = Log(logger_name=__name__)
+
+
+class RequestEntry(NamedTuple):
+    name: str
+    # parse(header, buffer, offset) checks the payload and returns the request tuple, see the parsers in Codec
+    parse: Callable
+    handler: Optional[Callable]  # Called with the parsed request, returns the response (or None, or a Handlers.LongPoll)
+
+
+class RequestRegistry:
+    """
+    Table of the supported request codes.
+
+    Each code maps to its parser and handler, so both parsing and dispatch are
+    a single dict lookup. Codes can be added, and handlers replaced, at runtime
+    without touching the parser. A code is registered with a parser of its own
+    (the MessageU codes, see Codec), or with a payload schema that a generic
+    parser checks.
+    """
+    entries = {}
+    parsers = {}  # Code -> the parse function of its entry, read by every request
+
+    @staticmethod
+    def register(code, name, parse=None, min_size=0, max_size=None, decode=None, validate=None, handler=None):
+        """
+        Adds or replaces the entry for a request code.
+
+        Args:
+            code (int): The request code.
+            name (str): A readable name for logs and errors.
+            parse (callable, optional): parse(header, buffer, offset) returns the request tuple. Built from the
+                payload schema below if not given.
+            min_size (int): The smallest accepted payload size.
+            max_size (int, optional): The largest accepted payload size, None for no limit.
+            decode (callable, optional): Turns the payload bytes into a payload object.
+            validate (callable, optional): Raises ValueError for a malformed payload.
+            handler (callable, optional): Handles the parsed request.
+        """
+        if parse is None:
+            parse = RequestRegistry.schema_parser(name, min_size, max_size, decode, validate)
+        RequestRegistry.entries[code] = RequestEntry(name, parse, handler)
+        RequestRegistry.parsers[code] = parse
+
+    @staticmethod
+    def schema_parser(name, min_size=0, max_size=None, decode=None, validate=None):
+        """
+        Builds the parser of a payload schema.
+
+        Args:
+            name (str): The request name, for errors.
+            min_size (int): The smallest accepted payload size.
+            max_size (int, optional): The largest accepted payload size, None for no limit.
+            decode (callable, optional): Turns the payload bytes into a payload object, None for no payload object.
+            validate (callable, optional): Raises ValueError for a malformed payload.
+
+        Returns:
+            callable: parse(header, buffer, offset).
+        """
+        def parse(header, buffer, offset=0):
+            payload_data = memoryview(buffer)[offset:offset + header[3]]
+            RequestRegistry.check_size(name, min_size, max_size, len(payload_data))
+            if validate is not None:
+                validate(payload_data)
+            return Codec.Request(*header, decode(payload_data) if decode is not None else None)
+
+        return parse
+
+    @staticmethod
+    def set_handler(code, handler):
+        """
+        Replaces the handler of an already registered request code.
+
+        Args:
+            code (int): The request code.
+            handler (callable): Handles the parsed request.
+        """
+        RequestRegistry.entries[code] = RequestRegistry.get(code)._replace(handler=handler)
+
+    @staticmethod
+    def get(code):
+        """
+        Returns the entry of a request code.
+
+        Raises:
+            ValueError: If the code is not registered.
+        """
+        entry = RequestRegistry.entries.get(code)
+        if entry is None:
+            raise ValueError(f"Unsupported request code: {code}")
+        return entry
+
+    @staticmethod
+    def check_size(name, min_size, max_size, payload_size):
+        """
+        Raises ValueError if a payload size is outside min_size and max_size (None for no limit).
+        """
+        if payload_size < min_size or (max_size is not None and payload_size > max_size):
+            if min_size == max_size:
+                raise ValueError(f"Data size {payload_size} does not match the expected for {name}: {min_size}.")
+            if payload_size < min_size:
+                raise ValueError(f"Data size {payload_size} is insufficient for {name}: {min_size}.")
+            raise ValueError(f"Data size {payload_size} exceeds the maximum for {name}: {max_size}.")
+
+    @staticmethod
+    def dispatch(request):
+        """
+        Calls the handler registered for the request's code.
+
+        Args:
+            request (tuple): The parsed request, a Codec request tuple.
+
+        Returns:
+            The handler's response, or None if the code has no handler.
+        """
+        entry = RequestRegistry.get(request.code)
+        if entry.handler is None:
+            logger.warning(f"No handler registered for request code [{request.code}] ({entry.name})")
+            return None
+        return entry.handler(request)
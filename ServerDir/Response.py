@@ -0,0 +1,197 @@
+"""
+Response encoder for codes 2100-2104 and 9000.
+
+A response is a list of buffers: the 7 bytes header followed by the payload
+parts. Headers of fixed-size responses are packed once at import. Large parts
+such as message contents are passed through as they are, and send() writes
+the whole list with socket.sendmsg, so they are never copied into one big
+buffer. Message contents spooled to disk are sent straight from their file
+with sendfile.
+"""
+import os
+import socket
+
+import Codec
+from Protocol import Protocol
+from Spool import SpooledContent
+
+
+def _pack_header(code, payload_size):
+    return Codec.RESPONSE_HEADER.pack(Protocol.SERVER_VERSION, code, payload_size)
+
+
+# Pre-packed headers of the responses whose payload size never changes
+_REGISTRATION_SUCCESS_HEADER = _pack_header(Protocol.REGISTRATION_SUCCESS_CODE, Codec.CLIENT_ID.size)
+_PUBLIC_KEY_HEADER = _pack_header(Protocol.PUBLIC_KEY_RESPONSE_CODE, Codec.PUBLIC_KEY_RESPONSE.size)
+_MESSAGE_SENT_HEADER = _pack_header(Protocol.MESSAGE_SENT_CODE, Codec.MESSAGE_SENT.size)
+_ERROR = _pack_header(Protocol.ERROR_CODE, 0)
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+_HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+
+class FileResponse(list):
+    """Response buffers of which some are Spool.SpooledContent, to be sent from their files."""
+    __slots__ = ()
+
+
+def registration_success(client_id):
+    """Registration succeeded (code 2100), with the new client ID."""
+    return [_REGISTRATION_SUCCESS_HEADER, client_id]
+
+
+def user_list(users):
+    """
+    User list (code 2101).
+
+    Args:
+        users (iterable): (client_id, name) pairs, name as bytes.
+
+    Returns:
+        list: The response buffers.
+    """
+    users = list(users)
+    entries = bytearray(len(users) * Codec.USER_ENTRY.size)
+    for i, (client_id, name) in enumerate(users):
+        Codec.USER_ENTRY.pack_into(entries, i * Codec.USER_ENTRY.size, client_id, name)
+    return [_pack_header(Protocol.USER_LIST_RESPONSE_CODE, len(entries)), entries]
+
+
+def encoded_user_list(entries, size):
+    """
+    User list (code 2101) from entries that are already encoded (see UserDirectory).
+
+    Args:
+        entries (list): Buffers of packed Codec.USER_ENTRY entries, sent as they are.
+        size (int): Their total size in bytes.
+
+    Returns:
+        list: The response buffers.
+    """
+    return [_pack_header(Protocol.USER_LIST_RESPONSE_CODE, size)] + entries
+
+
+def user_list_page(entries, size, next_version, version):
+    """
+    User list (code 2101) answering a user list query: the Codec.USER_LIST_PAGE versions, then the entries.
+
+    Args:
+        entries (list): Buffers of packed Codec.USER_ENTRY entries, sent as they are.
+        size (int): Their total size in bytes.
+        next_version (int): The version to ask for next.
+        version (int): The current version of the directory. The client is up to date once it reaches it.
+
+    Returns:
+        list: The response buffers.
+    """
+    page = Codec.USER_LIST_PAGE.pack(next_version, version)
+    return [_pack_header(Protocol.USER_LIST_RESPONSE_CODE, len(page) + size), page] + entries
+
+
+def public_key(client_id, key):
+    """Public key of a client (code 2102)."""
+    return [_PUBLIC_KEY_HEADER, Codec.PUBLIC_KEY_RESPONSE.pack(client_id, key)]
+
+
+def message_sent(client_id, message_id):
+    """Message stored for its recipient (code 2103)."""
+    return [_MESSAGE_SENT_HEADER, Codec.MESSAGE_SENT.pack(client_id, message_id)]
+
+
+def waiting_messages(messages):
+    """
+    Waiting messages (code 2104).
+
+    Args:
+        messages (iterable): Objects with sender_id, message_id, message_type and content attributes.
+
+    Returns:
+        list: The response buffers. Every message content is its own buffer. A FileResponse if some are spooled.
+    """
+    buffers = [None]
+    payload_size = 0
+    spooled = False
+    for message in messages:
+        entry_header = Codec.MESSAGE_ENTRY_HEADER.pack(
+            message.sender_id, message.message_id, message.message_type, len(message.content))
+        buffers.append(entry_header)
+        buffers.append(message.content)
+        payload_size += len(entry_header) + len(message.content)
+        if type(message.content) is SpooledContent:
+            spooled = True
+
+    buffers[0] = _pack_header(Protocol.WAITING_MESSAGES_CODE, payload_size)
+    return FileResponse(buffers) if spooled else buffers
+
+
+def error():
+    """General error (code 9000)."""
+    return [_ERROR]
+
+
+def size(buffers):
+    """Returns the total number of bytes in a response."""
+    return sum(len(buffer) for buffer in buffers)
+
+
+def send(client_socket, buffers):
+    """
+    Writes all the buffers of a response to a blocking socket.
+
+    Uses scatter/gather sendmsg calls (at most IOV_MAX buffers each) and
+    resumes after partial writes. Falls back to sendall per buffer where
+    sendmsg is not available (Windows).
+
+    Args:
+        client_socket (socket.socket): The connection.
+        buffers (list): The response buffers.
+    """
+    if type(buffers) is FileResponse:
+        _send_with_files(client_socket, buffers)
+        return
+
+    if not _HAS_SENDMSG:
+        for buffer in buffers:
+            client_socket.sendall(buffer)
+        return
+
+    pending = [memoryview(buffer).cast("B") for buffer in buffers if len(buffer)]
+    index = 0
+    while index < len(pending):
+        sent = client_socket.sendmsg(pending[index:index + IOV_MAX])
+        while sent:
+            remaining = len(pending[index])
+            if sent >= remaining:
+                sent -= remaining
+                index += 1
+            else:
+                pending[index] = pending[index][sent:]
+                sent = 0
+
+
+def _send_with_files(client_socket, buffers):
+    pending = []
+    try:
+        for buffer in buffers:
+            if type(buffer) is SpooledContent:
+                if pending:
+                    send(client_socket, pending)
+                    pending = []
+                buffer.send(client_socket)
+            else:
+                pending.append(buffer)
+        if pending:
+            send(client_socket, pending)
+    finally:
+        discard_files(buffers)
+
+
+def discard_files(buffers):
+    """Deletes the spool files of a sent (or failed) FileResponse: the pulled messages have no other owner."""
+    for buffer in buffers:
+        if type(buffer) is SpooledContent:
+            buffer.discard()
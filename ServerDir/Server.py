@@ -1,9 +1,42 @@
+import select
+import signal
 import socket
+import time
 from threading import Thread
 
-from Protocol import Protocol
+from AsyncServer import AsyncServer
+from BufferPool import BufferPool
+from Framer import RequestFramer
+import Handlers  # Attaches the default request handlers to RequestRegistry
+from Reaper import REASON_DRAINED, Reaper
+import Response
+import Spool
 from IO_Handler import read_port_from_file
 from Logger import Log
+from MessageStore import MessageStore
+import Metrics
+from Parker import ConnectionParker
+from SqliteStore import SqliteStore
+import Tracing
+from WorkerPool import WorkerPool
+
+_MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)  # Not on Windows, select() tells readability there
+
+
+class DrainRequested(BaseException):
+    """Raised in the main thread by SIGTERM when the server drains on it (see Server.start_server)."""
+
+
+class Connection:
+    """The state of one client connection kept between its requests, so that in pool mode any worker can serve it."""
+    __slots__ = ("socket", "framer", "watch", "accepted_ns", "requests_handled")
+
+    def __init__(self, client_socket, framer, watch, accepted_ns=None):
+        self.socket = client_socket
+        self.framer = framer
+        self.watch = watch
+        self.accepted_ns = accepted_ns
+        self.requests_handled = 0
 
 
 class Server:
@@ -12,50 +45,383 @@ class Server:
     PORT = read_port_from_file(PORT_FILENAME)
     logger = Log(logger_name=__name__)
 
+    # Server backends: a thread per connection, a fixed worker pool, or a single asyncio event loop
+    MODE_THREADED = "threaded"
+    MODE_POOL = "pool"
+    MODE_ASYNC = "async"
+    MODES = (MODE_THREADED, MODE_POOL, MODE_ASYNC)
+
+    # Worker pool sizing for MODE_POOL: connections beyond MAX_WORKERS + QUEUE_DEPTH are rejected. Workers only
+    # serve connections with a request waiting: idle ones wait in the parker, without a worker
+    MAX_WORKERS = 32
+    QUEUE_DEPTH = 128
+    pool = None
+    parker = None
+
+    # Persistent connections: a client may send many requests on one connection
+    IDLE_TIMEOUT = 30  # Seconds to wait for the next request before closing the connection
+    REQUEST_TIMEOUT = Reaper.DEFAULT_REQUEST_TIMEOUT  # Seconds to receive a request or send a response (plus size)
+    MAX_REQUESTS_PER_CONNECTION = 1000
+    MAX_PAYLOAD_SIZE = RequestFramer.DEFAULT_MAX_PAYLOAD_SIZE
+
+    # Closes idle and slow connections (see Reaper), no socket has a timeout
+    reaper = None
+
+    # Optional SQLite persistence of clients and waiting messages (off unless a database file is given)
+    store = None
+
+    # Request payload buffers are borrowed from a pool shared by all the connections (0 bytes: no pool)
+    BUFFER_POOL_BYTES = BufferPool.DEFAULT_MAX_BYTES
+    buffer_pool = None
+
+    # Send message contents above this size are spooled to disk instead of memory (None: never, see Spool)
+    SPOOL_THRESHOLD = Spool.DEFAULT_THRESHOLD
+
+    # Set when the server stops accepting connections: connections close after their current request
+    draining = False
+
     @staticmethod
-    def start_server():
+    def start_server(mode=MODE_THREADED, host=None, port=None, max_workers=None, queue_depth=None,
+                     idle_timeout=None, max_requests=None, db_filename=None, ready=None, listen_socket=None,
+                     reuse_port=False, drain_timeout=None, buffer_pool_bytes=None, spool_threshold=None,
+                     spool_dir=None, request_timeout=None, message_ttl=None, message_log=None, queue_cap=None,
+                     queue_overflow=None):
+        """
+        Runs the server until it is interrupted.
+
+        Args:
+            mode (str): One of MODES.
+            host (str, optional): The address to bind, LOCAL_HOST by default.
+            port (int, optional): The port to bind, PORT by default. 0 binds any free port.
+            max_workers (int, optional): Worker threads in MODE_POOL.
+            queue_depth (int, optional): Connections that may wait for a worker in MODE_POOL.
+            idle_timeout (float, optional): Seconds to wait for the next request on a connection.
+            max_requests (int, optional): Requests served before a connection is closed.
+            db_filename (str, optional): SQLite database to keep clients and waiting messages in.
+            ready (callable, optional): Called with the bound (host, port) once the server accepts connections.
+            listen_socket (socket.socket, optional): An already listening socket to accept from, instead of binding.
+            reuse_port (bool): Bind with SO_REUSEPORT, so several processes can listen on the same port.
+            drain_timeout (float, optional): If given, SIGTERM drains the server instead of killing it: it stops
+                accepting, lets the open connections finish their current request for up to this many seconds,
+                and returns. Must be called from the main thread then.
+            buffer_pool_bytes (int, optional): The most memory pooled request buffers may take, 0 for no pool.
+            spool_threshold (int, optional): Spool send message contents larger than this to disk, 0 never to.
+                Spooling is off with a database, which stores contents as blobs.
+            spool_dir (str, optional): Where spool files are written, a temporary folder by default.
+            request_timeout (float, optional): Seconds a client may take to send a request or read a response, on
+                top of its size at Reaper.MIN_TRANSFER_RATE. Slower connections are closed.
+            message_ttl (float, optional): Seconds a message waits to be pulled before it is dropped. Forever by
+                default. Messages loaded from the database start a new TTL.
+            message_log (str, optional): Keep the waiting messages in an append-only log in this folder (see
+                LogStore) instead of in memory. The database then only keeps the clients. No TTL.
+            queue_cap (int, optional): Content bytes a recipient's queue may hold in memory, see MessageStore.
+            queue_overflow (str, optional): What happens to messages beyond the queue cap: MessageStore.OVERFLOW_REJECT
+                (the default) or MessageStore.OVERFLOW_SPILL to disk. The message log always rejects them.
+        """
+        host = host or Server.LOCAL_HOST
+        port = Server.PORT if port is None else port
+        Server.IDLE_TIMEOUT = idle_timeout or Server.IDLE_TIMEOUT
+        Server.MAX_REQUESTS_PER_CONNECTION = max_requests or Server.MAX_REQUESTS_PER_CONNECTION
+        Server.REQUEST_TIMEOUT = request_timeout or Server.REQUEST_TIMEOUT
+        Server.BUFFER_POOL_BYTES = Server.BUFFER_POOL_BYTES if buffer_pool_bytes is None else buffer_pool_bytes
+        if spool_threshold is not None:
+            Server.SPOOL_THRESHOLD = spool_threshold or None
+
+        if mode not in Server.MODES:
+            Server.logger.error(f"Unknown server mode [{mode}], expected one of {Server.MODES}")
+            return
+
+        if queue_overflow == MessageStore.OVERFLOW_SPILL and message_log:
+            Server.logger.warning("The message log is on disk already, messages beyond the queue cap are rejected")
+        elif queue_cap or queue_overflow:
+            try:
+                Handlers.configure_queues(queue_cap, queue_overflow)
+            except ValueError as e:
+                Server.logger.error(e)
+                return
+
+        if message_log:
+            try:
+                Handlers.use_log_store(message_log, queue_cap)
+            except Exception as e:
+                Server.logger.error(f"Failed to open the message log '{message_log}': {e}")
+                return
+            if message_ttl:
+                Server.logger.warning("The message log keeps messages until they are pulled, ignoring the TTL")
+                message_ttl = None
+
+        if message_ttl:
+            Handlers.expire_messages(message_ttl)
+
+        if db_filename:
+            try:
+                Server.store = SqliteStore(db_filename)
+                Handlers.attach_journal(Server.store, with_messages=not message_log)
+                Metrics.add_source("sqlite", Server.store.stats)
+            except Exception as e:
+                Server.logger.error(f"Failed to open the database '{db_filename}': {e}")
+                return
+            if Server.SPOOL_THRESHOLD is not None and not message_log:
+                Server.logger.info("Message spooling is off: the database stores message contents itself")
+                Server.SPOOL_THRESHOLD = None
+
+        if Server.SPOOL_THRESHOLD is not None:
+            Spool.configure(spool_dir)
+            Metrics.add_source("spool", Spool.stats)
+
+        if Server.BUFFER_POOL_BYTES:
+            Server.buffer_pool = BufferPool(max_bytes=Server.BUFFER_POOL_BYTES)
+            Metrics.add_source("buffer_pool", Server.buffer_pool.stats)
+
         try:
-            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if mode == Server.MODE_ASYNC:
+                AsyncServer.start_server(host, port, Server.IDLE_TIMEOUT, Server.MAX_REQUESTS_PER_CONNECTION,
+                                         Server.MAX_PAYLOAD_SIZE, ready, listen_socket, reuse_port, drain_timeout,
+                                         Server.buffer_pool, Server.SPOOL_THRESHOLD, Server.REQUEST_TIMEOUT)
+            else:
+                if drain_timeout is not None:
+                    signal.signal(signal.SIGTERM, Server._request_drain)
+                Server.serve_threaded(mode, host, port, max_workers, queue_depth, ready, listen_socket, reuse_port)
+        except DrainRequested:
+            Server.drain(drain_timeout)
+        finally:
+            if message_log:
+                Handlers.messages.close()
+            if Server.store:
+                Server.logger.debug("Commit pending writes to the database")
+                Server.store.close()
 
-            host = Server.LOCAL_HOST
-            port = Server.PORT
+    @staticmethod
+    def serve_threaded(mode, host, port, max_workers, queue_depth, ready=None, listen_socket=None, reuse_port=False):
+        server_socket = listen_socket
+        try:
+            if server_socket is None:
+                server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                if reuse_port:
+                    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
-            server_socket.bind((host, port))
-            server_socket.listen()
+                server_socket.bind((host, port))
+                server_socket.listen()
+            host, port = server_socket.getsockname()[:2]
 
             Server.logger.info(f"Server listening on [{host}:{port}]")
 
-            Server.run(server_socket)
+            Server.reaper = Reaper(Server.IDLE_TIMEOUT, Server.REQUEST_TIMEOUT)
+            Server.reaper.run_thread()
+            Metrics.add_source("reaper", Server.reaper.stats)
+
+            if mode == Server.MODE_POOL:
+                Server.pool = WorkerPool(Server.handle_pooled_client,
+                                         max_workers=max_workers or Server.MAX_WORKERS,
+                                         queue_depth=queue_depth or Server.QUEUE_DEPTH,
+                                         name="client")
+                Metrics.add_source("worker_pool", Server.pool.stats)
+                Server.parker = ConnectionParker(Server.resume_parked)
+                Metrics.add_source("parker", Server.parker.stats)
+                if ready:
+                    ready(host, port)
+                Server.run_pool(server_socket, Server.pool)
+            else:
+                if ready:
+                    ready(host, port)
+                Server.run(server_socket)
 
             Server.logger.debug("Close server")
             server_socket.close()
 
+        except DrainRequested:
+            Server.logger.info("Stop accepting connections")
+            server_socket.close()
+            raise
         except Exception as e:
             Server.logger.error(e)
 
+    @staticmethod
+    def _request_drain(signum, frame):
+        raise DrainRequested()
+
+    @staticmethod
+    def drain(timeout):
+        """
+        Closes the idle connections and waits for the others to finish their current request, for up to timeout
+        seconds.
+
+        Args:
+            timeout (float): The longest wait, in seconds.
+        """
+        Server.draining = True
+        closed = Server.reaper.close_idle() if Server.reaper is not None else 0
+        if closed:
+            Server.logger.info(f"Closed {closed} idle connections")
+        deadline = time.monotonic() + timeout
+        while Metrics.active_connections() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        remaining = Metrics.active_connections()
+        if remaining:
+            Server.logger.warning(f"Drain timed out after {timeout}s with {remaining} connections still open")
+        else:
+            Server.logger.info("All connections drained")
+
     @staticmethod
     def run(server_socket):
         while True:
             client_socket, address = server_socket.accept()
-            Server.logger.info(f"Connection from [{address}]")
+            accepted_ns = time.perf_counter_ns()
+            Server.logger.info("Connection from [%s]", address)
 
             # Server.logger.debug(f"client_socket: {client_socket}")
-            Thread(target=Server.handle_client, args=(client_socket,)).start()
+            Thread(target=Server.handle_client, args=(client_socket, accepted_ns), daemon=True).start()
 
     @staticmethod
-    def handle_client(client_socket):
-        try:
-            Server.logger.debug("Parse the request from socket")
-            data = client_socket.recv(Protocol.HEADER_SIZE + Protocol.REGISTRATION_SIZE)
-            parsed_request = Protocol.parse_request(data)
+    def run_pool(server_socket, pool):
+        while True:
+            client_socket, address = server_socket.accept()
+            accepted_ns = time.perf_counter_ns()
+            Server.logger.info("Connection from [%s]", address)
 
-            Server.logger.info(f"Request with code [{parsed_request['header']['code']}] was successfully decrypted.")
-            Server.logger.debug(f"Header: {parsed_request['header']}")
-            Server.logger.debug(f"Payload: {parsed_request['payload']}")
+            if not pool.submit((client_socket, accepted_ns)):
+                stats = pool.stats()
+                Server.logger.warning(f"Server busy, rejecting [{address}] "
+                                      f"(queue depth: {stats['queue_depth']}, rejected: {stats['rejected']})")
+                Metrics.connection_rejected()
+                Server.reject_client(client_socket)
 
-        except ValueError as e:
+    @staticmethod
+    def reject_client(client_socket):
+        try:
+            Response.send(client_socket, Response.error())
+        except OSError as e:
             Server.logger.error(e)
+        finally:
+            client_socket.close()
+
+    @staticmethod
+    def handle_pooled_client(item):
+        # A new (socket, accepted_ns) pair, or a connection the parker found readable again
+        connection = item if type(item) is Connection else Server.open_connection(*item)
+        Server.serve_connection(connection, park=True)
+
+    @staticmethod
+    def resume_parked(connection):
+        # On the parker thread: must not block
+        if not Server.pool.submit(connection):
+            Server.logger.warning("Server busy, closing a connection whose next request arrived")
+            Metrics.connection_rejected()
+            try:
+                Response.send(connection.socket, Response.error())
+            except OSError as e:
+                Server.logger.error(e)
+            Server.close_connection(connection)
+
+    @staticmethod
+    def handle_client(client_socket, accepted_ns=None):
+        Server.serve_connection(Server.open_connection(client_socket, accepted_ns))
+
+    @staticmethod
+    def open_connection(client_socket, accepted_ns=None):
+        framer = RequestFramer(Server.MAX_PAYLOAD_SIZE, Server.buffer_pool, Server.SPOOL_THRESHOLD)
+        watch = Server.reaper.watch(framer, lambda reason: Server.close_reaped(client_socket, reason))
+        Metrics.connection_opened()
+        return Connection(client_socket, framer, watch, accepted_ns)
+
+    @staticmethod
+    def serve_connection(connection, park=False):
+        """
+        Serves the requests of a connection until it ends, then closes it.
+
+        Args:
+            connection (Connection): The connection.
+            park (bool): Hand the connection to Server.parker and return as soon as no request is waiting on it,
+                instead of blocking the thread until the next one arrives (pool mode).
+        """
+        client_socket = connection.socket
+        framer = connection.framer
+        watch = connection.watch
+        try:
+            while connection.requests_handled < Server.MAX_REQUESTS_PER_CONNECTION:
+                requests_handled = connection.requests_handled
+                if requests_handled:
+                    watch.waiting()
+                if park and not Server.readable(client_socket):
+                    Server.parker.park(client_socket, connection)
+                    return
+
+                Server.logger.debug("Parse the request from socket")
+                trace = Tracing.new_trace(None if requests_handled else connection.accepted_ns) \
+                    if Tracing.enabled else None
+                frame = framer.read_frame(client_socket)
+                if frame is None:
+                    if watch.reaped is None:
+                        Server.logger.debug("Client closed the connection after %d requests", requests_handled)
+                    break
+                if trace is not None:
+                    Tracing.mark(trace, Tracing.FRAME)
+
+                connection.requests_handled += 1
+                watch.busy()
+                try:
+                    if Tracing.profiling:
+                        response = Tracing.profile_call(Handlers.handle_frame, frame, trace)
+                    else:
+                        response = Handlers.handle_frame(frame, trace)
+                    if type(response) is Handlers.LongPoll:
+                        response = Handlers.finish_long_poll(frame, response, trace)  # Holds this thread
+                    if response:
+                        watch.sending(Response.size(response))
+                        Response.send(client_socket, response)
+                finally:
+                    framer.release(frame)
+                if trace is not None:
+                    Tracing.finish(trace, frame.header.code, frame.header.client_id)
+                if Server.draining:
+                    Server.logger.debug("Closing connection, the server is draining")
+                    break
+            else:
+                Server.logger.info(f"Closing connection after the limit of {connection.requests_handled} requests")
+
+        except (ValueError, OSError) as e:
+            if watch.reaped is None:
+                Server.logger.error(e)
+                Metrics.record_error(e)
         except Exception as e:
             Server.logger.error(e)
+            Metrics.record_error(e)
+
+        Server.close_connection(connection)
+
+    @staticmethod
+    def close_connection(connection):
+        if connection.watch.reaped is not None:
+            Server.logger.info(f"Closed connection reaped as [{connection.watch.reaped}] "
+                               f"after {connection.requests_handled} requests")
+        connection.watch.closed()
+        connection.framer.close()
+        connection.socket.close()
+        Metrics.connection_closed()
 
-        client_socket.close()
+    @staticmethod
+    def readable(client_socket):
+        """True if the next request, or the end of the connection, can be read without waiting."""
+        try:
+            if _MSG_DONTWAIT:
+                client_socket.recv(1, socket.MSG_PEEK | _MSG_DONTWAIT)
+            else:
+                return bool(select.select([client_socket], [], [], 0)[0])
+        except BlockingIOError:
+            return False
+        except OSError:
+            pass  # The read that follows fails the same way and ends the connection
+        return True
+
+    @staticmethod
+    def close_reaped(client_socket, reason):
+        # A connection closed by a drain was idle, but its thread may have just read a request: it can still answer
+        Server.shutdown_socket(client_socket, socket.SHUT_RD if reason == REASON_DRAINED else socket.SHUT_RDWR)
+
+    @staticmethod
+    def shutdown_socket(client_socket, how=socket.SHUT_RDWR):
+        # Wakes the connection's thread from a blocking recv or send, which then closes the socket
+        try:
+            client_socket.shutdown(how)
+        except OSError:
+            pass
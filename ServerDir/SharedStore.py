@@ -0,0 +1,266 @@
+import sqlite3
+import threading
+import time
+import uuid
+
+from Logger import Log
+from MessageStore import Message, MessageStore
+from SqliteStore import SqliteStore
+from UserDirectory import UserDirectory
+from UserRegistry import UserRecord
+
+logger = Log(logger_name=__name__)
+
+
+class SharedDatabase:
+    """
+    A SQLite database used directly as the server state, so that several
+    server processes (see Prefork) see the same clients and messages.
+
+    Unlike SqliteStore, which journals the in-memory state in the background,
+    every write here is committed before the request is answered, so another
+    process can serve the next request of the same client. WAL mode lets
+    readers run next to the writer, and busy_timeout makes concurrent writers
+    of different processes wait for each other instead of failing. Every
+    thread gets its own connection. The schema is the one of SqliteStore, so
+    the same file works in both modes.
+    """
+    BUSY_TIMEOUT_MS = 5000
+
+    def __init__(self, filename, synchronous="NORMAL"):
+        """
+        Args:
+            filename (str): The database file, created if missing.
+            synchronous (str): SQLite's synchronous setting, NORMAL is durable across crashes of the process in WAL mode.
+        """
+        self.filename = filename
+        self._synchronous = synchronous
+        self._local = threading.local()
+        connection = self.connection()
+        for statement in SqliteStore._SCHEMA:
+            connection.execute(statement)
+        connection.commit()
+
+    def connection(self):
+        """Returns the calling thread's connection, opening it on first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit mode: transactions are opened explicitly with BEGIN IMMEDIATE where they are needed
+            connection = sqlite3.connect(self.filename, isolation_level=None, check_same_thread=False)
+            connection.execute(f"PRAGMA busy_timeout={SharedDatabase.BUSY_TIMEOUT_MS}")
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(f"PRAGMA synchronous={self._synchronous}")
+            self._local.connection = connection
+        return connection
+
+
+class SharedUserRegistry:
+    """UserRegistry interface over a SharedDatabase."""
+    TOUCH_INTERVAL = 60  # Seconds: last_seen is only written when it is older than this, not on every request
+
+    _INSERT = "INSERT INTO clients (id, name, public_key, last_seen) VALUES (?, ?, ?, ?)"
+    _SELECT_BY_ID = "SELECT id, name, public_key, last_seen FROM clients WHERE id = ?"
+    _SELECT_BY_NAME = "SELECT id, name, public_key, last_seen FROM clients WHERE name = ?"
+    _SELECT_ALL = "SELECT id, name, public_key, last_seen FROM clients"
+    _TOUCH = "UPDATE clients SET last_seen = ? WHERE id = ?"
+    _COUNT = "SELECT COUNT(*) FROM clients"
+    _SELECT_SINCE = "SELECT rowid, id, name FROM clients WHERE rowid > ? ORDER BY rowid"
+
+    def __init__(self, database):
+        """
+        Args:
+            database (SharedDatabase): The database.
+        """
+        self._database = database
+        self.journal = None  # Part of the UserRegistry interface; the database already is durable
+        # This process' copy of the encoded user list, brought up to date from the rows added since
+        self._directory = UserDirectory()
+        self._directory_rowid = 0
+        self._directory_lock = threading.Lock()
+
+    def register(self, name, public_key):
+        """
+        Registers a new client under a fresh client ID.
+
+        Returns:
+            UserRecord: The new record.
+
+        Raises:
+            ValueError: If the name is already registered.
+        """
+        record = UserRecord(uuid.uuid4().bytes, name, public_key)
+        self.add(record)
+        return record
+
+    def add(self, record):
+        """
+        Raises:
+            ValueError: If the record's name or client ID is already registered.
+        """
+        try:
+            self._database.connection().execute(
+                SharedUserRegistry._INSERT, (record.client_id, record.name, record.public_key, record.last_seen))
+        except sqlite3.IntegrityError:
+            if self.get_by_name(record.name) is not None:
+                raise ValueError(f"The name [{record.name}] is already registered")
+            raise ValueError(f"The client ID [{record.client_id.hex()}] is already registered")
+
+    def get(self, client_id):
+        """Returns the record of a client ID, or None."""
+        row = self._database.connection().execute(SharedUserRegistry._SELECT_BY_ID, (client_id,)).fetchone()
+        return UserRecord(*row) if row else None
+
+    def get_by_name(self, name):
+        """Returns the record registered under a name, or None."""
+        row = self._database.connection().execute(SharedUserRegistry._SELECT_BY_NAME, (name,)).fetchone()
+        return UserRecord(*row) if row else None
+
+    def touch(self, client_id):
+        """
+        Updates the last seen time of a client, at most once per TOUCH_INTERVAL.
+
+        Returns:
+            UserRecord: The client's record, or None if it is not registered.
+        """
+        record = self.get(client_id)
+        if record is not None:
+            now = time.time()
+            if now - record.last_seen >= SharedUserRegistry.TOUCH_INTERVAL:
+                self._database.connection().execute(SharedUserRegistry._TOUCH, (now, client_id))
+                record.last_seen = now
+        return record
+
+    def user_directory(self):
+        """
+        Returns the encoded user list, after adding the clients registered since the last call, by any process.
+        Clients are added in rowid order, which is their commit order, so directory versions agree across processes.
+        """
+        with self._directory_lock:
+            for rowid, client_id, name in self._database.connection().execute(
+                    SharedUserRegistry._SELECT_SINCE, (self._directory_rowid,)):
+                self._directory.append(client_id, name.encode("ascii"))
+                self._directory_rowid = rowid
+        return self._directory
+
+    def users(self):
+        """Returns a snapshot list of all the records."""
+        return [UserRecord(*row) for row in self._database.connection().execute(SharedUserRegistry._SELECT_ALL)]
+
+    def __len__(self):
+        return self._database.connection().execute(SharedUserRegistry._COUNT).fetchone()[0]
+
+
+class SharedMessageStore:
+    """
+    MessageStore interface over a SharedDatabase. Queues are capped like in
+    MessageStore, but there is nothing to spill: messages beyond the cap are
+    rejected.
+
+    Waiters are only woken by messages sent through this process; messages
+    sent through other processes are found by rechecking the database every
+    RECHECK_INTERVAL seconds.
+    """
+    RECHECK_INTERVAL = 0.25
+
+    _QUEUE_BYTES = "SELECT COALESCE(SUM(LENGTH(content)), 0) FROM messages WHERE recipient_id = ?"
+    _INSERT = "INSERT INTO messages (recipient_id, sender_id, type, content) VALUES (?, ?, ?, ?)"
+    _RESTORE = "INSERT OR REPLACE INTO messages (id, recipient_id, sender_id, type, content) VALUES (?, ?, ?, ?, ?)"
+    _SELECT_QUEUE = "SELECT id, sender_id, type, content FROM messages WHERE recipient_id = ? ORDER BY id"
+    _DELETE_QUEUE = "DELETE FROM messages WHERE recipient_id = ? AND id <= ?"
+    _HAS_MESSAGES = "SELECT 1 FROM messages WHERE recipient_id = ? LIMIT 1"
+    _STATS = "SELECT COUNT(DISTINCT recipient_id), COUNT(*), COALESCE(SUM(LENGTH(content)), 0) FROM messages"
+    _QUEUE_STATS = ("SELECT recipient_id, COUNT(*), SUM(LENGTH(content)) AS size FROM messages "
+                    "GROUP BY recipient_id ORDER BY size DESC LIMIT ?")
+
+    def __init__(self, database, max_queue_bytes=MessageStore.DEFAULT_MAX_QUEUE_BYTES):
+        """
+        Args:
+            database (SharedDatabase): The database.
+            max_queue_bytes (int): Content bytes a recipient's queue may hold.
+        """
+        self._database = database
+        self._max_queue_bytes = max_queue_bytes
+        self._stats_lock = threading.Lock()
+        self._rejected = 0  # In this process
+        self._waiters_lock = threading.Lock()
+        self._waiters = {}  # Recipient ID -> callbacks waiting for its next message, in this process
+        self.journal = None  # Part of the MessageStore interface; the database already is durable
+
+    def enqueue(self, recipient_id, sender_id, message_type, content):
+        """
+        Stores a message for its recipient.
+
+        Returns:
+            Message: The stored message, with its message ID.
+
+        Raises:
+            ValueError: If the recipient's queue is full.
+        """
+        connection = self._database.connection()
+        connection.execute("BEGIN IMMEDIATE")  # The size check and the insert must not interleave with other writers
+        try:
+            queue_bytes = connection.execute(SharedMessageStore._QUEUE_BYTES, (recipient_id,)).fetchone()[0]
+            if queue_bytes + len(content) > self._max_queue_bytes:
+                with self._stats_lock:
+                    self._rejected += 1
+                raise ValueError(f"The message queue of [{recipient_id.hex()}] is full "
+                                 f"({queue_bytes} of {self._max_queue_bytes} bytes)")
+            cursor = connection.execute(SharedMessageStore._INSERT, (recipient_id, sender_id, message_type, content))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        with self._waiters_lock:
+            waiters = self._waiters.pop(recipient_id, None)
+        for wake in waiters or ():
+            wake()
+        return Message(cursor.lastrowid & 0xFFFFFFFF, sender_id, recipient_id, message_type, content)
+
+    def add_waiter(self, recipient_id, wake):
+        """See MessageStore.add_waiter."""
+        with self._waiters_lock:
+            if self._database.connection().execute(SharedMessageStore._HAS_MESSAGES, (recipient_id,)).fetchone():
+                return False
+            self._waiters.setdefault(recipient_id, []).append(wake)
+        return True
+
+    def remove_waiter(self, recipient_id, wake):
+        with self._waiters_lock:
+            waiters = self._waiters.get(recipient_id)
+            if waiters and wake in waiters:
+                waiters.remove(wake)
+                if not waiters:
+                    del self._waiters[recipient_id]
+
+    def restore(self, message):
+        self._database.connection().execute(SharedMessageStore._RESTORE, (
+            message.message_id, message.recipient_id, message.sender_id, message.message_type, message.content))
+
+    def pull(self, recipient_id):
+        """
+        Removes and returns all the waiting messages of a recipient, in the order they were sent.
+        """
+        connection = self._database.connection()
+        connection.execute("BEGIN IMMEDIATE")  # So two processes never hand out the same message
+        try:
+            rows = connection.execute(SharedMessageStore._SELECT_QUEUE, (recipient_id,)).fetchall()
+            if rows:
+                connection.execute(SharedMessageStore._DELETE_QUEUE, (recipient_id, rows[-1][0]))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return [Message(message_id & 0xFFFFFFFF, sender_id, recipient_id, message_type, content)
+                for message_id, sender_id, message_type, content in rows]
+
+    def stats(self):
+        queues, messages, size = self._database.connection().execute(SharedMessageStore._STATS).fetchone()
+        with self._stats_lock:
+            rejected = self._rejected
+        return {"queues": queues, "messages": messages, "bytes": size, "spilled_messages": 0, "spilled_bytes": 0,
+                "rejected": rejected}
+
+    def queue_stats(self, top=10):
+        return [{"recipient": recipient_id.hex(), "messages": count, "bytes": size, "spilled_messages": 0}
+                for recipient_id, count, size in self._database.connection().execute(
+                    SharedMessageStore._QUEUE_STATS, (top,))]
@@ -0,0 +1,190 @@
+"""
+Disk spooling of large message contents.
+
+The payload size of a send message request is a 32-bit field, so one
+message may legally be gigabytes. RequestFramer streams the content of a
+send message request above a threshold straight to a spool file in fixed
+size chunks instead of into memory, and the message is stored with a
+SpooledContent in place of its bytes. A pull sends it back with sendfile,
+so the server's memory use does not depend on message sizes.
+
+A spool file lives as long as its SpooledContent: it is deleted once the
+pull response carrying it was sent, once the content is garbage collected
+otherwise, or at exit. A SpooledContent may also be a range of a SharedFile
+(the spill file of a message queue) holding several contents; that file is
+deleted once the last of them is gone.
+"""
+import os
+import tempfile
+import threading
+import weakref
+
+from Logger import Log
+
+logger = Log(logger_name=__name__)
+
+DEFAULT_THRESHOLD = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+_directory = None
+_stats_lock = threading.Lock()
+_stats = {"files": 0, "bytes": 0, "spooled_messages": 0, "spooled_bytes": 0}
+
+
+def configure(directory=None):
+    """
+    Sets where spool files are written.
+
+    Args:
+        directory (str, optional): The spool folder, created if missing. A temporary folder by default.
+    """
+    global _directory
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+    _directory = directory
+
+
+def _spool_directory():
+    global _directory
+    if _directory is None:
+        _directory = tempfile.mkdtemp(prefix="messageu-spool-")
+    return _directory
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _count(files, size):
+    with _stats_lock:
+        _stats["files"] += files
+        _stats["bytes"] += files * size
+
+
+def _remove(path, size):
+    _remove_file(path)
+    _count(-1, size)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        logger.error(f"Failed to remove the spool file '{path}': {e}")
+
+
+class SharedFile:
+    """A file holding several contents, deleted once none of the SpooledContent ranges over it is left (or at exit)."""
+    __slots__ = ("path", "__weakref__")
+
+    def __init__(self, path):
+        self.path = path
+        weakref.finalize(self, _remove_file, path)
+
+    def content(self, offset, size):
+        """Returns the content of size bytes at offset in the file, which keeps the file alive."""
+        return SpooledContent(self.path, size, offset, shared=self)
+
+
+class SpooledContent:
+    """
+    A message content kept in a file: a whole spool file, or a range of a SharedFile. Sized like bytes, but only
+    readable through a file.
+    """
+    __slots__ = ("path", "size", "offset", "_finalizer", "_shared", "__weakref__")
+
+    def __init__(self, path, size, offset=0, shared=None):
+        self.path = path
+        self.size = size
+        self.offset = offset
+        self._shared = shared
+        self._finalizer = weakref.finalize(self, _remove, path, size) if shared is None else None
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return f"SpooledContent(path={self.path!r}, size={self.size}, offset={self.offset})"
+
+    def open(self):
+        """Opens the file, positioned at the start of the content."""
+        file = open(self.path, "rb")
+        if self.offset:
+            file.seek(self.offset)
+        return file
+
+    def send(self, client_socket):
+        """Writes the content to a blocking socket with sendfile."""
+        with open(self.path, "rb") as file:
+            client_socket.sendfile(file, self.offset, self.size)
+
+    async def send_async(self, loop, transport):
+        """Writes the content to an asyncio transport with loop.sendfile, once the transport's buffer is flushed."""
+        with open(self.path, "rb") as file:
+            await loop.sendfile(transport, file, self.offset, self.size)
+
+    def discard(self):
+        """Deletes the spool file now, or lets go of the shared file."""
+        if self._finalizer is not None:
+            self._finalizer()
+        self._shared = None
+
+
+class SpooledPayload:
+    """
+    The payload of a spooled send message request: its message header in memory and its content in a spool file.
+    Sized like the payload it stands for.
+    """
+    __slots__ = ("head", "content")
+
+    def __init__(self, head, content):
+        self.head = head
+        self.content = content
+
+    def __len__(self):
+        return len(self.head) + len(self.content)
+
+
+class SpoolWriter:
+    """Writes one content to a new spool file, chunk by chunk, then hands it over as a SpooledContent."""
+
+    def __init__(self, size):
+        """
+        Args:
+            size (int): The content size the writer expects.
+        """
+        self._size = size
+        self._written = 0
+        descriptor, self._path = tempfile.mkstemp(suffix=".spool", dir=_spool_directory())
+        self._file = os.fdopen(descriptor, "wb", buffering=0)  # Chunks are large already
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        self._written += len(chunk)
+
+    def finish(self):
+        """
+        Returns:
+            SpooledContent: The content, which owns the file from now on.
+
+        Raises:
+            ValueError: If fewer or more bytes were written than expected.
+        """
+        self._file.close()
+        if self._written != self._size:
+            self.discard()
+            raise ValueError(f"Spooled {self._written} bytes, expected {self._size}")
+        _count(1, self._size)
+        with _stats_lock:
+            _stats["spooled_messages"] += 1
+            _stats["spooled_bytes"] += self._size
+        return SpooledContent(self._path, self._size)
+
+    def discard(self):
+        """Deletes the unfinished spool file."""
+        self._file.close()
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
@@ -0,0 +1,237 @@
+import queue
+import sqlite3
+import threading
+import time
+
+from Logger import Log
+from MessageStore import Message
+from UserRegistry import UserRecord
+
+logger = Log(logger_name=__name__)
+
+
+class SqliteStore:
+    """
+    Optional durable storage of clients and waiting messages in SQLite.
+
+    The in-memory UserRegistry and MessageStore stay the source of truth while
+    the server runs; they report every change to this store (see their journal
+    attribute), and it is used to warm them up on startup.
+
+    All writes go through one writer thread and its own connection, which
+    commits them in groups: a commit happens once batch_size writes are
+    waiting or flush_interval seconds after the first one, whichever comes
+    first. A burst of sends therefore costs one fsync per batch, at the price of
+    losing at most one batch on a crash. The database runs in WAL mode so reads
+    (each thread gets its own connection) never wait for the writer.
+
+    A batch whose commit fails is retried a few times with a growing delay; if
+    it still fails, its writes are committed one at a time so only the ones that
+    fail on their own are dropped, and they are counted in stats().
+    """
+    DEFAULT_BATCH_SIZE = 512
+    DEFAULT_FLUSH_INTERVAL = 0.05  # Seconds
+    DEFAULT_COMMIT_ATTEMPTS = 3
+    DEFAULT_RETRY_DELAY = 0.1  # Seconds, doubled after each failed attempt
+
+    # Constant SQL texts: sqlite3 keeps the compiled statement of each one per connection and reuses it
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS clients ("
+        " id BLOB PRIMARY KEY, name TEXT NOT NULL UNIQUE, public_key BLOB NOT NULL, last_seen REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS messages ("
+        " id INTEGER PRIMARY KEY, recipient_id BLOB NOT NULL, sender_id BLOB NOT NULL,"
+        " type INTEGER NOT NULL, content BLOB NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS messages_recipient ON messages (recipient_id)",
+    )
+    _INSERT_CLIENT = "INSERT OR REPLACE INTO clients (id, name, public_key, last_seen) VALUES (?, ?, ?, ?)"
+    _INSERT_MESSAGE = "INSERT OR REPLACE INTO messages (id, recipient_id, sender_id, type, content) VALUES (?, ?, ?, ?, ?)"
+    _DELETE_MESSAGE = "DELETE FROM messages WHERE id = ?"
+    _SELECT_CLIENTS = "SELECT id, name, public_key, last_seen FROM clients"
+    _SELECT_MESSAGES = "SELECT id, recipient_id, sender_id, type, content FROM messages ORDER BY id"
+
+    _FLUSH = object()
+    _STOP = object()
+
+    def __init__(self, filename, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 synchronous="NORMAL", commit_attempts=DEFAULT_COMMIT_ATTEMPTS, retry_delay=DEFAULT_RETRY_DELAY):
+        """
+        Opens (or creates) the database and starts the writer thread.
+
+        Args:
+            filename (str): The database file.
+            batch_size (int): The most writes committed together.
+            flush_interval (float): The longest a write waits for its commit, in seconds.
+            synchronous (str): SQLite's synchronous setting, NORMAL is durable across crashes of the process in WAL mode.
+            commit_attempts (int): How many times a failing batch is committed before falling back to single writes.
+            retry_delay (float): The wait before the first retry, in seconds.
+        """
+        self._filename = filename
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._synchronous = synchronous
+        self._commit_attempts = commit_attempts
+        self._retry_delay = retry_delay
+        self._writes = queue.Queue()
+        self._local = threading.local()
+        self._commits = 0
+        self._written = 0
+        self._failed_commits = 0
+        self._dropped_writes = 0
+
+        connection = self._connect()
+        for statement in SqliteStore._SCHEMA:
+            connection.execute(statement)
+        connection.commit()
+
+        self._writer = threading.Thread(target=self._write_loop, name="sqlite-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self._filename, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(f"PRAGMA synchronous={self._synchronous}")
+        return connection
+
+    def _reader(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection
+
+    # Journal interface, called by UserRegistry and MessageStore
+
+    def record_client(self, record):
+        self._writes.put((SqliteStore._INSERT_CLIENT,
+                          (record.client_id, record.name, record.public_key, record.last_seen)))
+
+    def record_message(self, message):
+        self._writes.put((SqliteStore._INSERT_MESSAGE,
+                          (message.message_id, message.recipient_id, message.sender_id, message.message_type,
+                           message.content)))
+
+    def delete_messages(self, messages):
+        for message in messages:
+            self._writes.put((SqliteStore._DELETE_MESSAGE, (message.message_id,)))
+
+    def load_into(self, users, messages):
+        """
+        Fills an empty UserRegistry and MessageStore from the database.
+
+        Args:
+            users (UserRegistry): Receives the registered clients.
+            messages (MessageStore): Receives the waiting messages, None to load the clients only.
+        """
+        connection = self._reader()
+        client_count = 0
+        for client_id, name, public_key, last_seen in connection.execute(SqliteStore._SELECT_CLIENTS):
+            users.add(UserRecord(client_id, name, public_key, last_seen))
+            client_count += 1
+
+        if messages is None:
+            logger.info(f"Loaded {client_count} clients from '{self._filename}'")
+            return
+
+        message_count = 0
+        for message_id, recipient_id, sender_id, message_type, content in connection.execute(
+                SqliteStore._SELECT_MESSAGES):
+            messages.restore(Message(message_id, sender_id, recipient_id, message_type, content))
+            message_count += 1
+
+        logger.info(f"Loaded {client_count} clients and {message_count} waiting messages from '{self._filename}'")
+
+    def flush(self):
+        """Blocks until every write queued so far is committed."""
+        done = threading.Event()
+        self._writes.put((SqliteStore._FLUSH, done))
+        done.wait()
+
+    def close(self):
+        """Commits the pending writes and stops the writer thread."""
+        self._writes.put((SqliteStore._STOP, None))
+        self._writer.join()
+
+    def stats(self):
+        return {"pending_writes": self._writes.qsize(), "written": self._written, "commits": self._commits,
+                "failed_commits": self._failed_commits, "dropped_writes": self._dropped_writes}
+
+    def _write_loop(self):
+        connection = self._connect()
+        while True:
+            batch = [self._writes.get()]
+            deadline = time.monotonic() + self._flush_interval
+            while len(batch) < self._batch_size and batch[-1][0] not in (SqliteStore._FLUSH, SqliteStore._STOP):
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._writes.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            stop = self._commit(connection, batch)
+            if stop:
+                connection.close()
+                return
+
+    def _commit(self, connection, batch):
+        events = [params for sql, params in batch if sql is SqliteStore._FLUSH]
+        stop = any(sql is SqliteStore._STOP for sql, _ in batch)
+        writes = [write for write in batch if write[0] is not SqliteStore._FLUSH and write[0] is not SqliteStore._STOP]
+        try:
+            delay = self._retry_delay
+            for attempt in range(1, self._commit_attempts + 1):
+                error = self._try_commit(connection, writes)
+                if error is None:
+                    self._written += len(writes)
+                    return stop
+                logger.warning(f"Failed to commit {len(writes)} writes to '{self._filename}' "
+                               f"(attempt {attempt} of {self._commit_attempts}): {error}")
+                if attempt < self._commit_attempts:
+                    time.sleep(delay)
+                    delay *= 2
+
+            # Most likely one write fails on its own: keep the others
+            for write in writes:
+                error = self._try_commit(connection, [write])
+                if error is None:
+                    self._written += 1
+                else:
+                    self._dropped_writes += 1
+                    logger.error(f"Dropped a write to '{self._filename}': {error}")
+            return stop
+        finally:
+            for event in events:
+                event.set()
+
+    def _try_commit(self, connection, writes):
+        """
+        Commits writes in one transaction.
+
+        Args:
+            connection (sqlite3.Connection): The writer connection.
+            writes (list): (sql, params) pairs.
+
+        Returns:
+            sqlite3.Error: Why the transaction was rolled back, None once committed.
+        """
+        try:
+            # Consecutive writes of the same statement go through one executemany call
+            run_sql, run_params = None, []
+            for sql, params in writes:
+                if sql is not run_sql and run_params:
+                    connection.executemany(run_sql, run_params)
+                    run_params = []
+                run_sql = sql
+                run_params.append(params)
+            if run_params:
+                connection.executemany(run_sql, run_params)
+            connection.commit()
+        except sqlite3.Error as e:
+            self._failed_commits += 1
+            try:
+                connection.rollback()
+            except sqlite3.Error:
+                pass
+            return e
+        self._commits += 1
+        return None
@@ -0,0 +1,91 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+import Codec
+from Framer import RequestFramer
+from Protocol import Protocol
+import Reaper
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Main.py")
+DRAIN_TIMEOUT = 4
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def connect(port):
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            return socket.create_connection(("127.0.0.1", port))
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def receive_all(client):
+    data = b""
+    while True:
+        chunk = client.recv(4096)
+        if not chunk:
+            return data
+        data += chunk
+
+
+def test_close_idle_leaves_requests_being_received():
+    reaper = Reaper.Reaper(idle_timeout=30)
+    closed = []
+    idle = reaper.watch(RequestFramer(), closed.append)
+    receiving_framer = RequestFramer()
+    list(receiving_framer.feed(b"x" * 5))
+    receiving = reaper.watch(receiving_framer, closed.append)
+    busy = reaper.watch(RequestFramer(), closed.append)
+    busy.busy()
+
+    assert reaper.close_idle() == 1
+    assert closed == [Reaper.REASON_DRAINED]
+    assert (idle.reaped, receiving.reaped, busy.reaped) == (Reaper.REASON_DRAINED, None, None)
+    assert reaper.stats()["reaped"][Reaper.REASON_DRAINED] == 1
+
+
+@pytest.mark.parametrize("mode", ["threaded", "pool", "async"])
+def test_drain_closes_idle_connections_at_once(mode, tmp_path):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, MAIN, "--port", str(port), "--mode", mode,
+                               "--drain-timeout", str(DRAIN_TIMEOUT), "--log-level", "ERROR"],
+                              cwd=tmp_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        idle = connect(port)
+        started = connect(port)
+        request = Protocol.build_request(b"", 2, Protocol.REGISTRATION_CODE,
+                                         Codec.REGISTRATION.pack(b"drained\0", bytes(160)))
+        started.sendall(request[:10])
+        time.sleep(0.5)  # Both connections are being served
+
+        start = time.monotonic()
+        server.send_signal(signal.SIGTERM)
+        assert receive_all(idle) == b""
+        assert time.monotonic() - start < DRAIN_TIMEOUT / 2
+
+        # The request already started is still answered
+        started.sendall(request[10:])
+        response = receive_all(started)
+        assert Codec.RESPONSE_HEADER.unpack_from(response)[1] == 2100
+        assert server.wait(DRAIN_TIMEOUT) == 0
+        assert time.monotonic() - start < DRAIN_TIMEOUT
+        idle.close()
+        started.close()
+    finally:
+        if server.poll() is None:
+            server.kill()
+            server.wait()
@@ -0,0 +1,129 @@
+import os
+import socket
+
+import pytest
+
+import Codec
+import Spool
+from BufferPool import BufferPool
+from Framer import RequestFramer
+from Protocol import Protocol
+
+CLIENT = bytes(range(16))
+RECIPIENT = b"r" * 16
+
+
+def request(code, payload=b""):
+    return Protocol.build_request(CLIENT, 2, code, payload)
+
+
+def message(content):
+    return request(Protocol.SEND_MESSAGE_CODE, Codec.MESSAGE_HEADER.pack(RECIPIENT, 3, len(content)) + content)
+
+
+def borrowed(pool):
+    return sum(size_class["borrowed"] for size_class in pool.stats()["classes"].values())
+
+
+def test_header_split_across_chunks():
+    framer = RequestFramer()
+    data = request(Protocol.PUBLIC_KEY_CODE, RECIPIENT)
+    frames = []
+    for index in range(len(data)):
+        frames.extend(framer.feed(data[index:index + 1]))
+
+    assert len(frames) == 1
+    assert frames[0].header == (CLIENT, 2, Protocol.PUBLIC_KEY_CODE, 16)
+    assert bytes(frames[0].payload) == RECIPIENT
+    assert framer.idle
+
+
+def test_payload_split_across_chunks():
+    framer = RequestFramer()
+    data = message(b"x" * 1000)
+    assert list(framer.feed(data[:Protocol.HEADER_SIZE + 10])) == []
+    assert not framer.idle
+    assert framer.expected_size == len(data)
+    assert list(framer.feed(data[Protocol.HEADER_SIZE + 10:-1])) == []
+
+    frames = list(framer.feed(data[-1:]))
+    assert len(frames) == 1
+    assert bytes(frames[0].payload) == data[Protocol.HEADER_SIZE:]
+
+
+def test_coalesced_requests_in_one_chunk():
+    framer = RequestFramer()
+    requests = [request(Protocol.USER_LIST_CODE), message(b"hello"), request(Protocol.PULL_MESSAGES_CODE)]
+    next_request = request(Protocol.PUBLIC_KEY_CODE, RECIPIENT)
+
+    frames = list(framer.feed(b"".join(requests) + next_request[:5]))
+    assert [frame.header.code for frame in frames] == [601, 603, 604]
+    assert [bytes(frame.payload) for frame in frames] == [b"", requests[1][Protocol.HEADER_SIZE:], b""]
+    assert Protocol.parse_frame(frames[1].header, frames[1].payload).content.tobytes() == b"hello"
+
+    frames = list(framer.feed(next_request[5:]))
+    assert [frame.header.code for frame in frames] == [602]
+
+
+def test_oversize_payload_is_rejected_before_allocating():
+    pool = BufferPool()
+    framer = RequestFramer(max_payload_size=100, pool=pool)
+    with pytest.raises(ValueError):
+        list(framer.feed(message(b"x" * 100)))
+    assert pool.stats()["allocated"] == 0
+
+
+def test_released_frame_returns_its_buffer():
+    pool = BufferPool()
+    framer = RequestFramer(pool=pool)
+    frame, = framer.feed(message(b"x" * 100))
+    assert BufferPool.is_pooled(frame.payload)
+    assert borrowed(pool) == 1
+
+    framer.release(frame)
+    assert borrowed(pool) == 0
+    frame, = framer.feed(message(b"y" * 100))
+    assert pool.stats()["reused"] == 1
+
+
+def test_close_mid_payload_returns_the_pooled_buffer():
+    pool = BufferPool()
+    framer = RequestFramer(pool=pool)
+    data = message(b"x" * 1000)
+    assert list(framer.feed(data[:Protocol.HEADER_SIZE + 100])) == []
+    assert borrowed(pool) == 1
+
+    framer.close()
+    assert borrowed(pool) == 0
+    assert pool.stats()["classes"]["8192"]["free"] == 1
+    assert framer.idle
+
+
+def test_close_mid_spool_deletes_the_spool_file(tmp_path):
+    Spool.configure(str(tmp_path))
+    try:
+        framer = RequestFramer(spool_threshold=64)
+        data = message(b"x" * (Spool.CHUNK_SIZE * 2))
+        assert list(framer.feed(data[:-10])) == []
+        assert len(os.listdir(tmp_path)) == 1
+
+        framer.close()
+        assert os.listdir(tmp_path) == []
+    finally:
+        Spool.configure()
+
+
+def test_read_frame_from_a_socket():
+    server, client = socket.socketpair()
+    with server, client:
+        framer = RequestFramer()
+        data = message(b"z" * 50)
+        client.sendall(data[:7])
+        client.sendall(data[7:] + request(Protocol.PULL_MESSAGES_CODE))
+        assert bytes(framer.read_frame(server).payload) == data[Protocol.HEADER_SIZE:]
+        assert framer.read_frame(server).header.code == Protocol.PULL_MESSAGES_CODE
+
+        client.sendall(data[:30])
+        client.shutdown(socket.SHUT_WR)
+        with pytest.raises(ValueError):
+            framer.read_frame(server)
@@ -0,0 +1,49 @@
+import sqlite3
+
+import pytest
+
+import Codec
+from Framer import Frame
+import Handlers
+import Metrics
+from Protocol import Protocol
+import Response
+from SharedStore import SharedDatabase, SharedMessageStore, SharedUserRegistry
+
+
+@pytest.fixture
+def locked_shared_store(tmp_path, monkeypatch):
+    """Handlers over a shared database another process holds the write lock of, with one registered client."""
+    monkeypatch.setattr(SharedDatabase, "BUSY_TIMEOUT_MS", 0)
+    filename = str(tmp_path / "shared.db")
+    database = SharedDatabase(filename)
+    monkeypatch.setattr(Handlers, "users", SharedUserRegistry(database))
+    monkeypatch.setattr(Handlers, "messages", SharedMessageStore(database))
+    record = Handlers.users.register("locked", bytes(160))
+
+    other = sqlite3.connect(filename, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    yield record
+    other.execute("ROLLBACK")
+    other.close()
+
+
+def pull_frame(client_id):
+    return Frame(Codec.RequestHeader(client_id, 2, Protocol.PULL_MESSAGES_CODE, 0), memoryview(b""))
+
+
+def pull_errors():
+    return Metrics.snapshot()["requests"].get(str(Protocol.PULL_MESSAGES_CODE), {}).get("errors", 0)
+
+
+def test_database_error_is_answered_and_counted(locked_shared_store):
+    errors = pull_errors()
+    assert Handlers.handle_frame(pull_frame(locked_shared_store.client_id)) == Response.error()
+    assert pull_errors() == errors + 1
+
+
+def test_database_error_after_a_long_poll_is_answered_and_counted(locked_shared_store):
+    errors = pull_errors()
+    poll = Handlers.LongPoll(locked_shared_store, timeout=0)
+    assert Handlers.finish_long_poll(pull_frame(locked_shared_store.client_id), poll) == Response.error()
+    assert pull_errors() == errors + 1
@@ -0,0 +1,178 @@
+import os
+import threading
+
+import pytest
+
+import LogStore as log_store
+import Spool
+from LogStore import LogStore
+
+SENDER = b"s" * 16
+RECIPIENTS = [bytes([index]) * 16 for index in range(1, 5)]
+SEGMENT_BYTES = 64 * 1024
+
+
+def open_store(directory):
+    return LogStore(str(directory), segment_bytes=SEGMENT_BYTES, max_queue_bytes=1 << 30)
+
+
+def pulled(store, recipient_id):
+    return [bytes(message.content) for message in store.pull(recipient_id)]
+
+
+@pytest.fixture(autouse=True)
+def spool_dir(tmp_path):
+    Spool.configure(str(tmp_path / "spool"))
+    yield
+    Spool.configure()
+
+
+def test_messages_survive_a_reopen_and_pulls_are_not_replayed(tmp_path):
+    store = open_store(tmp_path)
+    sent = {recipient_id: [] for recipient_id in RECIPIENTS}
+    for index in range(200):
+        recipient_id = RECIPIENTS[index % len(RECIPIENTS)]
+        content = os.urandom(index * 7 % 3000)
+        store.enqueue(recipient_id, SENDER, 1, content)
+        sent[recipient_id].append(content)
+    assert pulled(store, RECIPIENTS[0]) == sent.pop(RECIPIENTS[0])
+    store.close()
+
+    reopened = open_store(tmp_path)
+    assert reopened.stats()["recovered_messages"] == 150
+    assert pulled(reopened, RECIPIENTS[0]) == []
+    for recipient_id, contents in sent.items():
+        assert pulled(reopened, recipient_id) == contents
+
+
+def test_message_ids_continue_after_a_reopen(tmp_path):
+    store = open_store(tmp_path)
+    first = store.enqueue(RECIPIENTS[0], SENDER, 1, b"one")
+    second = open_store(tmp_path).enqueue(RECIPIENTS[0], SENDER, 1, b"two")
+    assert second.message_id > first.message_id
+
+
+def test_a_torn_last_record_is_dropped(tmp_path):
+    store = open_store(tmp_path)
+    store.enqueue(RECIPIENTS[0], SENDER, 1, b"kept")
+    store.enqueue(RECIPIENTS[0], SENDER, 1, b"torn")
+    segment = store._segments[-1]
+    segment.view[max(segment.live) + log_store.RECORD.size] ^= 0xFF  # The write was cut short by a crash
+    store.close()
+
+    reopened = open_store(tmp_path)
+    assert reopened.stats()["damaged_segments"] == 1
+    assert pulled(reopened, RECIPIENTS[0]) == [b"kept"]
+    reopened.enqueue(RECIPIENTS[0], SENDER, 1, b"after")
+    assert pulled(open_store(tmp_path), RECIPIENTS[0]) == [b"after"]
+
+
+def test_a_damaged_record_does_not_take_the_next_ones_with_it(tmp_path):
+    store = open_store(tmp_path)
+    for content in (b"A", b"B", b"C"):
+        store.enqueue(RECIPIENTS[0], SENDER, 1, content)
+    segment = store._segments[-1]
+    segment.view[min(segment.live):min(segment.live) + 4] = bytes(4)  # A crash before the CRC was written
+    store.close()
+
+    reopened = open_store(tmp_path)
+    stats = reopened.stats()
+    assert (stats["damaged_segments"], stats["damaged_records"]) == (1, 1)
+    assert pulled(reopened, RECIPIENTS[0]) == [b"B", b"C"]
+    reopened.enqueue(RECIPIENTS[0], SENDER, 1, b"D")
+    assert pulled(open_store(tmp_path), RECIPIENTS[0]) == [b"D"]
+
+
+def test_compaction_keeps_the_live_messages(tmp_path):
+    store = open_store(tmp_path)
+    kept = []
+    for index in range(300):
+        content = os.urandom(2000)
+        recipient_id = RECIPIENTS[index % 2]
+        store.enqueue(recipient_id, SENDER, 1, content)
+        if recipient_id == RECIPIENTS[0]:
+            kept.append(content)
+    store.pull(RECIPIENTS[1])
+    segments = store.stats()["segments"]
+
+    while store.compact():
+        pass
+    stats = store.stats()
+    assert stats["segments"] < segments
+    assert stats["copied_records"] > 0
+    assert len(os.listdir(tmp_path)) - 1 == stats["segments"]  # The spool folder aside
+
+    assert pulled(open_store(tmp_path), RECIPIENTS[0]) == kept
+
+
+def test_an_unfinished_compaction_does_not_duplicate_messages(tmp_path):
+    store = open_store(tmp_path)
+    contents = [os.urandom(3000) for _ in range(60)]
+    for index, content in enumerate(contents):
+        store.enqueue(RECIPIENTS[index % 2], SENDER, 1, content)
+    store.pull(RECIPIENTS[1])
+    store.compact(slice_size=3)  # Copies a few records, then the process dies before removing the segment
+
+    assert pulled(open_store(tmp_path), RECIPIENTS[0]) == contents[::2]
+
+
+def test_an_empty_segment_file_is_removed_on_recovery(tmp_path):
+    store = open_store(tmp_path)
+    store.enqueue(RECIPIENTS[0], SENDER, 1, b"kept")
+    store.close()
+    open(os.path.join(tmp_path, "00000002.seg"), "wb").close()  # Created, then a crash before its preallocation
+
+    reopened = open_store(tmp_path)
+    assert not os.path.exists(os.path.join(tmp_path, "00000002.seg"))
+    assert pulled(reopened, RECIPIENTS[0]) == [b"kept"]
+
+
+def spooled(data):
+    writer = Spool.SpoolWriter(len(data))
+    writer.write(data)
+    return writer.finish()
+
+
+def test_spooled_contents_are_copied_without_the_lock(tmp_path, monkeypatch):
+    store = open_store(tmp_path)
+    copying = threading.Event()
+    release = threading.Event()
+    copy_spooled = LogStore._copy_spooled
+
+    def slow_copy(content, view, start):
+        copying.set()
+        release.wait(5)
+        return copy_spooled(content, view, start)
+
+    monkeypatch.setattr(LogStore, "_copy_spooled", staticmethod(slow_copy))
+    big = os.urandom(200 * 1024)
+    sender = threading.Thread(target=store.enqueue, args=(RECIPIENTS[0], SENDER, 2, spooled(big)))
+    sender.start()
+    assert copying.wait(5)
+
+    # Other sends and pulls go on meanwhile; the pending message is not visible yet
+    store.enqueue(RECIPIENTS[1], SENDER, 1, b"small")
+    assert pulled(store, RECIPIENTS[1]) == [b"small"]
+    assert pulled(store, RECIPIENTS[0]) == []
+    while store.compact():  # Leaves the segment being written to alone
+        pass
+
+    release.set()
+    sender.join(5)
+    assert pulled(open_store(tmp_path), RECIPIENTS[0]) == [big]
+    assert pulled(store, RECIPIENTS[0]) == [big]
+
+
+def test_a_pending_record_left_by_a_crash_is_skipped(tmp_path, monkeypatch):
+    store = open_store(tmp_path)
+
+    def crash(content, view, start):
+        raise OSError("crashed while copying")
+
+    monkeypatch.setattr(LogStore, "_copy_spooled", staticmethod(crash))
+    with pytest.raises(OSError):
+        store.enqueue(RECIPIENTS[0], SENDER, 2, spooled(b"x" * 1000))
+    store.enqueue(RECIPIENTS[0], SENDER, 1, b"after")
+    store.close()
+
+    assert pulled(open_store(tmp_path), RECIPIENTS[0]) == [b"after"]
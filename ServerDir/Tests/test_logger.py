@@ -0,0 +1,46 @@
+import io
+import os
+
+from Logger import Log, _FileSink
+
+
+def test_file_sink_counts_bytes(tmp_path):
+    path = str(tmp_path / "server.log")
+    sink = _FileSink(path, max_bytes=100, flush_interval=0)
+    sink.write_lines(["é" * 30])  # 30 characters, 61 bytes with the line ending
+    assert os.path.getsize(path) == 61
+    assert sink.rotations == 0
+
+    sink.write_lines(["é" * 30])  # 122 bytes would be past max_bytes, although 62 characters are not
+    assert sink.rotations == 1
+    assert os.path.getsize(path) == 61
+    assert os.path.getsize(path + ".1") == 61
+    sink.close()
+
+
+def test_file_sink_reopens_with_the_size_in_bytes(tmp_path):
+    path = str(tmp_path / "server.log")
+    sink = _FileSink(path, flush_interval=0)
+    sink.write_lines(["€" * 10])
+    sink.close()
+
+    sink = _FileSink(path, max_bytes=40, flush_interval=0)
+    sink.write_lines(["x" * 8])  # 31 + 9 bytes fit exactly
+    assert sink.rotations == 0
+    sink.write_lines(["x"])
+    assert sink.rotations == 1
+    sink.close()
+
+
+def test_console_stream_can_leave_stdout_to_data(capsys):
+    stream = io.StringIO()
+    Log.set_console_stream(stream)
+    try:
+        Log._write_console(["first", "second"], flush=True)
+    finally:
+        Log.set_console_stream(None)
+    assert stream.getvalue() == "first\nsecond\n"
+    assert capsys.readouterr().out == ""
+
+    Log._write_console(["back"])
+    assert capsys.readouterr().out == "back\n"
@@ -0,0 +1,140 @@
+import os
+
+import pytest
+
+import Spool
+from MessageStore import Message, MessageStore
+from Spool import SpooledContent
+
+RECIPIENT = b"r" * 16
+SENDER = b"s" * 16
+
+
+def spooled(data):
+    writer = Spool.SpoolWriter(len(data))
+    writer.write(data)
+    return writer.finish()
+
+
+@pytest.fixture(autouse=True)
+def spool_dir(tmp_path):
+    Spool.configure(str(tmp_path / "spool"))
+    yield
+    Spool.configure()
+
+
+def read(content):
+    if type(content) is not SpooledContent:
+        return bytes(content)
+    with content.open() as file:
+        return file.read(len(content))
+
+
+def spilling_store(tmp_path, max_queue_bytes=10):
+    return MessageStore(max_queue_bytes=max_queue_bytes, overflow=MessageStore.OVERFLOW_SPILL,
+                        spill_dir=str(tmp_path))
+
+
+def test_pull_returns_messages_in_order():
+    store = MessageStore()
+    for index in range(3):
+        store.enqueue(RECIPIENT, SENDER, 1, b"m%d" % index)
+    assert [bytes(message.content) for message in store.pull(RECIPIENT)] == [b"m0", b"m1", b"m2"]
+    assert store.pull(RECIPIENT) == []
+
+
+def test_reject_policy_rejects_over_the_cap():
+    store = MessageStore(max_queue_bytes=10)
+    store.enqueue(RECIPIENT, SENDER, 1, b"x" * 10)
+    with pytest.raises(ValueError):
+        store.enqueue(RECIPIENT, SENDER, 1, b"y")
+    assert store.stats()["rejected"] == 1
+
+
+def test_rejected_message_leaves_no_queue_behind():
+    store = MessageStore(max_queue_bytes=10)
+    with pytest.raises(ValueError):
+        store.enqueue(RECIPIENT, SENDER, 1, b"x" * 11)
+    stats = store.stats()
+    assert (stats["queues"], stats["messages"], stats["rejected"]) == (0, 0, 1)
+    assert store.add_waiter(RECIPIENT, lambda: None)  # A long poll still waits for the next message
+
+
+def test_restore_over_the_cap_is_kept():
+    store = MessageStore(max_queue_bytes=10)
+    store.restore(Message(7, SENDER, RECIPIENT, 1, b"x" * 20))
+    assert [message.message_id for message in store.pull(RECIPIENT)] == [7]
+
+
+def test_restore_into_a_spilling_queue_goes_behind_the_spill(tmp_path):
+    store = spilling_store(tmp_path)
+    store.enqueue(RECIPIENT, SENDER, 1, b"a" * 10)
+    store.enqueue(RECIPIENT, SENDER, 1, b"b")  # Spilled
+    store.restore(Message(50, SENDER, RECIPIENT, 1, b"c"))
+    assert store.stats()["spilled_messages"] == 2
+    assert [read(message.content) for message in store.pull(RECIPIENT)] == [b"a" * 10, b"b", b"c"]
+
+
+def test_spill_keeps_order(tmp_path):
+    store = spilling_store(tmp_path)
+    contents = [b"a" * 6, b"b" * 6, b"c" * 3, b"d" * 20]
+    for content in contents:
+        store.enqueue(RECIPIENT, SENDER, 1, content)
+    assert store.stats()["spilled_messages"] == 3
+
+    pulled = store.pull(RECIPIENT)
+    assert [message.message_id for message in pulled] == [1, 2, 3, 4]
+    assert [read(message.content) for message in pulled] == contents
+
+
+def test_pull_streams_spilled_contents_from_the_spill_file(tmp_path):
+    store = spilling_store(tmp_path)
+    store.enqueue(RECIPIENT, SENDER, 1, b"a" * 10)
+    store.enqueue(RECIPIENT, SENDER, 1, b"b" * 1000)
+    store.enqueue(RECIPIENT, SENDER, 1, b"c" * 2000)
+    spill_path = store._shard(RECIPIENT).queues[RECIPIENT].spill_path
+
+    pulled = store.pull(RECIPIENT)
+    spilled = [message.content for message in pulled[1:]]
+    assert all(type(content) is SpooledContent and content.path == spill_path for content in spilled)
+    assert [read(content) for content in spilled] == [b"b" * 1000, b"c" * 2000]
+
+    # The spill file goes once the last range over it is discarded
+    spilled[0].discard()
+    assert os.path.exists(spill_path)
+    del pulled
+    spilled[1].discard()
+    assert not os.path.exists(spill_path)
+
+
+def test_spooled_message_in_spilled_queue_stays_spooled(tmp_path):
+    store = spilling_store(tmp_path)
+    store.enqueue(RECIPIENT, SENDER, 1, b"a" * 10)
+    store.enqueue(RECIPIENT, SENDER, 1, b"b" * 5)  # Starts the spill
+    content = spooled(b"big" * 1000)
+    store.enqueue(RECIPIENT, SENDER, 2, content)
+
+    spill_path = store._shard(RECIPIENT).queues[RECIPIENT].spill_path
+    assert os.path.getsize(spill_path) < 100  # The spool file was not copied into the spill file
+
+    pulled = store.pull(RECIPIENT)
+    assert [message.message_type for message in pulled] == [1, 1, 2]
+    assert pulled[2].content is content
+    assert type(pulled[2].content) is SpooledContent
+    assert read(pulled[2].content) == b"big" * 1000
+
+
+def test_expired_spill_discards_spooled_contents(tmp_path):
+    store = spilling_store(tmp_path)
+    store.ttl = 1
+    store.enqueue(RECIPIENT, SENDER, 1, b"a" * 10)
+    content = spooled(b"x" * 100)
+    store.enqueue(RECIPIENT, SENDER, 1, content)
+    path = content.path
+    del content
+
+    count, _, more = store.sweep(now=float("inf"))
+    assert (count, more) == (2, False)
+    assert not os.path.exists(path)
+    assert store.pull(RECIPIENT) == []
+
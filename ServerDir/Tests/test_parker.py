@@ -0,0 +1,57 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import Codec
+from Parker import ConnectionParker
+from Protocol import Protocol
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Main.py")
+
+
+def test_parked_socket_is_resumed_once_readable():
+    resumed = []
+    ready = threading.Event()
+    parker = ConnectionParker(lambda item: (resumed.append(item), ready.set()))
+    server, client = socket.socketpair()
+    with server, client:
+        parker.park(server, "connection")
+        assert not ready.wait(0.2)
+        assert parker.stats()["parked"] == 1
+
+        client.sendall(b"x")
+        assert ready.wait(5)
+        assert resumed == ["connection"]
+        assert parker.stats() == {"parked": 0, "peak_parked": 1, "resumed": 1}
+
+
+def test_idle_connections_do_not_hold_the_pool_workers(tmp_path):
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    server = subprocess.Popen([sys.executable, MAIN, "--port", str(port), "--mode", "pool", "--workers", "1",
+                               "--queue-depth", "1", "--log-level", "ERROR"],
+                              cwd=tmp_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                idle = [socket.create_connection(("127.0.0.1", port)) for _ in range(5)]
+                break
+            except OSError:
+                assert time.monotonic() < deadline
+                time.sleep(0.05)
+        time.sleep(0.3)
+
+        with socket.create_connection(("127.0.0.1", port), timeout=5) as client:
+            client.sendall(Protocol.build_request(b"", 2, Protocol.REGISTRATION_CODE,
+                                                  Codec.REGISTRATION.pack(b"busy\0", bytes(160))))
+            assert Codec.RESPONSE_HEADER.unpack(client.recv(Codec.RESPONSE_HEADER.size))[1] == 2100
+        for connection in idle:
+            connection.close()
+    finally:
+        server.kill()
+        server.wait()
@@ -0,0 +1,23 @@
+import RequestLog
+from Metrics import Histogram
+
+
+def make_records(latencies, code=603):
+    return b"".join(RequestLog.RECORD.pack(0.0, code, b"c" * 16, 10, latency, 2103, 23, RequestLog.OUTCOME_OK)
+                     for latency in latencies)
+
+
+def test_aggregate_counts_and_percentiles():
+    latencies = list(range(1, 10001))
+    records = RequestLog.iter_records(memoryview(make_records(latencies) + make_records([5], code=600)))
+    summary = RequestLog.aggregate(records)
+
+    assert summary[600]["count"] == 1 and summary[600]["p99_us"] == 5
+    send = summary[603]
+    assert send["count"] == 10000
+    assert send["bytes_in"] == 100000 and send["bytes_out"] == 230000
+    assert send["outcomes"]["ok"] == 10000
+    assert send["max_us"] == 10000
+    # Within the histogram resolution of the exact percentiles
+    assert abs(send["p50_us"] - 5000) <= 5000 / Histogram.SUB_BUCKETS
+    assert abs(send["p99_us"] - 9900) <= 9900 / Histogram.SUB_BUCKETS
@@ -31,14 +31,32 @@ def connect_and_execute(server_ip, server_port, user_id, action, *args):
             return None
 
 def build_register_request(client_id):
-    payload = struct.pack("255s 160s", b"yaron serlin\0", b"123456789")
-    header = struct.pack("16s B H I", b'', 1, 600, len(payload))
+    payload = struct.pack("<255s 160s", b"yaron serlin\0", b"123456789")
+    header = struct.pack("<16s B H I", b'', 1, 600, len(payload))
     return header + payload
 
 def build_user_list_request(client_id):
-    header = struct.pack("16s B H I", b'', 1, 601, 0)
+    header = struct.pack("<16s B H I", b'', 1, 601, 0)
     return header
 
+def recv_exact(client_socket, size):
+    data = b""
+    while len(data) < size:
+        chunk = client_socket.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def receive_response(client_socket):
+    header = recv_exact(client_socket, 7)
+    if header is None:
+        return None
+    version, code, payload_size = struct.unpack("<B H I", header)
+    payload = recv_exact(client_socket, payload_size) if payload_size else b""
+    return code, payload
+
 def mock_client(client_id):
     rand = random.randint(0,1)
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
@@ -58,9 +76,11 @@ def mock_client(client_id):
             client_socket.sendall(request)
             logger.info(f"Client {client_id.hex()}: Sent message to the server")
 
-            # Example of receiving data from the server
-            # response = client_socket.recv(1024).decode('utf-8')
-            # logger.info(f"Client {client_id}: Received response: {response}")
+            client_socket.shutdown(socket.SHUT_WR)  # No more requests on this connection
+            response = receive_response(client_socket)
+            if response:
+                logger.info(f"Client {client_id.hex()}: Received response with code [{response[0]}] "
+                            f"and {len(response[1])} bytes payload")
         except Exception as e:
             logger.error(f"Client {client_id}: Error during connection: {e}")
 
@@ -0,0 +1,62 @@
+import sqlite3
+import threading
+
+from MessageStore import Message, MessageStore
+from SqliteStore import SqliteStore
+from UserRegistry import UserRecord, UserRegistry
+
+CLIENT = UserRecord(b"c" * 16, "client", bytes(160), 1.0)
+
+
+class ImpatientStore(SqliteStore):
+    """Fails a locked commit at once instead of waiting out SQLite's busy timeout."""
+
+    def _connect(self):
+        connection = super()._connect()
+        connection.execute("PRAGMA busy_timeout=0")
+        return connection
+
+
+def message(message_id, content):
+    return Message(message_id, b"s" * 16, b"r" * 16, 3, content)
+
+
+def load(filename):
+    users, messages = UserRegistry(), MessageStore()
+    reader = SqliteStore(filename)
+    reader.load_into(users, messages)
+    reader.close()
+    return users, messages
+
+
+def test_a_locked_batch_is_retried(tmp_path):
+    filename = str(tmp_path / "server.db")
+    store = ImpatientStore(filename, retry_delay=0.05, commit_attempts=6)
+    other = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+    other.execute("BEGIN EXCLUSIVE")
+    store.record_client(CLIENT)
+    threading.Timer(0.2, other.rollback).start()
+
+    store.flush()
+    stats = store.stats()
+    store.close()
+    other.close()
+    assert stats["failed_commits"] >= 1
+    assert (stats["written"], stats["dropped_writes"]) == (1, 0)
+    users, _ = load(filename)
+    assert users.get(CLIENT.client_id).name == CLIENT.name
+
+
+def test_a_failing_write_does_not_drop_its_batch(tmp_path):
+    filename = str(tmp_path / "server.db")
+    store = SqliteStore(filename, flush_interval=5, retry_delay=0)
+    store.record_message(message(1, b"first"))
+    store.record_message(message(2, None))  # Violates NOT NULL on every attempt
+    store.record_message(message(3, b"third"))
+
+    store.flush()
+    stats = store.stats()
+    store.close()
+    assert (stats["written"], stats["dropped_writes"]) == (2, 1)
+    _, messages = load(filename)
+    assert [bytes(message.content) for message in messages.pull(b"r" * 16)] == [b"first", b"third"]
@@ -0,0 +1,54 @@
+import time
+
+from MessageStore import MessageStore
+
+RECIPIENT = b"r" * 16
+SENDER = b"s" * 16
+
+
+def test_sweep_drops_only_expired_messages():
+    store = MessageStore()
+    store.ttl = 1
+    store.enqueue(RECIPIENT, SENDER, 1, b"old")
+    store.ttl = 100
+    store.enqueue(RECIPIENT, SENDER, 1, b"new")
+
+    assert store.sweep(now=time.monotonic() + 50) == (1, 3, False)
+    assert [bytes(message.content) for message in store.pull(RECIPIENT)] == [b"new"]
+    assert store.stats()["expired_messages"] == 1
+
+
+def test_sweep_holds_the_lock_for_one_slice_at_a_time():
+    store = MessageStore(shards=1)
+    store.ttl = 1
+    for index in range(5):
+        store.enqueue(RECIPIENT, SENDER, 1, b"m%d" % index)
+
+    assert store.sweep(now=float("inf"), slice_size=2) == (2, 4, True)
+    assert store.sweep(now=float("inf"), slice_size=2) == (2, 4, True)
+    assert store.sweep(now=float("inf"), slice_size=2) == (1, 2, False)
+    stats = store.stats()
+    assert (stats["messages"], stats["queues"], stats["expired_messages"], stats["sweep_slices"]) == (0, 0, 5, 3)
+
+
+def test_sweep_skips_pulled_queues():
+    store = MessageStore()
+    store.ttl = 1
+    store.enqueue(RECIPIENT, SENDER, 1, b"m")
+    assert len(store.pull(RECIPIENT)) == 1
+    assert store.sweep(now=float("inf")) == (0, 0, False)
+
+
+def test_sweeper_thread_drops_expired_messages():
+    store = MessageStore()
+    store.ttl = 0.01
+    store.enqueue(RECIPIENT, SENDER, 1, b"m")
+    stop = store.start_sweeper(interval=0.01)
+    try:
+        deadline = time.monotonic() + 5
+        while store.stats()["expired_messages"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        stop.set()
+    assert store.stats()["expired_messages"] == 1
+    assert store.pull(RECIPIENT) == []
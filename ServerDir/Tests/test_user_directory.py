@@ -0,0 +1,50 @@
+import Codec
+from UserDirectory import UserDirectory
+
+
+def client_id(index):
+    return bytes([index]) * 16
+
+
+def directory(count, chunk_entries=4):
+    users = UserDirectory(chunk_entries)
+    for index in range(count):
+        users.append(client_id(index), b"user%d" % index)
+    return users
+
+
+def client_ids(views):
+    data = b"".join(bytes(view) for view in views)
+    return [Codec.USER_ENTRY.unpack_from(data, offset)[0] for offset in range(0, len(data), UserDirectory.ENTRY_SIZE)]
+
+
+def test_full_list_leaves_out_the_requester():
+    views, size, end = directory(10).entries(exclude=client_id(5))
+    assert client_ids(views) == [client_id(index) for index in range(10) if index != 5]
+    assert (size, end) == (9 * UserDirectory.ENTRY_SIZE, 10)
+
+
+def test_page_holding_the_requester_is_still_full():
+    users = directory(10)
+    views, _, end = users.entries(0, 3, exclude=client_id(1))
+    assert client_ids(views) == [client_id(0), client_id(2), client_id(3)]
+    assert end == 4
+
+    # The next page starts where this one ended, nothing is skipped or repeated
+    views, _, end = users.entries(end, 3, exclude=client_id(1))
+    assert client_ids(views) == [client_id(4), client_id(5), client_id(6)]
+    assert end == 7
+
+
+def test_page_of_only_the_requester_is_not_empty():
+    users = directory(3)
+    views, _, end = users.entries(1, 1, exclude=client_id(1))
+    assert client_ids(views) == [client_id(2)]
+    assert end == 3
+
+
+def test_last_page_is_short():
+    users = directory(5)
+    views, _, end = users.entries(3, 3, exclude=client_id(4))
+    assert client_ids(views) == [client_id(3)]
+    assert end == 5
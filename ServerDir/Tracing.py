@@ -0,0 +1,264 @@
+"""
+Opt-in request tracing and on-demand profiling.
+
+Tracing: when enabled, every request carries a small list of
+perf_counter_ns stamps taken at the stage boundaries of the pipeline:
+
+    accepted -> recv start -> frame read -> parsed -> logged -> handled -> sent
+
+Finished traces go into a ring buffer, and requests slower than the slow
+threshold (from frame read to sent) are logged with their stage breakdown
+and kept in a second ring buffer. When tracing is off the servers only test
+one module flag per request.
+
+Profiling: start_profile() runs cProfile for N seconds without restarting
+the server, also from a signal (see install_signal_handlers). Requests are
+sampled: one request at a time runs under its thread's profiler, so
+concurrent requests never share one, and the per-thread profiles are merged
+with pstats at the end.
+"""
+import io
+import json
+import os
+import pstats
+import signal
+import threading
+import time
+import cProfile
+from collections import deque
+
+from Logger import Log
+
+logger = Log(logger_name=__name__)
+
+# Indexes of the stamps in a trace
+ACCEPTED, RECV, FRAME, PARSED, LOGGED, HANDLED, SENT = range(7)
+# The stage ending at each stamp, starting from RECV
+STAGES = ("wait", "recv", "parse", "log", "handler", "send")
+
+DEFAULT_BUFFER_SIZE = 4096
+DEFAULT_PROFILE_SECONDS = 10
+
+enabled = False
+slow_threshold_ns = None
+_traces = deque(maxlen=DEFAULT_BUFFER_SIZE)
+_slow_traces = deque(maxlen=DEFAULT_BUFFER_SIZE)
+
+profiling = False  # True while a profile session runs
+_session = None
+_session_lock = threading.Lock()
+
+
+def enable(buffer_size=DEFAULT_BUFFER_SIZE, slow_ms=None):
+    """
+    Starts tracing every request.
+
+    Args:
+        buffer_size (int): The most recent traces kept, and separately the most recent slow ones.
+        slow_ms (float, optional): Requests taking at least this long from frame read to sent are logged.
+    """
+    global enabled, slow_threshold_ns, _traces, _slow_traces
+    _traces = deque(maxlen=buffer_size)
+    _slow_traces = deque(maxlen=buffer_size)
+    slow_threshold_ns = int(slow_ms * 1_000_000) if slow_ms is not None else None
+    enabled = True
+    logger.info(f"Tracing requests (buffer: {buffer_size}, slow threshold: {slow_ms} ms)")
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def new_trace(accepted_ns=None, recv_start_ns=None):
+    """
+    Starts the trace of a request, right before its frame is read.
+
+    Args:
+        accepted_ns (int, optional): When the connection was accepted, for its first request only.
+        recv_start_ns (int, optional): When reading the frame started, now by default.
+
+    Returns:
+        list: The stamps, filled in by mark() and finish().
+    """
+    trace = [0] * 7
+    trace[RECV] = recv_start_ns or time.perf_counter_ns()
+    trace[ACCEPTED] = accepted_ns or trace[RECV]
+    return trace
+
+
+def mark(trace, index):
+    trace[index] = time.perf_counter_ns()
+
+
+def finish(trace, code, client_id):
+    """
+    Stamps the end of a request and stores its trace.
+
+    Args:
+        trace (list): The stamps.
+        code (int): The request code.
+        client_id (bytes): The client ID from the request header.
+    """
+    trace[SENT] = time.perf_counter_ns()
+    # Stages a failed request skipped take no time
+    for index in range(PARSED, SENT):
+        if not trace[index]:
+            trace[index] = trace[index - 1]
+
+    record = (time.time(), code, client_id, trace)
+    _traces.append(record)
+    if slow_threshold_ns is not None and trace[SENT] - trace[FRAME] >= slow_threshold_ns:
+        _slow_traces.append(record)
+        logger.warning("Slow request [%d] from [%s]: %s", code, client_id.hex(), _Breakdown(trace))
+
+
+class _Breakdown:
+    # Renders the stage durations only if the log record is written
+    __slots__ = ("trace",)
+
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __str__(self):
+        durations = stage_durations(self.trace)
+        total = (self.trace[SENT] - self.trace[FRAME]) / 1000
+        return f"{total:.0f} us (" + ", ".join(f"{stage} {us:.0f}" for stage, us in durations.items()) + ")"
+
+
+def stage_durations(trace):
+    """Returns the duration of every stage of a trace, in microseconds."""
+    return {stage: (trace[index + 1] - trace[index]) / 1000 for index, stage in enumerate(STAGES)}
+
+
+def traces(slow_only=False):
+    """
+    Returns the buffered traces, oldest first.
+
+    Args:
+        slow_only (bool): Only the slow ones.
+
+    Returns:
+        list: One dict per request, with its time, code, client ID and stage durations in microseconds.
+    """
+    records = list(_slow_traces if slow_only else _traces)
+    return [{"time": created, "code": code, "client_id": client_id.hex(),
+             "total_us": (trace[SENT] - trace[FRAME]) / 1000, "stages_us": stage_durations(trace)}
+            for created, code, client_id, trace in records]
+
+
+def dump(filename):
+    """
+    Writes the buffered traces to a file as JSON lines, slow ones flagged.
+
+    Args:
+        filename (str): The file, overwritten.
+    """
+    slow = {id(record[3]) for record in list(_slow_traces)}
+    records = list(_traces)
+    with open(filename, "w") as file:
+        for created, code, client_id, trace in records:
+            file.write(json.dumps({"time": created, "code": code, "client_id": client_id.hex(),
+                                   "slow": id(trace) in slow, "total_us": (trace[SENT] - trace[FRAME]) / 1000,
+                                   "stages_us": stage_durations(trace)}) + "\n")
+    logger.info(f"Wrote {len(records)} request traces to '{filename}'")
+
+
+class _ProfileSession:
+    def __init__(self, seconds, filename):
+        self.deadline = time.monotonic() + seconds
+        self.filename = filename
+        self.lock = threading.Lock()  # Held by the one request being profiled
+        self.profiles = {}  # Thread ID -> cProfile.Profile
+        self.sampled = 0
+        self.skipped = 0
+
+
+def start_profile(seconds=DEFAULT_PROFILE_SECONDS, filename=None):
+    """
+    Profiles sampled requests for a while, then writes the merged profile and logs its top functions.
+
+    Args:
+        seconds (float): How long to profile.
+        filename (str, optional): Where to write the pstats file. profile-<pid>-<time>.pstats by default.
+
+    Returns:
+        bool: False if a profile session is already running.
+    """
+    global profiling, _session
+    filename = filename or f"profile-{os.getpid()}-{int(time.time())}.pstats"
+    session = _ProfileSession(seconds, filename)
+    with _session_lock:
+        if _session is not None:
+            logger.warning("A profile session is already running")
+            return False
+        _session = session
+        profiling = True
+    timer = threading.Timer(seconds, _stop_profile, args=(session,))
+    timer.daemon = True
+    timer.start()
+    logger.info(f"Profiling requests for {seconds}s")
+    return True
+
+
+def profile_call(function, *args):
+    """
+    Calls a request handling function, under the profiler of the calling thread if this request is sampled.
+    """
+    session = _session
+    if session is None or time.monotonic() >= session.deadline or not session.lock.acquire(blocking=False):
+        if session is not None:
+            session.skipped += 1
+        return function(*args)
+    try:
+        profile = session.profiles.get(threading.get_ident())
+        if profile is None:
+            profile = session.profiles[threading.get_ident()] = cProfile.Profile()
+        session.sampled += 1
+        return profile.runcall(function, *args)
+    finally:
+        session.lock.release()
+
+
+def _stop_profile(session):
+    global profiling, _session
+    profiling = False
+    _session = None
+    with session.lock:  # Waits for the request being profiled, if any
+        profiles = list(session.profiles.values())
+
+    if not profiles:
+        logger.warning("No request was handled while profiling")
+        return
+
+    stats = pstats.Stats(*profiles)
+    try:
+        stats.dump_stats(session.filename)
+    except OSError as e:
+        logger.error(f"Failed to write the profile to '{session.filename}': {e}")
+
+    summary = io.StringIO()
+    stats.stream = summary
+    stats.sort_stats("cumulative").print_stats(15)
+    logger.info(f"Profiled {session.sampled} requests on {len(profiles)} threads ({session.skipped} not sampled), "
+                f"written to '{session.filename}':\n{summary.getvalue()}")
+
+
+def _in_background(function, *args):
+    threading.Thread(target=function, args=args, daemon=True).start()
+
+
+def install_signal_handlers(profile_seconds=DEFAULT_PROFILE_SECONDS, dump_filename="traces.jsonl"):
+    """
+    SIGUSR1 starts a profile session of profile_seconds, SIGUSR2 dumps the buffered traces to dump_filename.
+    Must be called from the main thread. Does nothing where these signals do not exist (Windows).
+    """
+    if not hasattr(signal, "SIGUSR1"):
+        logger.warning("Profiling and trace dump signals are not available on this platform")
+        return
+
+    # The work runs on a new thread: the interrupted main thread may hold the logger's locks
+    signal.signal(signal.SIGUSR1, lambda signum, frame: _in_background(start_profile, profile_seconds))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: _in_background(dump, dump_filename))
+    logger.info(f"Send SIGUSR1 to profile for {profile_seconds}s, SIGUSR2 to dump traces to '{dump_filename}' "
+                f"(pid {os.getpid()})")
@@ -0,0 +1,95 @@
+import threading
+
+import Codec
+
+
+class UserDirectory:
+    """
+    The payload of the user list response (2101), kept encoded.
+
+    Every registration packs its 271 bytes entry once, at the end of the
+    directory, so a user list request only slices what is already there and
+    the response goes out as memoryviews of these buffers, without packing or
+    copying a single entry. The storage is a list of fixed-size chunks that
+    are never resized or moved once allocated (a bytearray with exported
+    memoryviews could not grow), and entries are only ever appended, so a
+    view handed out keeps showing the same bytes while later registrations
+    are added.
+
+    The version of the directory is its number of entries: entries since
+    version N are the ones registered after the first N, which is what the
+    delta form of the user list request returns.
+    """
+    CHUNK_ENTRIES = 1024
+    ENTRY_SIZE = Codec.USER_ENTRY.size
+
+    def __init__(self, chunk_entries=CHUNK_ENTRIES):
+        """
+        Args:
+            chunk_entries (int): Entries per storage chunk.
+        """
+        self._chunk_entries = chunk_entries
+        self._chunk_size = chunk_entries * UserDirectory.ENTRY_SIZE
+        self._chunks = []
+        self._positions = {}  # Client ID -> entry position
+        self._count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        return self._count
+
+    def append(self, client_id, name):
+        """
+        Adds the entry of a new client.
+
+        Args:
+            client_id (bytes): The client ID.
+            name (bytes): The client name, ASCII encoded.
+        """
+        with self._lock:
+            position = self._count
+            chunk_index, slot = divmod(position, self._chunk_entries)
+            if chunk_index == len(self._chunks):
+                self._chunks.append(bytearray(self._chunk_size))
+            Codec.USER_ENTRY.pack_into(self._chunks[chunk_index], slot * UserDirectory.ENTRY_SIZE, client_id, name)
+            self._positions[client_id] = position
+            # Counted last: readers never see an entry before it is complete
+            self._count = position + 1
+
+    def entries(self, start=0, limit=None, exclude=None):
+        """
+        Returns encoded entries, oldest first.
+
+        Args:
+            start (int): The first entry position, a version of the directory.
+            limit (int, optional): The most entries to return. The excluded entry does not count, so a page is only
+                short at the end of the directory.
+            exclude (bytes, optional): The client ID to leave out (the requester).
+
+        Returns:
+            tuple: (views, size, end): memoryviews over the entries, their total size in bytes, and the version
+            reached, from which the next delta starts.
+        """
+        with self._lock:
+            count = self._count
+            excluded = self._positions.get(exclude, -1) if exclude is not None else -1
+        start = min(max(start, 0), count)
+        end = count if limit is None else min(count, start + limit)
+        if limit is not None and start <= excluded < end:
+            end = min(count, end + 1)  # The requester's entry is skipped, take one more in its place
+
+        views = []
+        size = 0
+        ranges = ((start, excluded), (excluded + 1, end)) if start <= excluded < end else ((start, end),)
+        for range_start, range_end in ranges:
+            position = range_start
+            while position < range_end:
+                chunk_index, slot = divmod(position, self._chunk_entries)
+                taken = min(range_end - position, self._chunk_entries - slot)
+                view = memoryview(self._chunks[chunk_index])[slot * UserDirectory.ENTRY_SIZE:
+                                                             (slot + taken) * UserDirectory.ENTRY_SIZE]
+                views.append(view)
+                size += len(view)
+                position += taken
+        return views, size, end
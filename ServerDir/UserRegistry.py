@@ -0,0 +1,145 @@
+import threading
+import time
+import uuid
+
+from UserDirectory import UserDirectory
+
+
+class UserRecord:
+    """One registered client. Kept small with __slots__ as there is one per user for the server's lifetime."""
+    __slots__ = ("client_id", "name", "public_key", "last_seen")
+
+    def __init__(self, client_id, name, public_key, last_seen=None):
+        self.client_id = client_id  # 16 bytes
+        self.name = name  # str, at most 255 ASCII characters
+        self.public_key = public_key  # 160 bytes
+        self.last_seen = last_seen if last_seen is not None else time.time()
+
+    def __repr__(self):
+        return f"UserRecord(client_id={self.client_id.hex()}, name={self.name!r}, last_seen={self.last_seen})"
+
+
+class _Shard:
+    __slots__ = ("lock", "items")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = {}
+
+
+class UserRegistry:
+    """
+    Thread-safe registry of the registered clients.
+
+    Records are indexed by client ID and by name, so registration, duplicate
+    name checks and public key lookups are all O(1). Each index is split into
+    shards with their own lock (a key always maps to the same shard), so
+    threads working on different clients rarely wait for each other. The
+    user list is kept encoded next to the indexes (see UserDirectory).
+    """
+    DEFAULT_SHARDS = 16
+
+    def __init__(self, shards=DEFAULT_SHARDS):
+        """
+        Args:
+            shards (int): The number of lock stripes of each index.
+        """
+        self._by_id = [_Shard() for _ in range(shards)]
+        self._by_name = [_Shard() for _ in range(shards)]
+        self._directory = UserDirectory()
+        self.journal = None  # Optional durable store told about every new registration (see SqliteStore)
+
+    def _id_shard(self, client_id):
+        return self._by_id[hash(client_id) % len(self._by_id)]
+
+    def _name_shard(self, name):
+        return self._by_name[hash(name) % len(self._by_name)]
+
+    def register(self, name, public_key):
+        """
+        Registers a new client under a fresh client ID.
+
+        Args:
+            name (str): The client name, unique among registered clients.
+            public_key (bytes): The client's 160 bytes public key.
+
+        Returns:
+            UserRecord: The new record.
+
+        Raises:
+            ValueError: If the name is already registered.
+        """
+        record = UserRecord(uuid.uuid4().bytes, name, public_key)
+        self.add(record)
+        if self.journal is not None:
+            self.journal.record_client(record)
+        return record
+
+    def add(self, record):
+        """
+        Adds an existing record, for example one loaded from storage.
+
+        Raises:
+            ValueError: If the record's name or client ID is already registered.
+        """
+        name_shard = self._name_shard(record.name)
+        with name_shard.lock:
+            if record.name in name_shard.items:
+                raise ValueError(f"The name [{record.name}] is already registered")
+            name_shard.items[record.name] = record
+
+        id_shard = self._id_shard(record.client_id)
+        with id_shard.lock:
+            if record.client_id in id_shard.items:
+                duplicate = True
+            else:
+                duplicate = False
+                id_shard.items[record.client_id] = record
+
+        if duplicate:
+            with name_shard.lock:
+                del name_shard.items[record.name]
+            raise ValueError(f"The client ID [{record.client_id.hex()}] is already registered")
+
+        self._directory.append(record.client_id, record.name.encode("ascii"))
+
+    def get(self, client_id):
+        """Returns the record of a client ID, or None."""
+        shard = self._id_shard(client_id)
+        with shard.lock:
+            return shard.items.get(client_id)
+
+    def get_by_name(self, name):
+        """Returns the record registered under a name, or None."""
+        shard = self._name_shard(name)
+        with shard.lock:
+            return shard.items.get(name)
+
+    def touch(self, client_id):
+        """
+        Updates the last seen time of a client.
+
+        Returns:
+            UserRecord: The client's record, or None if it is not registered.
+        """
+        shard = self._id_shard(client_id)
+        with shard.lock:
+            record = shard.items.get(client_id)
+            if record is not None:
+                record.last_seen = time.time()
+            return record
+
+    def user_directory(self):
+        """Returns the encoded user list of the registered clients."""
+        return self._directory
+
+    def users(self):
+        """Returns a snapshot list of all the records."""
+        records = []
+        for shard in self._by_id:
+            with shard.lock:
+                records.extend(shard.items.values())
+        return records
+
+    def __len__(self):
+        return sum(len(shard.items) for shard in self._by_id)
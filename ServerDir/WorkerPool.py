@@ -0,0 +1,120 @@
+import queue
+import threading
+
+from Logger import Log
+
+logger = Log(logger_name=__name__)
+
+
+class WorkerPool:
+    """
+    Fixed number of worker threads fed from a bounded work queue.
+
+    Unlike ThreadPoolExecutor, whose queue is unbounded, submit() refuses work
+    as soon as the queue is full so the caller can shed load early instead of
+    letting requests pile up behind the workers.
+    """
+    _STOP = object()
+
+    def __init__(self, handler, max_workers, queue_depth, name="worker"):
+        """
+        Starts the worker threads.
+
+        Args:
+            handler (callable): Called with each submitted item on a worker thread.
+            max_workers (int): The number of worker threads.
+            queue_depth (int): How many items may wait for a free worker.
+            name (str): Prefix for the worker thread names.
+        """
+        if max_workers < 1:
+            raise ValueError(f"max_workers must be at least 1, got {max_workers}")
+        if queue_depth < 1:
+            raise ValueError(f"queue_depth must be at least 1, got {queue_depth}")
+
+        self._handler = handler
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._queue_depth = queue_depth
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._rejected = 0
+        self._completed = 0
+        self._active = 0
+        self._peak_queue_depth = 0
+
+        self._workers = [
+            threading.Thread(target=self._worker, name=f"{name}-{i}", daemon=True)
+            for i in range(max_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, item):
+        """
+        Queues an item for the workers without blocking.
+
+        Args:
+            item: The item to pass to the handler.
+
+        Returns:
+            bool: True if the item was queued, False if the queue is full.
+        """
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            return False
+
+        with self._lock:
+            self._submitted += 1
+            self._peak_queue_depth = max(self._peak_queue_depth, self._queue.qsize())
+        return True
+
+    def stats(self):
+        """
+        Returns a snapshot of the pool counters.
+
+        Returns:
+            dict: Queue depth and capacity, active workers and submitted/rejected/completed counts.
+        """
+        with self._lock:
+            return {
+                "workers": len(self._workers),
+                "active": self._active,
+                "queue_depth": self._queue.qsize(),
+                "queue_capacity": self._queue_depth,
+                "peak_queue_depth": self._peak_queue_depth,
+                "submitted": self._submitted,
+                "rejected": self._rejected,
+                "completed": self._completed,
+            }
+
+    def shutdown(self, wait=True):
+        """
+        Stops the workers once the already queued items are handled.
+
+        Args:
+            wait (bool): Whether to wait for the workers to exit.
+        """
+        for _ in self._workers:
+            self._queue.put(WorkerPool._STOP)
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is WorkerPool._STOP:
+                return
+
+            with self._lock:
+                self._active += 1
+            try:
+                self._handler(item)
+            except Exception as e:
+                logger.error(e)
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    self._completed += 1